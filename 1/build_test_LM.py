@@ -6,12 +6,27 @@ import getopt
 import argparse
 import pprint
 import math
+import itertools
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+import batch
+import lmfile
+from eval import accuracy
 
 
 class Tokenizer(object):
     """Base class for all tokenizer type,
     Any child class must implement tokenize method
     """
+    def parameters(self):
+        """Keyword arguments to create the same tokenizer,
+        stored in the language model files"""
+        return {}
+
     def tokenize(self, sentence):
         """
         @sentence the line will be tokenize
@@ -28,6 +43,9 @@ class CharacterTokenizer(Tokenizer):
         self.ngram = ngram
         self.pad = pad
 
+    def parameters(self):
+        return {'ngram': self.ngram, 'pad': self.pad}
+
     def _replace_digits(self, sentence, digits_representation='0'):
         """replace all digits into `0`, 
         so we can treat any `0` as any number"""
@@ -61,63 +79,166 @@ class CharacterTokenizer(Tokenizer):
         return token_list
 
 
-class LanguagePredictor(object):
-    """Predictor handles the prediction based on the language model given"""
+# Tokenizers by class name, to create the one of a model file
+TOKENIZERS = {
+    'WordTokenizer': WordTokenizer,
+    'CharacterTokenizer': CharacterTokenizer,
+}
 
-    # static counter for debugging purpose
-    prediction_index = 1
-    def __init__(self, language_model_dict, tokenizer):
-        self._language_model_dict = language_model_dict
+
+class LanguagePredictor(object):
+    """Predictor handles the prediction based on the language matrix given,
+    it keeps no state of its own between the predictions, so that it can
+    be shared by the worker processes of a streaming prediction"""
+    def __init__(self, language_matrix, tokenizer):
+        self._language_matrix = language_matrix
         self.tokenizer = tokenizer
 
     def predict(self, sentence):
-        """Predict the probability of a sentence
-        based on the language model registered"""
-        prediction_dict = {}
-        for lang in self._language_model_dict.keys():
-            prediction_dict[lang] = 0
-
-        tokens = self.tokenizer.tokenize(sentence)
-
-        # For each token, it will sum the total count
-        rogue_token_count = 0
-        for token in tokens:
-            most_used_lang = max(
-                    self._language_model_dict,
-                    key=lambda lang: self._language_model_dict[lang][token])
-            # If token in the most commonly used language is not 1
-            if (self._language_model_dict[most_used_lang][token] > self._language_model_dict[most_used_lang].smooth_value):
-                for lang, lang_model in self._language_model_dict.items():
-
-                    # Do the log because of the small floating point
-                    prediction_dict[lang] += math.log(lang_model[token])
-                    prediction_dict[lang] -= math.log(lang_model.token_count)
+        """Predict the language of a sentence
+        based on the language models compiled in the matrix"""
+        return self.predict_batch([sentence])[0]
+
+    def predict_batch(self, sentences):
+        """Predict the language of each sentence,
+        the sentences are scored together by a single gather
+        of their token columns in the log probability matrix"""
+        matrix = self._language_matrix
+        token_lists = [self.tokenizer.tokenize(sentence)
+                for sentence in sentences]
+        token_counts = np.array([len(tokens) for tokens in token_lists],
+                dtype=np.int64)
+
+        # A token is rogue when no language has seen it in training,
+        # its count is then the smooth value in every language
+        columns, seen = matrix.columns(
+                list(itertools.chain.from_iterable(token_lists)))
+        sentence_ids = np.repeat(np.arange(len(sentences)), token_counts)
+        valid_sentence_ids = sentence_ids[seen]
+        valid_token_counts = np.bincount(valid_sentence_ids,
+                minlength=len(sentences))
+        rogue_token_counts = token_counts - valid_token_counts
+
+        # languages x sentences sums of the token log probabilities,
+        # added in the order of the tokens
+        scores = np.zeros((len(matrix.languages), len(sentences)))
+        for row, log_probabilities in enumerate(
+                matrix.log_probabilities[:, columns[seen]]):
+            scores[row] = np.bincount(valid_sentence_ids,
+                    weights=log_probabilities, minlength=len(sentences))
+
+        predictions = []
+        for i in range(len(sentences)):
+            # Get the Highest prediction, the first language on ties
+            best = scores[:, i].argmax() if len(matrix.languages) else None
+            # Unknown language when zero probability or too much rogue token
+            if (best is None or scores[best, i] == 0
+                    or rogue_token_counts[i] > valid_token_counts[i]):
+                predictions.append('other')
             else:
-                rogue_token_count += 1
+                predictions.append(matrix.languages[best])
 
-        valid_token_count = len(tokens) - rogue_token_count
+        return predictions
 
-        # [(lang1, 0.01), (lang2, 0.005), ...]
-        pred = list(map(
-            lambda lang: (
-                lang, 
-                prediction_dict[lang]
-            ), prediction_dict.keys()))
+    def predict_lines(self, sentences):
+        """Output lines of the sentences, each one prefixed
+        with its predicted language"""
+        return ["{predicted} {sentence}".format(**{
+                    'predicted': predicted,
+                    'sentence': sentence,
+                }) for predicted, sentence in zip(
+                    self.predict_batch(sentences), sentences)]
 
-        # Get the Highest prediction
-        result = max(pred, key=(lambda x: x[1]))
-        # Princ prediction score
-        # print(result[1])
-
-        # Unknown language when zero probability or too much rogue token
-        if result[1] == 0 or rogue_token_count > valid_token_count:
-            predicted_language = 'other'
-        else:
-            predicted_language = result[0]
-
-        # simple counter for debugging purpose
-        LanguagePredictor.prediction_index+=1
-        return predicted_language
+class LanguageMatrix(object):
+    """
+    language matrix is the trained language models compiled
+    for the prediction, and stored in the language model files
+    (see lmfile.py).
+
+    Language Matrix Data Structure:
+    - languages: [<language-A>, <language-B>, ...], one row each
+    - tokens: sorted NumPy array of every token seen in the training
+      of any language, as UTF-8 byte strings, one column each.
+      With hashed language models, the buckets of the seen tokens
+    - buckets: number of buckets of hashed language models, else None
+    - log_probabilities: languages x tokens matrix of
+        log(<smoothed count> / <token_count>)
+      of each token in each language model
+
+    The byte strings of NumPy ignore trailing null bytes, tokens
+    which only differ by them are the same column.
+    """
+    def __init__(self, languages, tokens, log_probabilities, buckets=None):
+        self.languages = languages
+        self.tokens = tokens
+        self.log_probabilities = log_probabilities
+        self.buckets = buckets
+
+    @classmethod
+    def from_models(cls, language_models):
+        """Compile the smoothed language models
+        @language_models dictionary of <language>: <language-model>
+        """
+        languages = list(language_models)
+        if any(isinstance(language_model, HashedLanguageModel)
+                for language_model in language_models.values()):
+            return cls.from_hashed_models(language_models)
+        tokens = sorted(set().union(*(
+            language_model.tokens()
+            for language_model in language_models.values())))
+        log_probabilities = np.empty((len(languages), len(tokens)))
+        for row, lang in enumerate(languages):
+            lang_model = language_models[lang]
+            counts = np.array([lang_model[token] for token in tokens],
+                    dtype=np.float64)
+            # Do the log because of the small floating point
+            log_probabilities[row] = (np.log(counts)
+                    - math.log(lang_model.token_count))
+
+        # Columns in the order of the byte strings
+        token_table = np.array([token.encode() for token in tokens],
+                dtype=bytes)
+        order = np.argsort(token_table, kind='stable')
+        return cls(languages, token_table[order], log_probabilities[:, order])
+
+    @classmethod
+    def from_hashed_models(cls, language_models):
+        """Compile the smoothed hashed language models,
+        which must have the same number of buckets"""
+        languages = list(language_models)
+        models = list(language_models.values())
+        buckets = models[0].buckets
+        if any(model.buckets != buckets for model in models):
+            raise ValueError('the language models have different buckets')
+
+        counts = np.array([model.counts() for model in models],
+                dtype=np.float64)
+        seen = np.flatnonzero(counts.any(axis=0))
+        counts = counts[:, seen]
+        for row, model in enumerate(models):
+            counts[row][counts[row] == 0] = model.smooth_value
+        log_probabilities = np.log(counts) - np.log(
+                [[model.token_count] for model in models])
+        return cls(languages, seen.astype(np.uint32), log_probabilities,
+                buckets)
+
+    def keys(self, tokens):
+        """Keys of the tokens in the token table"""
+        if self.buckets:
+            return np.array([token_bucket(token, self.buckets)
+                for token in tokens], dtype=np.uint32)
+        return np.array([token.encode() for token in tokens], dtype=bytes)
+
+    def columns(self, tokens):
+        """(columns, seen) arrays of the tokens, seen is False
+        for the tokens not in the matrix"""
+        keys = self.keys(tokens)
+        if not len(self.tokens):
+            return (np.zeros(len(keys), dtype=np.int64),
+                    np.zeros(len(keys), dtype=bool))
+        columns = np.minimum(np.searchsorted(self.tokens, keys),
+                len(self.tokens) - 1)
+        return columns, self.tokens[columns] == keys
 
 class LanguageModel(object):
     """
@@ -162,6 +283,16 @@ class LanguageModel(object):
             self[token]+=value
             self.token_count+=value
 
+    def tokens(self):
+        """Tokens seen in the training"""
+        return self._dict.keys()
+
+    def memory(self):
+        """Approximate size in bytes of the dictionary counter"""
+        return sys.getsizeof(self._dict) + sum(
+                sys.getsizeof(token) + sys.getsizeof(count)
+                for token, count in self._dict.items())
+
     def __getitem__(self, token):
         """Retrieve the token count from the dictionary"""
         return self._dict.get(token, self.smooth_value)
@@ -177,21 +308,91 @@ class LanguageModel(object):
         return "{language} - total: {total}".format(
                 language=self.language, total=self.token_count)
 
-def build_LM(input_file_b, tokenizer=CharacterTokenizer(ngram=4)):
+def token_bucket(token, buckets):
+    """Bucket of a token among `buckets`, the same in every process"""
+    return zlib.crc32(token.encode()) % buckets
+
+class HashedLanguageModel(LanguageModel):
+    """
+    hashed language model counts the tokens in a fixed number of
+    buckets instead of a dictionary, so its memory does not grow
+    with the training data. The tokens of a bucket share its count.
+
+    Hashed Language Model Data Structure:
+    - _counts: NumPy array of the count of each bucket,
+      0 for the buckets of no token seen in the training
+    - token_count
+    """
+    def __init__(self, language, tokenizer, buckets):
+        super().__init__(language, tokenizer)
+        self.buckets = buckets
+        self._counts = np.zeros(buckets, dtype=np.int64)
+
+    def train(self, sentence):
+        """Tokenize and add each token into the bucket counter"""
+        tokens = self.tokenizer.tokenize(sentence)
+        np.add.at(self._counts,
+                [token_bucket(token, self.buckets) for token in tokens], 1)
+        self.token_count += len(tokens)
+
+    def smoothing(self, value=0):
+        """increase the counter of the seen buckets by value"""
+        self.smooth_value = value
+        seen = self._counts > 0
+        self._counts[seen] += value
+        self.token_count += value * int(seen.sum())
+
+    def counts(self):
+        """Counts of the buckets, 0 for the unseen ones"""
+        return self._counts
+
+    def tokens(self):
+        raise TypeError('the tokens of a hashed language model are '
+                'not kept')
+
+    def memory(self):
+        return self._counts.nbytes
+
+    def __getitem__(self, token):
+        count = self._counts[token_bucket(token, self.buckets)]
+        return int(count) if count else self.smooth_value
+
+    def __setitem__(self, token, value):
+        self._counts[token_bucket(token, self.buckets)] = value
+
+    def __repr__(self):
+        return "{language} - total: {total}, {buckets} buckets".format(
+                language=self.language, total=self.token_count,
+                buckets=self.buckets)
+
+def build_LM(input_file_b, tokenizer=CharacterTokenizer(ngram=4),
+        buckets=None):
     """
     build language models for each label
     each line in in_file contains a label
     and an URL separated by a tab(\t)
 
+    @buckets number of buckets of hashed language models,
+    None for exact token counts
+
+    return the LanguageMatrix compiled from the language models
+    of each label, smoothed
+    """
+    print('Training language models...')
+    return LanguageMatrix.from_models(
+            train_LM(input_file_b, tokenizer, buckets))
+
+def train_LM(input_file_b, tokenizer, buckets=None):
+    """
+    train the smoothed language models of each label
+
     return dictionary with the following formats:
     {
         <language-A>: <language-model>,
         <language-B>: <language-model>,
         <language-C>: <language-model>,
     }
-    
     """
-    print('Training language models...')
 
     with open(input_file_b) as f:
         sample_data = f.readlines()
@@ -201,7 +402,12 @@ def build_LM(input_file_b, tokenizer=CharacterTokenizer(ngram=4)):
         language, sentence = line.split(' ', 1)
 
         if language not in language_models:
-            language_models[language] = LanguageModel(language, tokenizer)
+            if buckets:
+                language_models[language] = HashedLanguageModel(
+                        language, tokenizer, buckets)
+            else:
+                language_models[language] = LanguageModel(
+                        language, tokenizer)
 
         language_models[language].train(sentence)
 
@@ -214,53 +420,173 @@ def build_LM(input_file_b, tokenizer=CharacterTokenizer(ngram=4)):
 
     return language_models
 
-def test_LM(in_file, out_file, lm, tokenizer=CharacterTokenizer(ngram=4)):
+def save_LM(model_file, language_matrix, tokenizer):
+    """Write the language matrix and the tokenizer
+    into a language model file"""
+    lmfile.write_model(model_file, language_matrix.languages,
+            (type(tokenizer).__name__, tokenizer.parameters()),
+            language_matrix.tokens, language_matrix.log_probabilities,
+            language_matrix.buckets)
+
+def load_LM(model_file):
+    """
+    load a language model file written by save_LM
+
+    return (<language-matrix>, <tokenizer>), the matrix
+    is read in place from the memory map of the file
+    """
+    print('Loading language model...')
+    (languages, (tokenizer_name, parameters), tokens, log_probabilities,
+            buckets) = lmfile.read_model(model_file)
+    tokenizer = TOKENIZERS[tokenizer_name](**parameters)
+    return (LanguageMatrix(languages, tokens, log_probabilities, buckets),
+            tokenizer)
+
+def test_LM(in_file, out_file, lm, tokenizer=CharacterTokenizer(ngram=4),
+        jobs=1, chunk_size=1024):
     """
     predict the language of each in_file lines.
+
+    The lines are read and their predictions written as they go,
+    in chunks of chunk_size lines (see batch.py), so the memory does
+    not depend on the size of in_file.
+    @jobs number of forked processes predicting the chunks,
+    sharing the language models of this process
+
+    return the number of lines predicted
     """
     print("Predicting language...")
     predictor = LanguagePredictor(lm, tokenizer)
 
-    # Read test file into test_data
-    with open(in_file) as f:
-        test_data = f.readlines()
-
-    # Predict the language of test_data
-    result = []
-    for line in test_data:
-        result.append(predictor.predict(line))
-
-    # Save the predicted test_data languages
-    with open(out_file, 'w') as f:
-        for i in range(len(test_data)):
-            f.write("{predicted} {sentence}".format(**{
-                'predicted': result[i],
-                'sentence': test_data[i],
-            }))
+    # Predict the language of the test lines, in order
+    throughput = batch.Throughput()
+    with open(in_file) as test_data, open(out_file, 'w') as f:
+        count = batch.run(predictor.predict_lines, test_data, f.write,
+                jobs, chunk_size)
+    print(throughput.report(count, jobs, 'lines'))
+    return count
 
-def main(input_file_b, input_file_t, output_file):
+def main(input_file_b, input_file_t, output_file, jobs=1):
     """Train and Predict the language"""
     tokenizer = CharacterTokenizer(ngram=4, pad=True)
     #tokenizer = WordTokenizer()
     language_models = build_LM(input_file_b, tokenizer)
-    test_LM(input_file_t, output_file, language_models, tokenizer)
+    test_LM(input_file_t, output_file, language_models, tokenizer, jobs)
+
+def train(input_file_b, model_file, buckets=None):
+    """Train the language models into a model file"""
+    tokenizer = CharacterTokenizer(ngram=4, pad=True)
+    language_models = build_LM(input_file_b, tokenizer, buckets)
+    save_LM(model_file, language_models, tokenizer)
+
+def predict(model_file, input_file_t, output_file, jobs=1):
+    """Predict the language with the models of a model file"""
+    language_models, tokenizer = load_LM(model_file)
+    test_LM(input_file_t, output_file, language_models, tokenizer, jobs)
 
     
+def report(input_file_b, input_file_t, correct_file, bucket_counts):
+    """Print the memory and the accuracy of exact and hashed
+    language models, to choose the number of buckets"""
+    tokenizer = CharacterTokenizer(ngram=4, pad=True)
+    print("{:>10} {:>14} {:>12} {:>10}".format(
+        'buckets', 'counters KB', 'model KB', 'accuracy'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = os.path.join(tmp_dir, 'output.txt')
+        for buckets in [None] + sorted(bucket_counts):
+            language_models = train_LM(input_file_b, tokenizer, buckets)
+            counters = sum(language_model.memory()
+                    for language_model in language_models.values())
+            language_matrix = LanguageMatrix.from_models(language_models)
+            model = (language_matrix.tokens.nbytes
+                    + language_matrix.log_probabilities.nbytes)
+            predictor = LanguagePredictor(language_matrix, tokenizer)
+            with open(input_file_t) as f:
+                test_data = f.readlines()
+            with open(output_file, 'w') as f:
+                f.writelines(predictor.predict_lines(test_data))
+            correct, count = accuracy(output_file, correct_file)
+            print("{:>10} {:>14.1f} {:>12.1f} {:>9.2f}%".format(
+                buckets or 'exact', counters / 1024, model / 1024,
+                correct * 100.0 / count))
+
 def getCommandArgs():
-    """Handling arguments for the command line"""
+    """Handling arguments for the command line,
+    train and predict with -b, -t and -o, or train once into
+    a model file and predict many times with the subcommands"""
     parser = argparse.ArgumentParser(description='Detect Language')
     parser.add_argument('-b', metavar='input-file-for-building-LM',
             type=str, help='input file for building the language model',
-            dest='input_file_b', required=True)
+            dest='input_file_b')
     parser.add_argument('-t', metavar='input-file-for-testing-LM',
             type=str, help='input file for testing the language',
-            dest='input_file_t', required=True)
+            dest='input_file_t')
     parser.add_argument('-o', metavar='output-file',
+            type=str, help='output file of the language prediction',
+            dest='output_file')
+    parser.add_argument('--jobs', type=int, dest='jobs', default=1,
+            help='number of processes predicting the test lines')
+    commands = parser.add_subparsers(dest='command')
+
+    train_parser = commands.add_parser('train',
+            help='train the language models into a model file')
+    train_parser.add_argument('-b', metavar='input-file-for-building-LM',
+            type=str, help='input file for building the language model',
+            dest='input_file_b', required=True)
+    train_parser.add_argument('-m', metavar='model-file',
+            type=str, help='output language model file',
+            dest='model_file', required=True)
+    train_parser.add_argument('--buckets', type=int, dest='buckets',
+            help='hash the tokens into this number of buckets per '
+            'language, to bound the memory of the counters')
+
+    predict_parser = commands.add_parser('predict',
+            help='predict the language with a model file')
+    predict_parser.add_argument('-m', metavar='model-file',
+            type=str, help='language model file written by train',
+            dest='model_file', required=True)
+    predict_parser.add_argument('-t', metavar='input-file-for-testing-LM',
+            type=str, help='input file for testing the language',
+            dest='input_file_t', required=True)
+    predict_parser.add_argument('-o', metavar='output-file',
             type=str, help='output file of the language prediction',
             dest='output_file', required=True)
+    predict_parser.add_argument('--jobs', type=int, dest='jobs', default=1,
+            help='number of processes predicting the test lines, '
+            'sharing the memory map of the model file')
+
+    report_parser = commands.add_parser('report',
+            help='accuracy and memory of exact and hashed language models')
+    report_parser.add_argument('-b', metavar='input-file-for-building-LM',
+            type=str, help='input file for building the language model',
+            dest='input_file_b', required=True)
+    report_parser.add_argument('-t', metavar='input-file-for-testing-LM',
+            type=str, help='input file for testing the language',
+            dest='input_file_t', required=True)
+    report_parser.add_argument('-c', metavar='correct-file',
+            type=str, help='file of the correct languages of the test file',
+            dest='correct_file', required=True)
+    report_parser.add_argument('--buckets', type=int, nargs='+',
+            dest='bucket_counts',
+            default=[2 ** n for n in range(8, 21, 2)],
+            help='numbers of buckets of the hashed language models')
+
     args = parser.parse_args()
+    if args.command is None and not (
+            args.input_file_b and args.input_file_t and args.output_file):
+        parser.error('-b, -t and -o are required without a subcommand')
     return args
 
 if __name__ == '__main__':
     args = getCommandArgs()
-    main(args.input_file_b, args.input_file_t, args.output_file)
+    if args.command == 'train':
+        train(args.input_file_b, args.model_file, args.buckets)
+    elif args.command == 'report':
+        report(args.input_file_b, args.input_file_t, args.correct_file,
+                args.bucket_counts)
+    elif args.command == 'predict':
+        predict(args.model_file, args.input_file_t, args.output_file,
+                args.jobs)
+    else:
+        main(args.input_file_b, args.input_file_t, args.output_file,
+                args.jobs)
@@ -0,0 +1,99 @@
+"""Compact language model file, read through a memory map.
+
+The train command of build_test_LM.py writes the compiled language
+models into a model file, which the predict command loads instead of
+training them again:
+
+    <MAGIC> <version: 4 bytes> <sections> <directory: pickle>
+    <directory offset: 8 bytes>
+
+The directory maps the name of each section to its (offset, length):
+
+    header             pickled (languages, tokenizer parameters,
+                       buckets, number of tokens, token dtype)
+    tokens             the tokens seen in training, sorted, as UTF-8
+                       strings of fixed width padded with null bytes;
+                       of hashed language models, the buckets of the
+                       seen tokens, sorted, as little-endian uint32
+    log_probabilities  the languages x tokens matrix of the smoothed
+                       log probabilities, as little-endian float64
+
+The sections start at multiples of 8 bytes. The token table and the
+matrix are used in place on the memory map, so a model is loaded by
+reading its directory and header only.
+"""
+
+import mmap
+import pickle
+import struct
+
+import numpy as np
+
+MAGIC = b'IRLANGMD'
+VERSION = 2
+_VERSION = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+_ALIGNMENT = 8
+
+
+def is_model_file(model_file):
+    with open(model_file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_model(model_file, languages, tokenizer, tokens, log_probabilities,
+        buckets=None):
+    """Write a model file
+    @tokenizer parameters of the tokenizer, any picklable object
+    @tokens sorted NumPy array of the tokens as byte strings,
+    or of the buckets of hashed language models
+    @log_probabilities languages x tokens matrix
+    @buckets number of buckets of hashed language models"""
+    if buckets:
+        tokens = tokens.astype('<u4')
+    directory = {}
+    with open(model_file, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_VERSION.pack(VERSION))
+
+        def section(name, data):
+            f.write(b'\0' * (-f.tell() % _ALIGNMENT))
+            directory[name] = (f.tell(), len(data))
+            f.write(data)
+
+        section('header', pickle.dumps((languages, tokenizer, buckets,
+            len(tokens), tokens.dtype.str)))
+        section('tokens', tokens.tobytes())
+        section('log_probabilities',
+                np.ascontiguousarray(log_probabilities, '<f8').tobytes())
+
+        directory_offset = f.tell()
+        f.write(pickle.dumps(directory))
+        f.write(_OFFSET.pack(directory_offset))
+
+
+def read_model(model_file):
+    """(languages, tokenizer parameters, tokens, log probabilities,
+    buckets) of a model file, the arrays are read-only views of its
+    memory map"""
+    with open(model_file, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('{} is not a language model file'.format(model_file))
+    version, = _VERSION.unpack_from(data, len(MAGIC))
+    if version != VERSION:
+        raise ValueError('{} is a version {} language model file, '
+                'version {} is supported'.format(model_file, version, VERSION))
+    directory_offset, = _OFFSET.unpack(data[-_OFFSET.size:])
+    directory = pickle.loads(data[directory_offset:-_OFFSET.size])
+
+    offset, length = directory['header']
+    languages, tokenizer, buckets, count, dtype = pickle.loads(
+            data[offset:offset + length])
+    offset, _ = directory['tokens']
+    tokens = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+    offset, _ = directory['log_probabilities']
+    log_probabilities = np.frombuffer(data, dtype='<f8',
+            count=len(languages) * count, offset=offset).reshape(
+                    len(languages), count)
+    return languages, tokenizer, tokens, log_probabilities, buckets
@@ -0,0 +1,45 @@
+"""Text analysis shared by the indexers and the searchers.
+
+Text is tokenized with nltk, and each token is Porter stemmed and
+lowercased. The stems are memoized in a bounded LRU cache, as the same
+high frequency surface forms are stemmed over and over.
+"""
+
+import functools
+
+import nltk
+
+
+class Analyzer(object):
+    def __init__(self, cache_size=65536):
+        self.porter = nltk.PorterStemmer()
+        self.stem = functools.lru_cache(maxsize=cache_size)(self._stem)
+
+    def _stem(self, token):
+        return self.porter.stem(token).lower()
+
+    def terms(self, text):
+        """Stream the terms of a text"""
+        for token in nltk.word_tokenize(text):
+            yield self.stem(token)
+
+    def sentences(self, text):
+        """Stream the terms of a text, sentence by sentence"""
+        for sentence in nltk.sent_tokenize(text):
+            yield list(self.terms(sentence))
+
+    def analyze_batch(self, texts):
+        """Stream the list of terms of each text"""
+        for text in texts:
+            yield list(self.terms(text))
+
+    def stats(self):
+        """Stem cache counters, for reporting"""
+        info = self.stem.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'cached_stems': info.currsize,
+            'hit_rate': info.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,86 @@
+"""Batch execution of a queries file over forked worker processes.
+
+The index is loaded once, before the workers are forked, so that they
+share it copy-on-write, and the postings file through its memory map.
+The same goes for the language models of 1/build_test_LM.py, whose
+sentences are the queries.
+
+The queries are read lazily and sent to the workers in chunks. At most
+`in_flight` chunks are queued or being searched at a time, so memory
+does not grow with the number of queries. The results of the chunks
+are written as soon as every previous chunk is written, in the order
+of the queries.
+"""
+
+import collections
+import itertools
+import multiprocessing
+import time
+
+# Search function of the worker processes, inherited through fork
+_search_batch = None
+
+
+def _search_chunk(chunk):
+    return _search_batch(chunk)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run(search_batch, queries, write, jobs=1, chunk_size=256,
+        in_flight=None):
+    """Search the queries and write their output lines in order,
+    return the number of queries
+    @search_batch function from a list of queries to their output lines,
+    called in the forked workers with the index of this process
+    @queries iterable of queries, read as the chunks are sent
+    @write called with each output line, in the order of the queries
+    @jobs number of worker processes, the queries are searched in this
+    process when 1
+    @in_flight maximum number of chunks sent and not written yet,
+    2 per worker by default"""
+    global _search_batch
+    count = 0
+    if jobs <= 1:
+        for chunk in chunks(queries, chunk_size):
+            for line in search_batch(chunk):
+                write(line)
+            count += len(chunk)
+        return count
+
+    in_flight = in_flight or 2 * jobs
+    _search_batch = search_batch
+    pending = collections.deque()
+    try:
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            for chunk in chunks(queries, chunk_size):
+                if len(pending) >= in_flight:
+                    for line in pending.popleft().get():
+                        write(line)
+                pending.append(pool.apply_async(_search_chunk, (chunk,)))
+                count += len(chunk)
+            while pending:
+                for line in pending.popleft().get():
+                    write(line)
+    finally:
+        _search_batch = None
+    return count
+
+
+class Throughput(object):
+    """Timer of a batch, for the queries/sec report"""
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    def report(self, count, jobs, unit='queries'):
+        seconds = time.perf_counter() - self.start
+        return "{} {unit} in {:.2f}s, {:.1f} {unit}/s with {} jobs".format(
+                count, seconds, count / seconds if seconds else 0.0,
+                max(jobs, 1), unit=unit)
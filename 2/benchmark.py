@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+import argparse
+import timeit
+
+import nltk
+
+import search
+
+
+def run_queries(queries, dict_file, postings_file, build):
+    """Evaluate every query with the postings built by `build`"""
+    _, dictionary, universal_doc, doc_set = search.load_index(
+            dict_file, postings_file, build, 64 * 1024 * 1024)
+    for query_tokens in queries:
+        search.search(query_tokens, universal_doc, doc_set, dictionary)
+    doc_set.close()
+
+
+def main(dict_file, postings_file, queries_file, repeat):
+    with open(queries_file) as f:
+        queries = [search.shunting(nltk.word_tokenize(query))
+                for query in f if query.strip()]
+
+    print("{} queries, best of {} runs".format(len(queries), repeat))
+    for name, build in sorted(search.CONTAINERS.items()):
+        timer = timeit.Timer(lambda: run_queries(
+            queries, dict_file, postings_file, build))
+        best = min(timer.repeat(repeat=repeat, number=1))
+        print("{:>10}: {:.4f}s".format(name, best))
+
+
+def _getCommandArgs():
+    parser = argparse.ArgumentParser(
+            description='Benchmark of the postings containers')
+    parser.add_argument('-d', dest='dict_file', required=True,
+            help='directory file')
+    parser.add_argument('-p', dest='postings_file', required=True,
+            help='postings file')
+    parser.add_argument('-q', dest='queries_file', required=True,
+            help='queries file')
+    parser.add_argument('-r', dest='repeat', type=int, default=5,
+            help='number of runs per container')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _getCommandArgs()
+    main(args.dict_file, args.postings_file, args.queries_file, args.repeat)
@@ -0,0 +1,168 @@
+import sys
+
+# Positions of the bits set, for every byte value
+_BYTE_BITS = [tuple(i for i in range(8) if byte >> i & 1) for byte in range(256)]
+
+
+def _mask(doc_ids):
+    """Bits of the doc ordinals, built in a buffer rather than
+    with a big integer operation per ordinal"""
+    buffer = bytearray()
+    for doc_id in doc_ids:
+        i = doc_id >> 3
+        if i >= len(buffer):
+            buffer.extend(bytes(i + 1 - len(buffer)))
+        buffer[i] |= 1 << (doc_id & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def _like(other, items):
+    """Build a container of the same type as `other` from sorted items"""
+    build = getattr(type(other), 'from_sorted', type(other))
+    return build(items)
+
+
+class Bitmap(object):
+    """Set of doc ordinals as the bits of a python int.
+
+    Operations between two bitmaps are single big integer operations.
+    Against any other set of ordinals (SkipList, set, ...) the bitmap
+    only tests or sets the bits of the other operand's elements, and
+    AND / difference keep the type of the other operand.
+    """
+    def __init__(self, bits=0):
+        self.bits = bits
+
+    @classmethod
+    def from_sorted(cls, doc_ids):
+        return cls(_mask(doc_ids))
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(int.from_bytes(data, 'little'))
+
+    @classmethod
+    def full(cls, doc_count):
+        """Bitmap of every doc ordinal below doc_count"""
+        return cls((1 << doc_count) - 1)
+
+    def to_bytes(self, doc_count=0):
+        length = max(doc_count, self.bits.bit_length())
+        return self.bits.to_bytes((length + 7) // 8, 'little')
+
+    def _tester(self):
+        """Membership test of a doc ordinal, over the bytes of the bitmap"""
+        data = self.to_bytes()
+        size = len(data)
+        return lambda doc_id: (doc_id >> 3) < size and bool(
+                data[doc_id >> 3] >> (doc_id & 7) & 1)
+
+    def __contains__(self, doc_id):
+        return doc_id >= 0 and bool(self.bits >> doc_id & 1)
+
+    def __iter__(self):
+        for i, byte in enumerate(self.to_bytes()):
+            if byte:
+                base = i * 8
+                for bit in _BYTE_BITS[byte]:
+                    yield base + bit
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __eq__(self, other):
+        if isinstance(other, Bitmap):
+            return self.bits == other.bits
+        return NotImplemented
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.bits)
+
+    def __repr__(self):
+        return 'Bitmap({})'.format(list(self))
+
+    def __and__(self, other):
+        if isinstance(other, Bitmap):
+            return Bitmap(self.bits & other.bits)
+        contains = self._tester()
+        return _like(other, [doc_id for doc_id in other if contains(doc_id)])
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        if isinstance(other, Bitmap):
+            return Bitmap(self.bits | other.bits)
+        return Bitmap(self.bits | _mask(other))
+
+    __ror__ = __or__
+
+    def __sub__(self, other):
+        if isinstance(other, Bitmap):
+            return Bitmap(self.bits & ~other.bits)
+        return Bitmap(self.bits & ~_mask(other))
+
+    def __rsub__(self, other):
+        contains = self._tester()
+        return _like(other,
+                [doc_id for doc_id in other if not contains(doc_id)])
+
+
+
+import unittest
+class TestBitmap(unittest.TestCase):
+    def setUp(self):
+        # Around the byte boundaries
+        self.doc_ids = [0, 1, 7, 8, 15, 16, 63, 64, 1000]
+        self.bitmap = Bitmap.from_sorted(self.doc_ids)
+
+    def test_round_trip(self):
+        self.assertEqual(list(self.bitmap), self.doc_ids)
+        self.assertEqual(len(self.bitmap), len(self.doc_ids))
+        data = self.bitmap.to_bytes()
+        self.assertEqual(len(data), 1000 // 8 + 1)
+        self.assertEqual(Bitmap.from_bytes(data), self.bitmap)
+
+    def test_padding(self):
+        # Bytes for every ordinal below doc_count, trailing zeros included
+        data = Bitmap.from_sorted([3]).to_bytes(doc_count=17)
+        self.assertEqual(data, b'\x08\x00\x00')
+        self.assertEqual(list(Bitmap.from_bytes(data)), [3])
+
+    def test_empty(self):
+        empty = Bitmap.from_sorted([])
+        self.assertFalse(empty)
+        self.assertEqual(list(empty), [])
+        self.assertEqual(empty.to_bytes(), b'')
+        self.assertEqual(Bitmap.from_bytes(b''), empty)
+        self.assertEqual(Bitmap.full(0), empty)
+
+    def test_full(self):
+        for doc_count in (1, 8, 9, 64):
+            self.assertEqual(list(Bitmap.full(doc_count)),
+                    list(range(doc_count)))
+
+    def test_contains(self):
+        for doc_id in range(-1, 1002):
+            self.assertEqual(doc_id in self.bitmap, doc_id in self.doc_ids)
+
+    def test_operations(self):
+        other = [1, 2, 8, 64, 65, 2000]
+        self.assertEqual(list(self.bitmap & Bitmap.from_sorted(other)),
+                [1, 8, 64])
+        self.assertEqual(list(self.bitmap | Bitmap.from_sorted(other)),
+                sorted(set(self.doc_ids) | set(other)))
+        self.assertEqual(list(self.bitmap - Bitmap.from_sorted(other)),
+                [0, 7, 15, 16, 63, 1000])
+        # AND and difference keep the type of a sorted list operand
+        self.assertEqual(self.bitmap & other, [1, 8, 64])
+        self.assertEqual(other - self.bitmap, [2, 65, 2000])
+        self.assertEqual(list(self.bitmap | other),
+                sorted(set(self.doc_ids) | set(other)))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import socket
+import sys
+import time
+
+from queryserver import add_server_arguments
+
+
+class QueryClient(object):
+    """Client of the query servers"""
+    def __init__(self, host='127.0.0.1', port=8750, unix_socket=None):
+        if unix_socket:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(unix_socket)
+        else:
+            self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile('rw')
+
+    def request(self, **request):
+        self._file.write(json.dumps(request) + '\n')
+        self._file.flush()
+        response = json.loads(self._file.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+def main(queries_file, output_file, host, port, unix_socket, result_count):
+    client = QueryClient(host, port, unix_socket)
+    queries = open(queries_file) if queries_file else sys.stdin
+    output = open(output_file, 'w') if output_file else sys.stdout
+
+    latencies = []
+    start = time.perf_counter()
+    for query in queries:
+        request = {'query': query.rstrip('\n')}
+        if result_count is not None:
+            request['result_count'] = result_count
+        response = client.request(**request)
+        latencies.append(response['latency_ms'])
+        results = (str(result[0]) if isinstance(result, list) else result
+                for result in response['results'])
+        output.write(' '.join(results) + '\n')
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    if latencies:
+        latencies.sort()
+        print("{} queries in {:.3f}s, server latency: mean {:.3f}ms, "
+                "median {:.3f}ms, max {:.3f}ms".format(
+                    len(latencies), elapsed,
+                    sum(latencies) / len(latencies),
+                    latencies[len(latencies) // 2], latencies[-1]),
+                file=sys.stderr)
+
+
+def _getCommandArgs():
+    parser = argparse.ArgumentParser(description='Search server client')
+    parser.add_argument('-q', dest='queries_file',
+            help='queries file, standard input by default')
+    parser.add_argument('-o', dest='output_file',
+            help='search result output file, standard output by default')
+    parser.add_argument('-k', dest='result_count', type=int,
+            help='number of results of the ranked queries')
+    add_server_arguments(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _getCommandArgs()
+    main(args.queries_file, args.output_file, args.host, args.port,
+            args.unix_socket, args.result_count)
@@ -2,53 +2,215 @@
 
 import argparse
 import os
-import nltk
 import collections
 import pickle
+import multiprocessing
 
+from analyzer import Analyzer
+from bitmap import Bitmap
+import segments
+import shards
+import termdict
+from postings import encode_postings, decode_postings, doc_order
+from postings import VBYTE, BITMAP
+from spimi import SpimiInverter
 
-def extract(document):
-    """Extraction of terms in the document"""
-    sentences = []
-    for sentence in nltk.sent_tokenize(document):
-        sentences.append(nltk.word_tokenize(sentence))
-    return sentences
 
-    
+analyzer = Analyzer()
+
+def extract(document):
+    """Extraction of terms in the document, sentence by sentence"""
+    return analyzer.sentences(document)
 
-def main(index_dir, dict_file, postings_file):
 
-    dictionary = {}
-    postings = collections.defaultdict(set)
-    doc_id_set = set()
+def invert(batch):
+    """Partial inverted lists of a batch of (doc_id, filepath),
+    the documents of the batch must be in doc ordinal order"""
+    postings = collections.defaultdict(list)
 
-    for filename in os.listdir(index_dir):
-        doc_id = filename
-        filepath = os.path.join(index_dir, filename)
+    for doc_id, filepath in batch:
         with open(filepath) as f:
             document = f.read()
 
-        sentences = extract(document)
-        porter = nltk.PorterStemmer()
-
-        for sentence in sentences:
-            tokens = [porter.stem(token) for token in sentence]
-            tokens = [token.lower() for token in tokens]
+        for tokens in extract(document):
             for token in tokens:
-                postings[token].add(doc_id)
-                doc_id_set.add(doc_id)
+                doc_list = postings[token]
+                if not doc_list or doc_list[-1] != doc_id:
+                    doc_list.append(doc_id)
+    return postings
+
+
+def parallel_map(function, iterable, workers, in_flight=None):
+    """Ordered map, over a process pool when there is more than 1 worker
+    @in_flight maximum number of items sent and not yielded yet, 2 per
+    worker by default: the pool does not read ahead of a slow consumer,
+    and holds at most that many results in memory"""
+    if workers <= 1:
+        yield from map(function, iterable)
+        return
+    in_flight = in_flight or 2 * workers
+    pending = collections.deque()
+    with multiprocessing.Pool(workers) as pool:
+        for item in iterable:
+            if len(pending) >= in_flight:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(function, (item,)))
+        while pending:
+            yield pending.popleft().get()
+
 
+def build(index_dir, filenames, dict_file, postings_file, workers=1,
+        batch_size=64, memory_budget=None, bitmap_threshold=1/16,
+        term_dictionary=False):
+    """Index the documents `filenames` of index_dir"""
+
+    postings = SpimiInverter(memory_budget, posting_size=40)
+
+    # Documents are numbered in sorted order, so that the postings
+    # lists are built already sorted by doc ordinal
+    doc_ids = sorted(filenames, key=doc_order)
+
+    documents = [(doc_id, os.path.join(index_dir, filename))
+            for doc_id, filename in enumerate(doc_ids)]
+    batches = [documents[i:i + batch_size]
+            for i in range(0, len(documents), batch_size)]
+
+    # Partial lists are merged in batch order, whatever the number of
+    # workers, which keeps the output identical
+    for partial in parallel_map(invert, batches, workers):
+        postings.add(partial)
+
+    if workers <= 1:
+        print("Stem cache: {hits} hits, {misses} misses".format(
+            **analyzer.stats()))
     print("Saving Index")
+    write_index(doc_ids, postings, dict_file, postings_file, bitmap_threshold,
+            term_dictionary)
+
+
+def write_index(doc_ids, postings, dict_file, postings_file, bitmap_threshold,
+        term_dictionary=False):
+    """Write the (term, doc_list) of postings, in term order,
+    @term_dictionary writes a term dictionary file (see termdict.py)
+    instead of a pickled dictionary"""
+    dictionary = {}
+
+    # Terms present in more than this many documents are stored as
+    # bitmaps of the whole collection
+    bitmap_df = bitmap_threshold * len(doc_ids)
 
     with open(postings_file, 'wb') as f:
-        for term, doc_set in postings.items():
+        for term, doc_list in postings:
+            if len(doc_list) > bitmap_df:
+                kind = BITMAP
+                data = Bitmap.from_sorted(doc_list).to_bytes(len(doc_ids))
+            else:
+                kind = VBYTE
+                data = encode_postings(doc_list)
             posting_offset = f.tell()
-            dictionary[term] = (len(doc_set), posting_offset)
-            pickle.dump(doc_set, f)
+            posting_length = f.write(data)
+            dictionary[term] = (
+                    len(doc_list), posting_offset, posting_length, kind)
 
 
+    if term_dictionary:
+        termdict.write_dictionary(dict_file, doc_ids, dictionary.items())
+        return
     with open(dict_file, 'wb') as f:
-        pickle.dump((doc_id_set, dictionary), f)
+        pickle.dump((doc_ids, dictionary), f)
+
+
+def update(index_dir, dict_file, postings_file, **options):
+    """Index the new and changed documents into a new segment"""
+    manifest = segments.load_manifest(dict_file)
+    docs = segments.plan_update(manifest, index_dir)
+    if docs:
+        segment_dict, segment_postings = segments.add_segment(
+                manifest, dict_file, postings_file, docs)
+        build(index_dir, docs, segment_dict, segment_postings, **options)
+    segments.save_manifest(manifest, dict_file)
+    print("{} documents indexed, {} segments".format(
+        len(docs), len(manifest['segments'])))
+
+
+def build_shards(index_dir, filenames, dict_file, postings_file, shard_count,
+        **options):
+    """Index the documents `filenames` of index_dir into `shard_count`
+    segments of contiguous documents, searched as shards"""
+    manifest = segments.new_manifest(sharded=True)
+    for docs in shards.partition(sorted(filenames, key=doc_order),
+            shard_count):
+        signatures = {doc: segments.signature(os.path.join(index_dir, doc))
+                for doc in docs}
+        segment_dict, segment_postings = segments.add_segment(
+                manifest, dict_file, postings_file, signatures)
+        build(index_dir, docs, segment_dict, segment_postings, **options)
+    segments.save_manifest(manifest, dict_file)
+    print("{} documents indexed into {} shards".format(
+        len(filenames), len(manifest['segments'])))
+
+
+def merge(dict_file, postings_file, bitmap_threshold=1/16,
+        term_dictionary=False):
+    """Merge the live documents of every segment into a single one"""
+    manifest = segments.load_manifest(dict_file)
+    old_segments = list(manifest['segments'])
+    if not old_segments:
+        print("No segment to merge")
+        return
+
+    indexes = []
+    for segment in old_segments:
+        doc_ids, dictionary = termdict.load(
+                segments.segment_path(dict_file, segment['dict_file']))
+        with open(segments.segment_path(
+                dict_file, segment['postings_file']), 'rb') as f:
+            data = f.read()
+        indexes.append((segment, doc_ids, dictionary, data))
+
+    docs = {}
+    for segment in old_segments:
+        for doc in segments.live_docs(segment):
+            docs[doc] = segment['docs'][doc]
+    doc_ids = sorted(docs, key=doc_order)
+    ordinals = {doc: doc_id for doc_id, doc in enumerate(doc_ids)}
+
+    def merged_postings():
+        terms = set()
+        for _, _, dictionary, _ in indexes:
+            terms.update(dictionary)
+        for term in sorted(terms):
+            doc_list = []
+            for segment, segment_doc_ids, dictionary, data in indexes:
+                if term not in dictionary:
+                    continue
+                _, offset, length, kind = dictionary[term]
+                encoded = data[offset:offset + length]
+                local_ids = (Bitmap.from_bytes(encoded) if kind == BITMAP
+                        else decode_postings(encoded))
+                for local_id in local_ids:
+                    doc = segment_doc_ids[local_id]
+                    if doc not in segment['deleted']:
+                        doc_list.append(ordinals[doc])
+            if doc_list:
+                yield term, sorted(doc_list)
+
+    segment_dict, segment_postings = segments.add_segment(
+            manifest, dict_file, postings_file, docs)
+    write_index(doc_ids, merged_postings(), segment_dict, segment_postings,
+            bitmap_threshold, term_dictionary)
+    manifest['segments'] = manifest['segments'][-1:]
+    segments.save_manifest(manifest, dict_file)
+    segments.remove_segments(dict_file, old_segments)
+    print("{} segments merged, {} documents".format(
+        len(old_segments), len(doc_ids)))
+
+
+def main(index_dir, dict_file, postings_file, workers=1, batch_size=64,
+        memory_budget=None, bitmap_threshold=1/16, term_dictionary=False):
+    build(index_dir, os.listdir(index_dir), dict_file, postings_file,
+            workers, batch_size, memory_budget, bitmap_threshold,
+            term_dictionary)
 
 
 
@@ -56,14 +218,52 @@ def main(index_dir, dict_file, postings_file):
 
 def _getCommandArgs():
     parser = argparse.ArgumentParser(description='Document indexer')
-    parser.add_argument('-i', dest='index_dir', required=True,
+    parser.add_argument('-i', dest='index_dir',
             help='directory of documents')
     parser.add_argument('-d', dest='dict_file', required=True,
             help='dictionary file')
     parser.add_argument('-p', dest='postings_file', required=True,
             help='postings file')
-    return parser.parse_args()
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+            help='number of indexing processes')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=float,
+            help='memory for the inverted lists in MB, '
+            'sorted runs are spilled to temporary files above it')
+    parser.add_argument('--bitmap-threshold', dest='bitmap_threshold',
+            type=float, default=1/16,
+            help='fraction of the documents above which the postings '
+            'of a term are stored as a bitmap')
+    parser.add_argument('--term-dictionary', dest='term_dictionary',
+            action='store_true',
+            help='write a front-coded term dictionary, read lazily by '
+            'the searcher, instead of a pickled dictionary')
+    parser.add_argument('--shards', dest='shards', type=int,
+            help='split the documents into this many shards, searched '
+            'in parallel, the dictionary file is then their manifest')
+    parser.add_argument('--incremental', action='store_true',
+            help='index the new and changed documents into a new segment, '
+            'the dictionary file is then the manifest of the segments')
+    parser.add_argument('--merge', action='store_true',
+            help='merge the segments of an incremental index')
+    args = parser.parse_args()
+    if not args.merge and args.index_dir is None:
+        parser.error('the directory of documents (-i) is required')
+    return args
 
 if __name__ == '__main__':
     args = _getCommandArgs()
-    main(args.index_dir, args.dict_file, args.postings_file)
+    memory_budget = (int(args.memory_budget * 1024 * 1024)
+            if args.memory_budget is not None else None)
+    options = dict(workers=args.workers, memory_budget=memory_budget,
+            bitmap_threshold=args.bitmap_threshold,
+            term_dictionary=args.term_dictionary)
+    if args.merge:
+        merge(args.dict_file, args.postings_file, args.bitmap_threshold,
+                args.term_dictionary)
+    elif args.incremental:
+        update(args.index_dir, args.dict_file, args.postings_file, **options)
+    elif args.shards:
+        build_shards(args.index_dir, os.listdir(args.index_dir),
+                args.dict_file, args.postings_file, args.shards, **options)
+    else:
+        main(args.index_dir, args.dict_file, args.postings_file, **options)
@@ -0,0 +1,262 @@
+"""Compressed postings format.
+
+Each postings list is a sorted list of integer document ordinals.
+On disk the list is stored as the gaps between consecutive ordinals,
+each gap written as a variable-byte integer: 7 bits of payload per byte,
+with the high bit set on the last byte of a number.
+
+Postings of the terms above a document frequency threshold are
+stored as bitmaps instead (see bitmap.py), the kind of each postings
+list is recorded in its dictionary entry.
+
+`PostingsReader` serves the lookups of a whole query batch from a
+single memory map of the postings file.
+"""
+
+import collections
+import mmap
+import sys
+import time
+
+# Kind of postings list, last field of the dictionary entry
+VBYTE = 'vbyte'
+BITMAP = 'bitmap'
+
+
+def encode_vbyte(number):
+    """Variable byte encoding of a single non negative integer"""
+    encoded = bytearray()
+    while True:
+        encoded.insert(0, number & 0x7f)
+        if number < 0x80:
+            break
+        number >>= 7
+    encoded[-1] |= 0x80
+    return encoded
+
+
+def decode_vbyte(data):
+    """Stream the integers encoded in `data` (bytes, bytearray, memoryview)"""
+    number = 0
+    for byte in data:
+        if byte & 0x80:
+            yield (number << 7) | (byte & 0x7f)
+            number = 0
+        else:
+            number = (number << 7) | byte
+
+
+def encode_postings(doc_ids):
+    """Gap + variable byte encoding of a sorted list of doc ordinals"""
+    encoded = bytearray()
+    previous = 0
+    for doc_id in doc_ids:
+        encoded += encode_vbyte(doc_id - previous)
+        previous = doc_id
+    return bytes(encoded)
+
+
+def decode_postings(data):
+    """Stream the doc ordinals of an encoded postings list"""
+    doc_id = 0
+    for gap in decode_vbyte(data):
+        doc_id += gap
+        yield doc_id
+
+
+def doc_order(filename):
+    """Sort key of the documents, numeric filenames are sorted by value"""
+    if filename.isdigit():
+        return (0, int(filename), filename)
+    return (1, 0, filename)
+
+
+class LRUCache(object):
+    """Least recently used cache, bounded by the memory of its values
+    as estimated by `sizeof`. With a `ttl` in seconds, the entries
+    older than it are expired on lookup."""
+    def __init__(self, max_bytes, sizeof=None, ttl=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or _sizeof
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, size, stored = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if self.ttl is not None and time.monotonic() - stored > self.ttl:
+            del self._entries[key]
+            self.bytes -= size
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size, time.monotonic())
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def invalidate(self):
+        """Drop every entry, the data they were computed from changed"""
+        self.clear()
+        self.invalidations += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Cache counters, for reporting"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+        }
+
+
+class PostingsReader(object):
+    """Postings reader shared by every term lookup of the process.
+
+    The postings file is memory mapped once, and the postings decoded
+    with `decode(data, dictionary_entry)` are kept in a LRU cache
+    bounded by `cache_size` bytes. `fields` are the positions of the
+    offset and length of the postings in the dictionary entries.
+    With `view`, decode receives memoryview slices of the mapped file
+    instead of copies, and the decoded postings may keep them.
+    The postings returned are shared with the cache, and must not be
+    modified by the caller.
+    """
+    def __init__(self, postings_file, dictionary,
+            decode=None, empty=list, cache_size=64 * 1024 * 1024,
+            fields=(1, 2), view=False):
+        self.dictionary = dictionary
+        self.fields = fields
+        self.decode = decode or (
+                lambda data, entry: list(decode_postings(data)))
+        self.empty = empty
+        self.cache = LRUCache(cache_size)
+        self.bytes_read = 0
+
+        self._file = open(postings_file, 'rb')
+        try:
+            self._data = mmap.mmap(
+                    self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty postings file cannot be mapped
+            self._data = b''
+        self._view = memoryview(self._data) if view else self._data
+
+    def __call__(self, term):
+        """Decoded postings of the term, `empty()` for unknown term"""
+        postings = self.cache.get(term)
+        if postings is not None:
+            return postings
+
+        try:
+            entry = self.dictionary[term]
+        except KeyError:
+            return self.empty()
+        offset, length = entry[self.fields[0]], entry[self.fields[1]]
+        postings = self.decode(self._view[offset:offset + length], entry)
+        self.bytes_read += length
+        self.cache.put(term, postings)
+        return postings
+
+    def stats(self):
+        """Cache counters and bytes of postings read, for reporting"""
+        return dict(self.cache.stats(), bytes_read=self.bytes_read)
+
+    def close(self):
+        self.cache.clear()
+        if isinstance(self._view, memoryview):
+            self._view.release()
+        if isinstance(self._data, mmap.mmap):
+            try:
+                self._data.close()
+            except BufferError:
+                # Postings still referenced keep the mapping until freed
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _sizeof(postings):
+    """Approximate memory used by a decoded postings list,
+    other containers account for their elements in `__sizeof__`"""
+    size = sys.getsizeof(postings)
+    if isinstance(postings, (list, set, frozenset, tuple)):
+        size += sum(map(sys.getsizeof, postings))
+    return size
+
+
+
+import unittest
+class TestVbyte(unittest.TestCase):
+    def test_byte_boundaries(self):
+        # 7 bits of payload per byte
+        for number, size in ((0, 1), (127, 1), (128, 2), (16383, 2),
+                (16384, 3), (2**21 - 1, 3), (2**21, 4)):
+            encoded = encode_vbyte(number)
+            self.assertEqual(len(encoded), size, number)
+            self.assertEqual(list(decode_vbyte(encoded)), [number])
+
+    def test_stop_bit(self):
+        # Only the last byte of a number has its high bit set
+        encoded = encode_vbyte(2**35 + 5)
+        self.assertEqual([byte >> 7 for byte in encoded],
+                [0] * (len(encoded) - 1) + [1])
+
+    def test_stream(self):
+        numbers = [0, 1, 127, 128, 300, 16384, 2**32 - 1, 2**40, 5]
+        encoded = b''.join(encode_vbyte(number) for number in numbers)
+        self.assertEqual(list(decode_vbyte(encoded)), numbers)
+        self.assertEqual(list(decode_vbyte(memoryview(encoded))), numbers)
+
+    def test_postings_round_trip(self):
+        for doc_ids in ([], [0], [0, 1, 2], [127, 128, 255, 256],
+                [5, 1000, 1000000, 2**32 - 1]):
+            encoded = encode_postings(doc_ids)
+            self.assertEqual(list(decode_postings(encoded)), doc_ids)
+        self.assertEqual(encode_postings([]), b'')
+        # Gaps, not ordinals, are encoded
+        self.assertEqual(len(encode_postings(range(1000000, 1000100))),
+                len(encode_vbyte(1000000)) + 99)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
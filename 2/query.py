@@ -0,0 +1,156 @@
+"""Boolean query optimizer.
+
+The reverse polish notation produced by `search.shunting` is turned into
+an expression tree, which is rewritten before being evaluated:
+
+- nested AND / OR chains are flattened into n-ary nodes
+- AND operands are evaluated from the smallest document frequency
+- `X AND NOT Y` becomes a difference X - Y, the complement of Y is
+  never built unless the query has no positive operand at all
+
+Across a batch of queries, the results of the subtrees can be cached
+under their canonical form, so that shared subexpressions are only
+evaluated once.
+
+Tree nodes are tuples:
+    (TERM, term)
+    (NOT, node)
+    (AND, [node, ...])
+    (OR, [node, ...])
+"""
+
+import functools
+
+TERM = 'TERM'
+AND_OP = 'AND'
+OR_OP = 'OR'
+NOT_OP = 'NOT'
+
+
+def build_tree(query_tokens, normalize=lambda term: term):
+    """Build the expression tree of a query in reverse polish notation,
+    @normalize is applied to every term of the query"""
+    operand_stack = []
+    for tok in query_tokens:
+        if tok == NOT_OP:
+            operand_stack.append((NOT_OP, operand_stack.pop()))
+        elif tok in (AND_OP, OR_OP):
+            o1 = operand_stack.pop()
+            o2 = operand_stack.pop()
+            operand_stack.append((tok, [o2, o1]))
+        else:
+            operand_stack.append((TERM, normalize(tok)))
+    return operand_stack[0]
+
+
+def optimize(node, dictionary, doc_count):
+    """Rewrite the tree for a cheaper evaluation"""
+    kind = node[0]
+    if kind == TERM:
+        return node
+
+    if kind == NOT_OP:
+        child = optimize(node[1], dictionary, doc_count)
+        # NOT NOT X is X
+        if child[0] == NOT_OP:
+            return child[1]
+        return (NOT_OP, child)
+
+    children = []
+    for child in node[1]:
+        child = optimize(child, dictionary, doc_count)
+        # (A AND B) AND C is AND(A, B, C), same for OR
+        if child[0] == kind:
+            children.extend(child[1])
+        else:
+            children.append(child)
+
+    size = lambda child: estimate(child, dictionary, doc_count)
+    children.sort(key=size)
+    return (kind, children)
+
+
+def estimate(node, dictionary, doc_count):
+    """Upper bound of the number of documents matched by the node"""
+    kind = node[0]
+    if kind == TERM:
+        return dictionary[node[1]][0] if node[1] in dictionary else 0
+    if kind == NOT_OP:
+        return doc_count - estimate(node[1], dictionary, doc_count)
+
+    sizes = [estimate(child, dictionary, doc_count) for child in node[1]]
+    if kind == AND_OP:
+        return min(sizes)
+    return min(sum(sizes), doc_count)
+
+
+def canonical(node):
+    """Hashable form of the node, which is the same whatever the order
+    of the operands of AND and OR"""
+    kind = node[0]
+    if kind == TERM:
+        return node
+    if kind == NOT_OP:
+        return (NOT_OP, canonical(node[1]))
+    return (kind, tuple(sorted(set(canonical(child) for child in node[1]))))
+
+
+def evaluate(node, postings, universal_doc, cache=None, trace=None):
+    """Evaluate the tree into a set of doc ordinals
+    @postings is the term -> postings retriever, the postings
+    only need to support the `&`, `|` and `-` set operators
+    @universal_doc is the postings of every doc ordinal
+    @cache optional `postings.LRUCache` of the subtree results
+    @trace optional trace(node, result) called for every evaluated
+    operator node
+    """
+    kind = node[0]
+    if kind == TERM:
+        return postings(node[1])
+    if cache is None:
+        result = _evaluate(node, postings, universal_doc, cache, trace)
+    else:
+        key = canonical(node)
+        result = cache.get(key)
+        if result is None:
+            result = _evaluate(node, postings, universal_doc, cache, trace)
+            cache.put(key, result)
+    if trace is not None:
+        trace(node, result)
+    return result
+
+
+def _evaluate(node, postings, universal_doc, cache, trace):
+    kind = node[0]
+    if kind == NOT_OP:
+        return universal_doc - evaluate(
+                node[1], postings, universal_doc, cache, trace)
+
+    if kind == OR_OP:
+        return functools.reduce(lambda p1, p2: p1 | p2,
+                (evaluate(child, postings, universal_doc, cache, trace)
+                    for child in node[1]))
+
+    # AND: intersect the positive operands from the smallest one,
+    # then remove the documents of the negated operands
+    positives = [child for child in node[1] if child[0] != NOT_OP]
+    negatives = [child[1] for child in node[1] if child[0] == NOT_OP]
+
+    if positives:
+        result = evaluate(
+                positives[0], postings, universal_doc, cache, trace)
+        for child in positives[1:]:
+            if not result:
+                return result
+            result = result & evaluate(
+                    child, postings, universal_doc, cache, trace)
+    else:
+        result = universal_doc
+
+    for child in negatives:
+        if not result:
+            break
+        result = result - evaluate(
+                child, postings, universal_doc, cache, trace)
+    return result
+
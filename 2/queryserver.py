@@ -0,0 +1,106 @@
+"""Query server keeping an index resident between queries.
+
+The protocol is one JSON object per line over a local TCP or unix
+socket:
+    request:  {"query": "<query>", ...engine specific fields}
+              {"stats": true}
+    response: {"results": [...], "latency_ms": <float>}
+              {"error": "<message>", "latency_ms": <float>}
+
+Connections are served concurrently by asyncio. The queries are
+evaluated in the event loop itself, as the caches of the engines are
+not thread safe.
+"""
+
+import asyncio
+import json
+import sys
+import time
+
+
+class QueryServer(object):
+    def __init__(self, handler, log=sys.stderr):
+        """
+        @handler callable of a request dict returning its results,
+        with a `stats()` method
+        """
+        self.handler = handler
+        self.log = log
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def respond(self, line):
+        """Response to a request line"""
+        start = time.perf_counter()
+        request = None
+        try:
+            request = json.loads(line)
+            if request.get('stats'):
+                response = {'results': self.stats()}
+            else:
+                response = {'results': self.handler(request)}
+        except Exception as e:
+            self.errors += 1
+            response = {'error': '{}: {}'.format(type(e).__name__, e)}
+        latency = (time.perf_counter() - start) * 1000
+        response['latency_ms'] = latency
+
+        self.requests += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if self.log is not None and isinstance(request, dict):
+            print(json.dumps({'query': request.get('query'),
+                'latency_ms': round(latency, 3)}), file=self.log)
+        return response
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = self.respond(line.decode())
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'mean_latency_ms': (self.total_latency / self.requests
+                if self.requests else 0.0),
+            'max_latency_ms': self.max_latency,
+            'engine': self.handler.stats(),
+        }
+
+    async def serve(self, host='127.0.0.1', port=8750, unix_socket=None):
+        if unix_socket:
+            server = await asyncio.start_unix_server(
+                    self.handle_connection, path=unix_socket)
+        else:
+            server = await asyncio.start_server(
+                    self.handle_connection, host, port)
+        for socket in server.sockets:
+            print("Serving on {}".format(socket.getsockname()), file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host='127.0.0.1', port=8750, unix_socket=None):
+        try:
+            asyncio.run(self.serve(host, port, unix_socket))
+        except KeyboardInterrupt:
+            pass
+
+
+def add_server_arguments(parser):
+    """Socket arguments, shared by the servers and the client"""
+    parser.add_argument('--host', dest='host', default='127.0.0.1',
+            help='host of the TCP socket')
+    parser.add_argument('--port', dest='port', type=int, default=8750,
+            help='port of the TCP socket')
+    parser.add_argument('--unix-socket', dest='unix_socket',
+            help='path of a unix socket, used instead of TCP')
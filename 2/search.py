@@ -1,10 +1,23 @@
 #!/usr/bin/python3
 
 import nltk
-import pickle
 import argparse
+import functools
+import heapq
 
-porter = nltk.PorterStemmer()
+import batch
+import query
+import segments
+import shards
+import termdict
+import tracing
+from analyzer import Analyzer
+from bitmap import Bitmap
+from postings import PostingsReader, LRUCache, decode_postings, doc_order
+from postings import BITMAP
+from skiplist import SkipList
+
+analyzer = Analyzer()
 
 # Constant Declaration
 LEFT_PAR = '('
@@ -28,22 +41,14 @@ is_parentheses = lambda token: token in PARENTHESES
 is_operand = lambda token: not (is_operator(token) or is_parentheses(token))
 is_lower_preceedence = lambda x, y: PRECEEDENCE[x] <= PRECEEDENCE[y]
 
+# Containers of the vbyte postings while evaluating a query,
+# built from the sorted doc ordinals. Bitmap postings stay bitmaps.
+CONTAINERS = {
+    'skiplist': SkipList.from_sorted,
+    'set': set,
+}
 
 
-def postings_retriever(postings_file, dictionary):
-    """Retriever helper function (wrapper)"""
-    def get_doc_set(term):
-        with open(postings_file, 'rb') as f:
-            try:
-                f.seek(dictionary[term][1])
-            except KeyError:
-                doc_set = set()
-            else:
-                doc_set = pickle.load(f)
-            
-        return doc_set
-    return get_doc_set
-
 
 def shunting(tokens):
     """Shunting algorithms will convert infix notation
@@ -68,56 +73,318 @@ def shunting(tokens):
 
     return output_queue
 
-def search(query_tokens, universal_doc, docset):
-    """Perform the search queries"""
-    result_doc_set = set()
-    operand_stack = []
-    query_tokens = query_tokens[::-1]
+def postings_decoder(build, base=0):
+    """Decoder of the dictionary entries for PostingsReader,
+    @build the container of the vbyte postings
+    @base added to the doc ordinals"""
+    def decode(data, entry):
+        if entry[3] == BITMAP:
+            return Bitmap(Bitmap.from_bytes(data).bits << base)
+        return build(doc_id + base for doc_id in decode_postings(data))
+    return decode
 
-    while (len(query_tokens) >= 1):
-        tok = query_tokens.pop()
-        if is_operand(tok):
-            operand_stack.append(docset(porter.stem(tok).lower()))
-        else:
-            if tok == NOT_OP:
-                operand_stack.append(universal_doc - operand_stack.pop())
-            elif tok == AND_OP:
-                o1 = operand_stack.pop()
-                o2 = operand_stack.pop()
-                operand_stack.append(o1 & o2)
-            elif tok == OR_OP:
-                o1 = operand_stack.pop()
-                o2 = operand_stack.pop()
-                operand_stack.append(o1 | o2)
-    return operand_stack[0]
-
-
-def main(dict_file, postings_file, queries_file, output_file):
+
+class SegmentedPostings(object):
+    """Postings retriever over every segment of an incremental index.
+
+    The segments share a single doc ordinal space, where the ordinals of
+    a segment follow the ones of the previous segment, so the postings
+    of a term are the union of the postings of each segment minus the
+    deleted documents.
+    """
+    def __init__(self, manifest, dict_file, build, cache_size):
+        self.doc_ids = []
+        self.dictionary = {}
+        self.readers = []
+        self.empty = lambda: build(())
+
+        deleted = []
+        for segment in manifest['segments']:
+            doc_ids, dictionary = termdict.load(
+                    segments.segment_path(dict_file, segment['dict_file']))
+            base = len(self.doc_ids)
+            self.doc_ids.extend(doc_ids)
+            deleted.extend(base + doc_id for doc_id, doc in enumerate(doc_ids)
+                    if doc in segment['deleted'])
+
+            for term, entry in dictionary.items():
+                df = self.dictionary.get(term, (0,))[0]
+                self.dictionary[term] = (df + entry[0],)
+
+            self.readers.append(PostingsReader(
+                segments.segment_path(dict_file, segment['postings_file']),
+                dictionary, decode=postings_decoder(build, base),
+                empty=self.empty,
+                cache_size=cache_size // max(len(manifest['segments']), 1)))
+
+        self.deleted = Bitmap.from_sorted(deleted)
+        self.universal_doc = Bitmap.full(len(self.doc_ids)) - self.deleted
+
+    def __call__(self, term):
+        postings = [reader(term) for reader in self.readers
+                if term in reader.dictionary]
+        if not postings:
+            return self.empty()
+        result = functools.reduce(lambda p1, p2: p1 | p2, postings)
+        if self.deleted:
+            result = result - self.deleted
+        return result
+
+    def stats(self):
+        stats = [reader.stats() for reader in self.readers]
+        return {key: sum(stat[key] for stat in stats)
+                for key in ('hits', 'misses', 'evictions', 'bytes_read')}
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+
+def load_index(dict_file, postings_file, build, cache_size, index=None):
+    """Load a single or incremental index,
+    return (doc_ids, dictionary, universal_doc, postings retriever)
+    @index contents of dict_file, when already loaded"""
+    if index is None:
+        index = termdict.load(dict_file)
+
+    if segments.is_manifest(index):
+        postings = SegmentedPostings(index, dict_file, build, cache_size)
+        return (postings.doc_ids, postings.dictionary,
+                postings.universal_doc, postings)
+
+    doc_ids, dictionary = index
+    postings = PostingsReader(postings_file, dictionary,
+            decode=postings_decoder(build),
+            empty=lambda: build(()), cache_size=cache_size)
+    return doc_ids, dictionary, Bitmap.full(len(doc_ids)), postings
+
+
+def load_segment(dict_file, segment, build, cache_size):
+    """Load a segment of a segmented index on its own,
+    return (doc_ids, dictionary, universal_doc, postings retriever)"""
+    if segment['deleted']:
+        postings = SegmentedPostings({'segments': [segment]}, dict_file,
+                build, cache_size)
+        return (postings.doc_ids, postings.dictionary,
+                postings.universal_doc, postings)
+    return load_index(segments.segment_path(dict_file, segment['dict_file']),
+            segments.segment_path(dict_file, segment['postings_file']),
+            build, cache_size)
+
+
+def search(query_tokens, universal_doc, docset, dictionary, cache=None):
+    """Perform the search queries,
+    @cache optional cache of the subexpression results"""
+    tree = query.build_tree(query_tokens, normalize=analyzer.stem)
+    tree = query.optimize(tree, dictionary, len(universal_doc))
+    return query.evaluate(tree, docset, universal_doc, cache)
+
+
+def search_traced(query_tokens, universal_doc, docset, dictionary, tracer,
+        cache=None):
+    """search() recording its phases and operators into tracer,
+    @docset wrapped in a `tracing.TracedPostings`"""
+    with tracer.phase('parse'):
+        tree = query.build_tree(query_tokens, normalize=analyzer.stem)
+    with tracer.phase('optimize'):
+        tree = query.optimize(tree, dictionary, len(universal_doc))
+    with tracer.phase('evaluate'):
+        return query.evaluate(tree, docset, universal_doc, cache,
+                tracer.operator)
+
+
+class ShardSearcher(object):
+    """Boolean search of a shard of a sharded index, in a worker process"""
+    def __init__(self, dict_file, segment, container='skiplist',
+            cache_size=64 * 1024 * 1024,
+            subexpression_cache_size=64 * 1024 * 1024):
+        (self.doc_ids, self.dictionary, self.universal_doc,
+            self.postings) = load_segment(dict_file, segment,
+                CONTAINERS[container], cache_size)
+        self.subexpressions = LRUCache(subexpression_cache_size)
+
+    def search_batch(self, queries):
+        """Filenames matching each query in reverse polish notation,
+        among the documents of the shard, in doc order"""
+        return [sorted((self.doc_ids[doc_id] for doc_id in search(
+            query_tokens, self.universal_doc, self.postings,
+            self.dictionary, self.subexpressions)), key=doc_order)
+            for query_tokens in queries]
+
+    def stats(self):
+        return {
+            'postings_cache': self.postings.stats(),
+            'subexpression_cache': self.subexpressions.stats(),
+        }
+
+    def close(self):
+        self.postings.close()
+
+
+class ShardedSearch(object):
+    """Coordinator of the shards of a sharded boolean index (see
+    shards.py). Each shard evaluates the queries on its own documents,
+    NOT included, so the result of a query is the union of the results
+    of the shards."""
+    def __init__(self, manifest, dict_file, container='skiplist',
+            cache_size=64 * 1024 * 1024,
+            subexpression_cache_size=64 * 1024 * 1024, processes=None):
+        """
+        @processes number of worker processes, one per shard by default,
+        0 searches the shards in this process
+        """
+        self.shards = shards.ShardPool(functools.partial(ShardSearcher,
+            dict_file, container=container, cache_size=cache_size,
+            subexpression_cache_size=subexpression_cache_size),
+            manifest['segments'], processes)
+
+    def search_batch(self, queries):
+        """Filenames matching each query in reverse polish notation,
+        in doc order"""
+        if not queries:
+            return []
+        replies = self.shards.scatter('search_batch', queries)
+        return [list(heapq.merge(*(shard_results[i]
+            for shard_results in replies), key=doc_order))
+            for i in range(len(queries))]
+
+    def stats(self):
+        """Cache counters summed over the shards"""
+        replies = self.shards.scatter('stats')
+        stats = {}
+        for cache in ('postings_cache', 'subexpression_cache'):
+            stats[cache] = {key: sum(reply[cache][key] for reply in replies)
+                    for key in ('hits', 'misses', 'evictions')}
+            lookups = stats[cache]['hits'] + stats[cache]['misses']
+            stats[cache]['hit_rate'] = (stats[cache]['hits'] / lookups
+                    if lookups else 0.0)
+        return stats
+
+    def close(self):
+        self.shards.close()
+
+
+def search_shards(index, dict_file, queries, write, container, cache_size,
+        subexpression_cache_size, processes=None, tracer=None):
+    """Search the queries on a sharded index, writing their output lines,
+    return the number of queries"""
+    sharded_search = ShardedSearch(index, dict_file, container, cache_size,
+            subexpression_cache_size, processes)
+    if tracer is None:
+        def search_batch(queries):
+            query_tokens = [shunting(nltk.word_tokenize(query_text))
+                    for query_text in queries]
+            return [' '.join(result)
+                    for result in sharded_search.search_batch(query_tokens)]
+    else:
+        def search_batch(queries):
+            results = []
+            for query_text in queries:
+                tracer.begin(query_text)
+                with tracer.phase('tokenize'):
+                    query_tokens = shunting(nltk.word_tokenize(query_text))
+                with tracer.phase('shards'):
+                    result = sharded_search.search_batch([query_tokens])[0]
+                results.append(' '.join(result))
+                tracer.end(candidates=len(result))
+            return results
+    count = batch.run(search_batch, queries, write)
+    stats = sharded_search.stats()
+    sharded_search.close()
+    print("Postings cache: {hits} hits, {misses} misses, "
+            "{evictions} evictions".format(**stats['postings_cache']))
+    print("Subexpression cache: {hits} reused, {misses} evaluated, "
+            "{evictions} evictions ({hit_rate:.1%} reuse)".format(
+                **stats['subexpression_cache']))
+    return count
+
+
+def format_result(result, doc_ids):
+    """Output line of the doc ordinals of a result"""
+    return ' '.join(sorted((doc_ids[doc_id] for doc_id in result),
+        key=doc_order))
+
+
+def main(dict_file, postings_file, queries_file, output_file,
+        cache_size=64, container='skiplist', subexpression_cache_size=64,
+        trace_file=None, shard_workers=None, jobs=1):
     # Load Dictionary
-    with open(dict_file, 'rb') as f:
-        doc_id_set, dictionary = pickle.loads(f.read())
+    index = termdict.load(dict_file)
 
-    doc_set = postings_retriever(postings_file, dictionary)
+    # Queries are read and results written as the batch goes
+    with open(queries_file) as queries, open(output_file, 'w') as f:
+        write = lambda line: f.write(line + '\n')
+        if segments.is_manifest(index) and segments.is_sharded(index):
+            if jobs > 1:
+                raise ValueError('--jobs does not apply to a sharded index, '
+                        'its shards are searched by --shard-workers')
+            tracer = tracing.open_tracer(trace_file)
+            throughput = batch.Throughput()
+            count = search_shards(index, dict_file, queries, write,
+                    container, cache_size * 1024 * 1024,
+                    subexpression_cache_size * 1024 * 1024, shard_workers,
+                    tracer)
+        else:
+            doc_ids, dictionary, universal_doc, doc_set = load_index(
+                    dict_file, postings_file, CONTAINERS[container],
+                    cache_size * 1024 * 1024, index)
+            tracer = tracing.open_tracer(trace_file, [doc_set])
+            if jobs > 1 and tracer is not None:
+                raise ValueError('--jobs cannot be combined with tracing')
+            throughput = batch.Throughput()
+            count = search_index(queries, write, doc_ids, dictionary,
+                    universal_doc, doc_set, subexpression_cache_size, tracer,
+                    jobs)
+    if tracer is not None:
+        print("Traced {queries} queries: {seconds:.4f}s, "
+                "p95 {latency_p95_ms:.2f} ms".format(**tracer.close()))
+    print(throughput.report(count, jobs))
 
-    # Read queries
-    with open(queries_file) as f:
-        queries = f.readlines()
 
+def search_index(queries, write, doc_ids, dictionary, universal_doc, doc_set,
+        subexpression_cache_size, tracer=None, jobs=1):
+    """Search the queries on a single or incremental index, writing their
+    output lines, return the number of queries
+    @jobs number of forked processes searching the queries"""
+    # Results of the subexpressions shared by the queries of the batch,
+    # of each process when forked
+    subexpressions = LRUCache(subexpression_cache_size * 1024 * 1024)
 
     # Perform Queries
-    results = []
-    for query in queries:
-        tokens = nltk.word_tokenize(query)
-        query_tokens = shunting(tokens)
-        result = search(query_tokens, doc_id_set, doc_set)
-        results.append(result)
-
-    # Store Result
-    with open(output_file, 'w') as f:
-        for result in results:
-            result = (int(i) for i in result)
-            x = ' '.join(str(doc_id) for doc_id in sorted(result))
-            f.write(x + '\n')
+    if tracer is None:
+        def search_batch(queries):
+            results = []
+            for query_text in queries:
+                tokens = nltk.word_tokenize(query_text)
+                query_tokens = shunting(tokens)
+                result = search(query_tokens, universal_doc, doc_set,
+                        dictionary, subexpressions)
+                results.append(format_result(result, doc_ids))
+            return results
+    else:
+        traced_doc_set = tracing.TracedPostings(doc_set, tracer)
+        def search_batch(queries):
+            results = []
+            for query_text in queries:
+                tracer.begin(query_text)
+                with tracer.phase('tokenize'):
+                    query_tokens = shunting(nltk.word_tokenize(query_text))
+                result = search_traced(query_tokens, universal_doc,
+                        traced_doc_set, dictionary, tracer, subexpressions)
+                with tracer.phase('sort'):
+                    results.append(format_result(result, doc_ids))
+                tracer.end(candidates=len(result))
+            return results
+    count = batch.run(search_batch, queries, write, jobs)
+    doc_set.close()
+    if jobs <= 1:
+        # The caches of forked workers are not reported back
+        print("Postings cache: {hits} hits, {misses} misses, "
+                "{evictions} evictions".format(**doc_set.stats()))
+        print("Subexpression cache: {hits} reused, {misses} evaluated, "
+                "{evictions} evictions ({hit_rate:.1%} reuse)".format(
+                    **subexpressions.stats()))
+    return count
         
 
 def _getCommandArgs():
@@ -130,9 +397,31 @@ def _getCommandArgs():
             help='queries file')
     parser.add_argument('-o', dest='output_file', required=True,
             help='search result output file')
+    parser.add_argument('--cache-size', dest='cache_size', type=int,
+            default=64, help='decoded postings cache size in MB')
+    parser.add_argument('--container', dest='container',
+            choices=sorted(CONTAINERS), default='skiplist',
+            help='postings data structure used to evaluate the queries')
+    parser.add_argument('--subexpression-cache-size',
+            dest='subexpression_cache_size', type=int, default=64,
+            help='cache size in MB of the subexpression results '
+            'shared across the queries')
+    parser.add_argument('--shard-workers', dest='shard_workers', type=int,
+            help='number of processes searching the shards of a sharded '
+            'index, one per shard by default, 0 searches them in this '
+            'process')
+    parser.add_argument('--trace', dest='trace_file', nargs='?', const='-',
+            help='write a JSON line of timings and counters per query to '
+            'this file, or to stderr, also enabled by the {} environment '
+            'variable'.format(tracing.ENVIRONMENT))
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+            help='number of processes searching the queries, forked once '
+            'the index is loaded')
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = _getCommandArgs()
     main(args.dict_file, args.postings_file,
-        args.queries_file, args.output_file)
+        args.queries_file, args.output_file, args.cache_size,
+        args.container, args.subexpression_cache_size, args.trace_file,
+        args.shard_workers, args.jobs)
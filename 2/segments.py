@@ -0,0 +1,231 @@
+"""Segment based indexes, for incremental updates.
+
+In incremental mode the dictionary file holds a manifest instead of a
+single index. The manifest lists immutable segments, each one a regular
+dictionary / postings file pair named after the manifest files with the
+segment number as suffix. Only new or changed documents are indexed,
+into a new segment. The previous copy of a changed (or removed)
+document is only marked as deleted in its segment. Merging rewrites
+the live documents of every segment into a single one.
+
+An index built with --shards is a manifest of segments as well, whose
+segments are searched in parallel as shards (see shards.py).
+
+Manifest:
+    {
+        'version': 1,
+        'next_segment': <n>,
+        'sharded': <whether the segments are searched as shards>,
+        'segments': [
+            {
+                'id': <n>,
+                'dict_file': <file name, relative to the manifest>,
+                'postings_file': <file name, relative to the manifest>,
+                'docs': {<filename>: <signature>},
+                'deleted': set(<filename>),
+            },
+        ],
+    }
+"""
+
+import os
+import pickle
+
+from postings import doc_order
+
+MANIFEST_VERSION = 1
+
+
+def is_manifest(obj):
+    return isinstance(obj, dict) and 'segments' in obj
+
+
+def is_sharded(manifest):
+    return manifest.get('sharded', False)
+
+
+def new_manifest(sharded=False):
+    return {'version': MANIFEST_VERSION, 'next_segment': 1, 'segments': [],
+            'sharded': sharded}
+
+
+def load_manifest(dict_file):
+    """Manifest stored in dict_file, empty one for a new index"""
+    if not os.path.exists(dict_file):
+        return new_manifest()
+    with open(dict_file, 'rb') as f:
+        manifest = pickle.load(f)
+    if not is_manifest(manifest):
+        raise ValueError('{} is not a segmented index'.format(dict_file))
+    return manifest
+
+
+def save_manifest(manifest, dict_file):
+    """Atomically replace the manifest, searchers see either version"""
+    tmp_file = dict_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(manifest, f)
+    os.replace(tmp_file, dict_file)
+
+
+def segment_path(dict_file, name):
+    """Path of a segment file, whose name is relative to the manifest"""
+    return os.path.join(os.path.dirname(dict_file), name)
+
+
+def signature(filepath):
+    """Size and modification time, to detect changed documents"""
+    stat = os.stat(filepath)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def live_docs(segment):
+    """Documents of the segment which are not deleted, in doc order"""
+    return sorted((doc for doc in segment['docs']
+            if doc not in segment['deleted']), key=doc_order)
+
+
+def plan_update(manifest, index_dir):
+    """Mark the removed and changed documents as deleted, and return
+    the signature of the documents which must be indexed"""
+    current = {filename: signature(os.path.join(index_dir, filename))
+            for filename in os.listdir(index_dir)}
+
+    indexed = {}
+    for segment in manifest['segments']:
+        for doc, doc_signature in segment['docs'].items():
+            if doc in segment['deleted']:
+                continue
+            if current.get(doc) == doc_signature:
+                indexed[doc] = doc_signature
+            else:
+                segment['deleted'].add(doc)
+
+    return {doc: doc_signature for doc, doc_signature in current.items()
+            if doc not in indexed}
+
+
+def add_segment(manifest, dict_file, postings_file, docs):
+    """Register a new segment of the documents signatures `docs`,
+    the segment files are returned as (dict path, postings path)"""
+    segment_id = manifest['next_segment']
+    manifest['next_segment'] += 1
+    segment = {
+        'id': segment_id,
+        'dict_file': '{}.{}'.format(os.path.basename(dict_file), segment_id),
+        'postings_file': '{}.{}'.format(
+            os.path.basename(postings_file), segment_id),
+        'docs': docs,
+        'deleted': set(),
+    }
+    manifest['segments'].append(segment)
+    return (segment_path(dict_file, segment['dict_file']),
+            segment_path(dict_file, segment['postings_file']))
+
+
+def remove_segments(dict_file, segments):
+    """Delete the files of segments no longer in the manifest"""
+    for segment in segments:
+        for name in (segment['dict_file'], segment['postings_file']):
+            try:
+                os.remove(segment_path(dict_file, name))
+            except FileNotFoundError:
+                pass
+
+
+
+import shutil
+import tempfile
+import time
+import unittest
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.doc_dir = os.path.join(self.tmp_dir, 'docs')
+        os.mkdir(self.doc_dir)
+        for doc in ('1', '2', '10'):
+            self.write_doc(doc, 'text of ' + doc)
+        self.dict_file = os.path.join(self.tmp_dir, 'dictionary.txt')
+        self.postings_file = os.path.join(self.tmp_dir, 'postings.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_doc(self, doc, text):
+        with open(os.path.join(self.doc_dir, doc), 'w') as f:
+            f.write(text)
+
+    def add(self, manifest):
+        """Register the documents to index into a new segment"""
+        docs = plan_update(manifest, self.doc_dir)
+        paths = add_segment(manifest, self.dict_file, self.postings_file,
+                docs)
+        for path in paths:
+            open(path, 'w').close()
+        return docs, paths
+
+    def test_new_index(self):
+        manifest = load_manifest(self.dict_file)
+        self.assertEqual(manifest, new_manifest())
+        self.assertFalse(is_sharded(manifest))
+        docs, paths = self.add(manifest)
+        self.assertEqual(sorted(docs), ['1', '10', '2'])
+        self.assertEqual(paths, (
+                os.path.join(self.tmp_dir, 'dictionary.txt.1'),
+                os.path.join(self.tmp_dir, 'postings.txt.1')))
+        self.assertEqual(manifest['next_segment'], 2)
+        self.assertEqual(live_docs(manifest['segments'][0]),
+                ['1', '2', '10'])
+
+    def test_save_load(self):
+        manifest = new_manifest(sharded=True)
+        self.add(manifest)
+        save_manifest(manifest, self.dict_file)
+        self.assertFalse(os.path.exists(self.dict_file + '.tmp'))
+        loaded = load_manifest(self.dict_file)
+        self.assertEqual(loaded, manifest)
+        self.assertTrue(is_manifest(loaded))
+        self.assertTrue(is_sharded(loaded))
+
+    def test_not_a_manifest(self):
+        with open(self.dict_file, 'wb') as f:
+            pickle.dump(({}, [], {}), f)
+        with self.assertRaises(ValueError):
+            load_manifest(self.dict_file)
+
+    def test_update(self):
+        manifest = new_manifest()
+        self.add(manifest)
+        # Nothing changed
+        self.assertEqual(plan_update(manifest, self.doc_dir), {})
+
+        time.sleep(0.01)
+        self.write_doc('2', 'changed text of 2')
+        self.write_doc('3', 'text of 3')
+        os.remove(os.path.join(self.doc_dir, '10'))
+        docs, _ = self.add(manifest)
+        self.assertEqual(sorted(docs), ['2', '3'])
+        first, second = manifest['segments']
+        self.assertEqual(first['deleted'], {'2', '10'})
+        self.assertEqual(live_docs(first), ['1'])
+        self.assertEqual(live_docs(second), ['2', '3'])
+        self.assertEqual([segment['id'] for segment in manifest['segments']],
+                [1, 2])
+
+        # Deleted documents are not marked again
+        self.assertEqual(plan_update(manifest, self.doc_dir), {})
+        self.assertEqual(first['deleted'], {'2', '10'})
+
+    def test_remove_segments(self):
+        manifest = new_manifest()
+        _, paths = self.add(manifest)
+        os.remove(paths[1])
+        # Files already gone are ignored
+        remove_segments(self.dict_file, manifest['segments'])
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+import argparse
+
+import nltk
+
+import search
+from postings import LRUCache, doc_order
+from queryserver import QueryServer, add_server_arguments
+
+
+class BooleanQueryHandler(object):
+    """Boolean queries against an index loaded once"""
+    def __init__(self, dict_file, postings_file, cache_size=64,
+            container='skiplist', subexpression_cache_size=64):
+        (self.doc_ids, self.dictionary,
+            self.universal_doc, self.postings) = search.load_index(
+                dict_file, postings_file, search.CONTAINERS[container],
+                cache_size * 1024 * 1024)
+        self.subexpressions = LRUCache(subexpression_cache_size * 1024 * 1024)
+
+    def __call__(self, request):
+        query_tokens = search.shunting(nltk.word_tokenize(request['query']))
+        result = search.search(query_tokens, self.universal_doc,
+                self.postings, self.dictionary, self.subexpressions)
+        return sorted((self.doc_ids[doc_id] for doc_id in result),
+                key=doc_order)
+
+    def stats(self):
+        return {
+            'postings_cache': self.postings.stats(),
+            'subexpression_cache': self.subexpressions.stats(),
+        }
+
+
+def main(dict_file, postings_file, host, port, unix_socket, **options):
+    handler = BooleanQueryHandler(dict_file, postings_file, **options)
+    QueryServer(handler).run(host, port, unix_socket)
+
+
+def _getCommandArgs():
+    parser = argparse.ArgumentParser(description='Boolean search server')
+    parser.add_argument('-d', dest='dict_file', required=True,
+            help='directory file')
+    parser.add_argument('-p', dest='postings_file', required=True,
+            help='postings file')
+    parser.add_argument('--cache-size', dest='cache_size', type=int,
+            default=64, help='decoded postings cache size in MB')
+    parser.add_argument('--container', dest='container',
+            choices=sorted(search.CONTAINERS), default='skiplist',
+            help='postings data structure used to evaluate the queries')
+    parser.add_argument('--subexpression-cache-size',
+            dest='subexpression_cache_size', type=int, default=64,
+            help='cache size in MB of the subexpression results '
+            'shared across the queries')
+    add_server_arguments(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _getCommandArgs()
+    main(args.dict_file, args.postings_file, args.host, args.port,
+            args.unix_socket, cache_size=args.cache_size,
+            container=args.container,
+            subexpression_cache_size=args.subexpression_cache_size)
@@ -0,0 +1,109 @@
+"""Scatter-gather over the shards of a sharded index.
+
+A sharded index is a segmented index (see segments.py) built with
+--shards: the documents are split into contiguous ranges in doc order,
+and each range is indexed into its own segment. Every segment is a
+shard, searched on its own. The segments added later by incremental
+updates are shards as well.
+
+The shards are served by local worker processes, each one loading its
+shards once and answering the requests of the coordinator over a pipe.
+A request is a method call on the handler of every shard. It is sent
+to every worker before any reply is awaited, so the shards are
+searched in parallel. With no worker process, the handlers run in the
+coordinator process.
+"""
+
+import multiprocessing
+
+
+def _serve(open_shard, shards, connection):
+    """Worker process loop, serving the requests for its shards"""
+    handlers = [open_shard(shard) for shard in shards]
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        method, args = request
+        try:
+            replies = [getattr(handler, method)(*args)
+                    for handler in handlers]
+        except Exception as exception:
+            connection.send((False, exception))
+        else:
+            connection.send((True, replies))
+    for handler in handlers:
+        handler.close()
+    connection.close()
+
+
+class ShardPool(object):
+    """Handlers of the shards of an index, over worker processes"""
+    def __init__(self, open_shard, shards, processes=None):
+        """
+        @open_shard function returning the handler of a shard, which
+        must be picklable, the handlers are opened in the workers
+        @shards the shards, e.g. the segments of the manifest
+        @processes number of worker processes, one per shard by default,
+        0 serves the shards in this process
+        """
+        self.shard_count = len(shards)
+        if processes is None:
+            processes = len(shards)
+        processes = min(processes, len(shards))
+        self.handlers = None
+        self.workers = []
+        if processes == 0:
+            self.handlers = [open_shard(shard) for shard in shards]
+            return
+
+        # Worker i serves the shards i, i + processes, ...
+        for i in range(processes):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, args=(
+                open_shard, shards[i::processes], worker_connection),
+                daemon=True)
+            process.start()
+            worker_connection.close()
+            self.workers.append((process, connection))
+
+    def scatter(self, method, *args):
+        """Replies of handler.method(*args) of every shard, in order"""
+        if self.handlers is not None:
+            return [getattr(handler, method)(*args)
+                    for handler in self.handlers]
+
+        for _, connection in self.workers:
+            connection.send((method, args))
+        replies = [None] * self.shard_count
+        error = None
+        for i, (_, connection) in enumerate(self.workers):
+            ok, worker_replies = connection.recv()
+            if not ok:
+                error = worker_replies
+                continue
+            replies[i::len(self.workers)] = worker_replies
+        if error is not None:
+            raise error
+        return replies
+
+    def close(self):
+        if self.handlers is not None:
+            for handler in self.handlers:
+                handler.close()
+            self.handlers = []
+            return
+        for process, connection in self.workers:
+            connection.send(None)
+            connection.close()
+        for process, _ in self.workers:
+            process.join()
+        self.workers = []
+
+
+def partition(doc_ids, count):
+    """Split the documents, in doc order, into `count` contiguous ranges
+    of about the same size, without empty ones"""
+    count = max(min(count, len(doc_ids)), 1)
+    bounds = [len(doc_ids) * i // count for i in range(count + 1)]
+    return [doc_ids[start:end] for start, end in zip(bounds, bounds[1:])]
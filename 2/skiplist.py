@@ -0,0 +1 @@
+../3/skiplist.py
\ No newline at end of file
@@ -0,0 +1,88 @@
+"""Single-pass in-memory inversion with a memory budget.
+
+Partial inverted lists are accumulated in memory until their estimated
+size goes over the budget, they are then written to a temporary file as
+a run sorted by term. The runs are finally merged with a k-way merge
+into a single stream of (term, postings) in term order.
+
+Partial lists must be added in document order, so that concatenating
+the lists of a term from the successive runs keeps them sorted.
+"""
+
+import collections
+import heapq
+import itertools
+import operator
+import pickle
+import tempfile
+
+# Rough memory cost of a term entry (key, list and dictionary slot)
+TERM_OVERHEAD = 150
+
+
+class SpimiInverter(object):
+    def __init__(self, memory_budget=None, posting_size=40):
+        """
+        @memory_budget in bytes, None to never spill to disk
+        @posting_size estimated memory cost of a single posting
+        """
+        self.memory_budget = memory_budget
+        self.posting_size = posting_size
+        self.postings = collections.defaultdict(list)
+        self.size = 0
+        self.runs = []
+
+    def add(self, partial):
+        """Add the partial inverted lists of the next documents"""
+        for term, doc_list in partial.items():
+            if term not in self.postings:
+                self.size += TERM_OVERHEAD + len(term)
+            self.postings[term].extend(doc_list)
+            self.size += len(doc_list) * self.posting_size
+
+        if self.memory_budget is not None and self.size > self.memory_budget:
+            self.flush()
+
+    def flush(self):
+        """Write the lists in memory as a sorted run"""
+        if not self.postings:
+            return
+        run = tempfile.TemporaryFile()
+        for term in sorted(self.postings):
+            pickle.dump((term, self.postings[term]), run,
+                    pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.postings.clear()
+        self.size = 0
+
+    def __iter__(self):
+        """Merged (term, postings) in term order"""
+        if not self.runs:
+            for term in sorted(self.postings):
+                yield term, self.postings[term]
+            return
+
+        self.flush()
+        try:
+            # heapq.merge keeps the run order for a same term
+            merged = heapq.merge(*map(_read_run, self.runs),
+                    key=operator.itemgetter(0))
+            for term, entries in itertools.groupby(
+                    merged, key=operator.itemgetter(0)):
+                doc_list = []
+                for _, partial_list in entries:
+                    doc_list.extend(partial_list)
+                yield term, doc_list
+        finally:
+            for run in self.runs:
+                run.close()
+            self.runs = []
+
+
+def _read_run(run):
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
@@ -0,0 +1,361 @@
+"""On-disk term dictionary, read lazily through a memory map.
+
+A term dictionary file replaces the pickled dictionary file of an
+index, so that a searcher starts without loading the whole vocabulary
+and document table:
+
+    <MAGIC> <sections> <directory: pickle> <directory offset: 8 bytes>
+
+The directory maps the name of each section to its (offset, length,
+array typecode):
+
+    blocks       the sorted terms and their dictionary entries, in blocks
+                 of `block_size` terms. A block is the vbyte term count,
+                 then for each term the vbyte lengths of the prefix shared
+                 with the previous term and of the rest, and the rest, in
+                 UTF-8; then the pickled list of the entries of the block.
+    block_index  pickled (first term of each block, block offsets,
+                 number of terms), the only part loaded up front
+    doc_ids      the document table (ordinal -> filename): the number of
+                 documents and the end offset of each filename as an
+                 array('I'), then the filenames
+    <array>      the arrays of the index (e.g. doc lengths), as raw
+                 array bytes
+
+An array may also be a column of the dictionary, with a value per term
+in term order (e.g. max impacts), stored packed instead of in every
+entry: the value of a term is appended to its entry when it is looked
+up. A pickled dictionary file of an index with columns holds the tuple
+(doc_ids, *arrays, *columns, dictionary).
+
+A term lookup is a binary search in the block index and the decoding of
+a single block, and the terms with a prefix are read from consecutive
+blocks. Arrays are in native byte order.
+"""
+
+import array
+import bisect
+import collections.abc
+import mmap
+import pickle
+import struct
+
+from postings import LRUCache, encode_vbyte
+
+MAGIC = b'IRTERMS1'
+_OFFSET = struct.Struct('<Q')
+
+
+def is_term_dictionary(dict_file):
+    with open(dict_file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load(dict_file, arrays=(), columns=()):
+    """Contents of a dictionary file: the unpickled object of a pickled
+    file, the tuple (doc_ids, *arrays, terms) of a term dictionary file
+    @columns names of the columns of the dictionary, whose values are
+    appended to the entries in this order; the columns of a pickled
+    index are removed from its tuple"""
+    if not is_term_dictionary(dict_file):
+        with open(dict_file, 'rb') as f:
+            index = pickle.loads(f.read())
+        if not columns or isinstance(index, dict):
+            return index
+        # (doc_ids, *arrays, *columns, dictionary)
+        dictionary = index[-1]
+        values = zip(*index[-1 - len(columns):-1])
+        return index[:-1 - len(columns)] + ({term: entry + tuple(value)
+                for (term, entry), value in zip(dictionary.items(), values)},)
+    dictionary_file = DictionaryFile(dict_file, columns=columns)
+    return ((dictionary_file.doc_ids,)
+            + tuple(dictionary_file.array(name) for name in arrays)
+            + (dictionary_file.terms,))
+
+
+def _common_prefix(a, b):
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+def _encode_block(block):
+    encoded = bytearray(encode_vbyte(len(block)))
+    previous = b''
+    for term, _ in block:
+        term = term.encode()
+        shared = _common_prefix(previous, term)
+        encoded += encode_vbyte(shared)
+        encoded += encode_vbyte(len(term) - shared)
+        encoded += term[shared:]
+        previous = term
+    encoded += pickle.dumps([entry for _, entry in block])
+    return bytes(encoded)
+
+
+def _read_vbyte(data, position):
+    """(number, position after it) of the vbyte number at position"""
+    number = 0
+    while True:
+        byte = data[position]
+        position += 1
+        number = (number << 7) | (byte & 0x7f)
+        if byte & 0x80:
+            return number, position
+
+
+def _decode_block(data):
+    """(terms, entries) of an encoded block"""
+    count, position = _read_vbyte(data, 0)
+    terms = []
+    previous = b''
+    for _ in range(count):
+        shared, position = _read_vbyte(data, position)
+        length, position = _read_vbyte(data, position)
+        term = previous[:shared] + bytes(data[position:position + length])
+        position += length
+        terms.append(term.decode())
+        previous = term
+    return terms, pickle.loads(data[position:])
+
+
+def write_dictionary(dict_file, doc_ids, entries, arrays=None, block_size=16):
+    """Write a term dictionary file
+    @entries (term, dictionary entry) in term order
+    @arrays optional {name: array.array} of the index, and of the
+    columns of the dictionary"""
+    directory = {}
+    with open(dict_file, 'wb') as f:
+        f.write(MAGIC)
+
+        def section(name, data, typecode='B'):
+            directory[name] = (f.tell(), len(data), typecode)
+            f.write(data)
+
+        first_terms = []
+        offsets = []
+        count = 0
+        blocks_offset = f.tell()
+        block = []
+        for term, entry in entries:
+            block.append((term, entry))
+            if len(block) == block_size:
+                first_terms.append(block[0][0])
+                offsets.append(f.tell() - blocks_offset)
+                f.write(_encode_block(block))
+                count += len(block)
+                block = []
+        if block:
+            first_terms.append(block[0][0])
+            offsets.append(f.tell() - blocks_offset)
+            f.write(_encode_block(block))
+            count += len(block)
+        offsets.append(f.tell() - blocks_offset)
+        directory['blocks'] = (blocks_offset, f.tell() - blocks_offset, 'B')
+        section('block_index', pickle.dumps((first_terms, offsets, count)))
+
+        names = [doc_id.encode() for doc_id in doc_ids]
+        ends = array.array('I', [len(names)])
+        end = 0
+        for name in names:
+            end += len(name)
+            ends.append(end)
+        section('doc_ids', ends.tobytes() + b''.join(names))
+
+        for name, values in sorted((arrays or {}).items()):
+            section(name, values.tobytes(), values.typecode)
+
+        directory_offset = f.tell()
+        f.write(pickle.dumps(directory))
+        f.write(_OFFSET.pack(directory_offset))
+
+
+class DictionaryFile(object):
+    """Sections of a term dictionary file, on its memory map"""
+    def __init__(self, dict_file, block_cache_size=1024 * 1024,
+            columns=()):
+        """
+        @columns names of the sections appended to the term entries
+        """
+        with open(dict_file, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._data)
+        if view[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a term dictionary'.format(dict_file))
+        directory_offset, = _OFFSET.unpack(view[-_OFFSET.size:])
+        self.directory = pickle.loads(view[directory_offset:-_OFFSET.size])
+        self.sections = {name: view[offset:offset + length].cast(typecode)
+                for name, (offset, length, typecode)
+                in self.directory.items()}
+        self.terms = TermDictionary(self.sections['blocks'],
+                pickle.loads(self.sections['block_index']), block_cache_size,
+                [self.sections[name] for name in columns])
+        self.doc_ids = DocTable(self.sections['doc_ids'])
+
+    def array(self, name):
+        """Named array of the index, as a memoryview of the file"""
+        return self.sections[name]
+
+
+class TermDictionary(collections.abc.Mapping):
+    """term -> dictionary entry, decoded block by block on lookup
+    @columns sequences of a value per term, appended to the entries"""
+    def __init__(self, blocks, block_index, block_cache_size, columns=()):
+        self.blocks = blocks
+        self.first_terms, self.offsets, self.count = block_index
+        self.cache = LRUCache(block_cache_size)
+        self.columns = columns
+        # Every block but the last holds as many terms as the first one
+        self.block_size = (_read_vbyte(blocks, self.offsets[0])[0]
+                if self.first_terms else 0)
+
+    def block(self, i):
+        """(terms, entries) of the i-th block"""
+        block = self.cache.get(i)
+        if block is None:
+            terms, entries = _decode_block(
+                    self.blocks[self.offsets[i]:self.offsets[i + 1]])
+            if self.columns:
+                start = i * self.block_size
+                entries = [entry + tuple(column[start + j]
+                        for column in self.columns)
+                        for j, entry in enumerate(entries)]
+            block = terms, entries
+            self.cache.put(i, block)
+        return block
+
+    def __getitem__(self, term):
+        i = bisect.bisect_right(self.first_terms, term) - 1
+        if i < 0:
+            raise KeyError(term)
+        terms, entries = self.block(i)
+        j = bisect.bisect_left(terms, term)
+        if j == len(terms) or terms[j] != term:
+            raise KeyError(term)
+        return entries[j]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(len(self.first_terms)):
+            yield from self.block(i)[0]
+
+    def items(self):
+        for i in range(len(self.first_terms)):
+            yield from zip(*self.block(i))
+
+    def prefix(self, prefix):
+        """(term, entry) of the terms starting with prefix, in order"""
+        i = max(bisect.bisect_left(self.first_terms, prefix) - 1, 0)
+        for i in range(i, len(self.first_terms)):
+            for term, entry in zip(*self.block(i)):
+                if term.startswith(prefix):
+                    yield term, entry
+                elif term > prefix:
+                    return
+
+
+class DocTable(collections.abc.Sequence):
+    """ordinal -> filename, read from the document table section"""
+    def __init__(self, data):
+        self.count, = struct.unpack_from('I', data)
+        self.ends = data[4:4 * (self.count + 1)].cast('I')
+        self.names = data[4 * (self.count + 1):]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('document ordinal out of range')
+        start = self.ends[i - 1] if i else 0
+        return bytes(self.names[start:self.ends[i]]).decode()
+
+
+
+import os
+import tempfile
+import unittest
+class TestTermDictionary(unittest.TestCase):
+    # Shared prefixes, a term prefix of the next one, non-ASCII terms
+    terms = ['ban', 'bank', 'banker', 'banking', 'bar', 'car', 'card',
+            'café', 'cafés', 'z']
+
+    def setUp(self):
+        fd, self.dict_file = tempfile.mkstemp()
+        os.close(fd)
+        self.doc_ids = ['1', '20', 'docé', '300']
+        self.entries = [(term, (i + 1, i * 10, 10))
+                for i, term in enumerate(sorted(self.terms))]
+        self.doc_length = array.array('I', [3, 0, 7, 2**32 - 1])
+        self.max_impacts = array.array('d',
+                (0.5 * i for i in range(len(self.terms))))
+        # Blocks of 4 terms, the last one partial
+        write_dictionary(self.dict_file, self.doc_ids, self.entries,
+                {'doc_length': self.doc_length,
+                    'max_impacts': self.max_impacts}, block_size=4)
+
+    def tearDown(self):
+        os.remove(self.dict_file)
+
+    def test_round_trip(self):
+        doc_ids, doc_length, terms = load(self.dict_file, ('doc_length',))
+        self.assertEqual(list(doc_ids), self.doc_ids)
+        self.assertEqual(list(doc_length), list(self.doc_length))
+        self.assertEqual(len(terms), len(self.entries))
+        self.assertEqual(list(terms), [term for term, _ in self.entries])
+        self.assertEqual(list(terms.items()), self.entries)
+        for term, entry in self.entries:
+            self.assertEqual(terms[term], entry)
+
+    def test_missing_terms(self):
+        terms = load(self.dict_file)[-1]
+        for term in ('', 'a', 'ba', 'banks', 'caf', 'caz', 'zz'):
+            self.assertNotIn(term, terms)
+            with self.assertRaises(KeyError):
+                terms[term]
+
+    def test_prefix(self):
+        terms = load(self.dict_file)[-1]
+        self.assertEqual([term for term, _ in terms.prefix('bank')],
+                ['bank', 'banker', 'banking'])
+        self.assertEqual([term for term, _ in terms.prefix('caf')],
+                ['café', 'cafés'])
+        self.assertEqual(list(terms.prefix('x')), [])
+        self.assertEqual(len(list(terms.prefix(''))), len(self.terms))
+
+    def test_doc_table(self):
+        doc_ids = load(self.dict_file)[0]
+        self.assertEqual(doc_ids[-1], '300')
+        self.assertEqual(doc_ids[1:3], ['20', 'docé'])
+        with self.assertRaises(IndexError):
+            doc_ids[len(self.doc_ids)]
+
+    def test_columns(self):
+        terms = load(self.dict_file, columns=('max_impacts',))[-1]
+        for (term, entry), impact in zip(self.entries, self.max_impacts):
+            self.assertEqual(terms[term], entry + (impact,))
+
+    def test_pickled_columns(self):
+        dictionary = dict(self.entries)
+        with open(self.dict_file, 'wb') as f:
+            pickle.dump((self.doc_ids, self.doc_length, self.max_impacts,
+                    dictionary), f)
+        self.assertFalse(is_term_dictionary(self.dict_file))
+        doc_ids, doc_length, terms = load(self.dict_file, ('doc_length',),
+                ('max_impacts',))
+        self.assertEqual(doc_ids, self.doc_ids)
+        for (term, entry), impact in zip(self.entries, self.max_impacts):
+            self.assertEqual(terms[term], entry + (impact,))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+"""Per-query tracing of the searches.
+
+Tracing is enabled with the --trace option of search.py, or with the
+IR_TRACE environment variable, both naming the trace file (- for
+stderr). Each query is written as one JSON line:
+
+    query       the query text
+    seconds     total time of the query
+    phases      seconds spent in each phase of the query (e.g. analyze,
+                score), the postings phase overlaps the ones fetching
+                postings
+    postings    lists fetched, decoded (postings cache misses), cache
+                hits and bytes read from the postings file
+    lists       size of the postings list of each term fetched
+    operators   boolean queries: operator, number of operands and
+                result size of each node, in evaluation order
+    candidates  documents considered: matched by a boolean query,
+                scored or pruned by a ranked query
+
+and the batch ends with a {"summary": ...} line of the totals.
+
+The hooks cost nothing when tracing is disabled: the searches then run
+the usual code, and the traced searches go through a separate path
+whose postings retrievers are wrapped by `TracedPostings`.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import sys
+import time
+
+ENVIRONMENT = 'IR_TRACE'
+
+# Postings retriever counters reported per query
+COUNTERS = ('hits', 'misses', 'bytes_read')
+
+
+def open_tracer(trace_file=None, retrievers=()):
+    """Tracer writing to trace_file, or to the file of the environment
+    variable, None when tracing is disabled"""
+    trace_file = trace_file or os.environ.get(ENVIRONMENT)
+    if not trace_file:
+        return None
+    output = sys.stderr if trace_file == '-' else open(trace_file, 'w')
+    return Tracer(output, retrievers)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Tracer(object):
+    def __init__(self, output, retrievers=()):
+        """
+        @output file of the JSON lines
+        @retrievers postings retrievers with a `stats()` of COUNTERS
+        """
+        self.output = output
+        self.retrievers = [retriever for retriever in retrievers
+                if retriever is not None]
+        self.record = None
+        self.latencies = []
+        self.phases = collections.Counter()
+        self.totals = collections.Counter()
+
+    def begin(self, query):
+        self.record = {
+            'query': query.strip(),
+            'phases': collections.Counter(),
+            'postings': collections.Counter(),
+            'lists': {},
+        }
+        self._counters = self.counters()
+        self._start = time.perf_counter()
+
+    def counters(self):
+        totals = collections.Counter()
+        for retriever in self.retrievers:
+            stats = retriever.stats()
+            totals.update({key: stats[key] for key in COUNTERS})
+        return totals
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record['phases'][name] += time.perf_counter() - start
+
+    def fetched(self, term, postings, seconds):
+        """Record a postings list fetched by a TracedPostings"""
+        if self.record is None:
+            # Fetched outside of a query, e.g. to load the matrix
+            return
+        self.record['postings']['fetched'] += 1
+        self.record['phases']['postings'] += seconds
+        self.record['lists'][term] = len(postings)
+
+    def operator(self, node, result):
+        """Record an evaluated node of a boolean query tree"""
+        operands = 1 if not isinstance(node[1], list) else len(node[1])
+        self.record.setdefault('operators', []).append(
+                {'operator': node[0], 'operands': operands,
+                    'size': len(result)})
+
+    def set(self, **fields):
+        self.record.update(fields)
+
+    def end(self, **fields):
+        """Write the record of the query"""
+        seconds = time.perf_counter() - self._start
+        counters = self.counters()
+        counters.subtract(self._counters)
+        record = self.record
+        record.update(fields)
+        record['seconds'] = seconds
+        record['postings'].update({
+            'decoded': counters['misses'],
+            'cache_hits': counters['hits'],
+            'bytes_read': counters['bytes_read'],
+        })
+
+        self.latencies.append(seconds)
+        self.phases.update(record['phases'])
+        self.totals.update(record['postings'])
+        self.totals['candidates'] += record.get('candidates', 0)
+        self.output.write(json.dumps(record) + '\n')
+        self.record = None
+
+    def summary(self):
+        """Totals of the traced queries"""
+        if not self.latencies:
+            return {'queries': 0}
+        return {
+            'queries': len(self.latencies),
+            'seconds': sum(self.latencies),
+            'latency_p50_ms': percentile(self.latencies, 0.5) * 1000,
+            'latency_p95_ms': percentile(self.latencies, 0.95) * 1000,
+            'latency_max_ms': max(self.latencies) * 1000,
+            'phases': dict(self.phases),
+            'totals': dict(self.totals),
+        }
+
+    def close(self):
+        """Write the summary of the batch, and return it"""
+        summary = self.summary()
+        self.output.write(json.dumps({'summary': summary}) + '\n')
+        if self.output is not sys.stderr:
+            self.output.close()
+        return summary
+
+
+class TracedPostings(object):
+    """Postings retriever recording the lists fetched into a tracer"""
+    def __init__(self, postings, tracer):
+        self.postings = postings
+        self.tracer = tracer
+
+    def __call__(self, term):
+        start = time.perf_counter()
+        postings = self.postings(term)
+        self.tracer.fetched(term, postings, time.perf_counter() - start)
+        return postings
+
+    def __getattr__(self, name):
+        return getattr(self.postings, name)
@@ -0,0 +1 @@
+../2/analyzer.py
\ No newline at end of file
@@ -0,0 +1 @@
+../2/batch.py
\ No newline at end of file
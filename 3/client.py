@@ -0,0 +1 @@
+../2/client.py
\ No newline at end of file
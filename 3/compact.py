@@ -0,0 +1,117 @@
+"""Compact ranked postings format.
+
+Documents are numbered by their doc ordinal, their position in doc
+order. The dictionary file holds the ordinal table (ordinal -> filename)
+and the document lengths as a flat array('I') indexed by ordinal. The
+max impacts of the terms are a column of the dictionary, an array('d')
+in term order (see termdict.py).
+
+A postings list is stored as
+    <typecode of the gaps: 1 byte> <typecode of the codes: 1 byte>
+    <doc gaps> <tf codes>
+The gaps between consecutive ordinals and the codes each use the
+smallest array type of 'B', 'H', 'I' holding their largest value.
+The weights 1 + log10(tf) are quantized without loss: the distinct term
+frequencies of the index are listed once in a table, also stored in
+the dictionary file, and the postings store the position of their tf
+in it. Frequent term frequencies come first in practice, as they are
+numbered in order of appearance.
+
+Impact-ordered postings are stored as
+    <doc ordinals: array('I')> <impacts: array('d')>
+
+Arrays are in native byte order. The decoded postings read the codes
+and impacts through memoryviews of the mapped postings file; only the
+ordinals of the gaps are materialized.
+"""
+
+import array
+import itertools
+import math
+import sys
+
+TYPECODES = ('B', 'H', 'I')
+
+
+def tf_weight(tf):
+    """Weight of a term frequency in a document"""
+    return 1 + math.log10(tf)
+
+
+def smallest_typecode(value):
+    """Smallest unsigned array type holding `value`"""
+    for typecode in TYPECODES:
+        if value < 1 << (8 * array.array(typecode).itemsize):
+            return typecode
+    raise OverflowError('{} does not fit in an array'.format(value))
+
+
+def encode_postings(doc_ids, codes):
+    """Bytes of the sorted doc ordinals and their tf codes"""
+    gaps = [doc_id - previous
+            for previous, doc_id in zip([0] + doc_ids, doc_ids)]
+    gap_type = smallest_typecode(max(gaps))
+    code_type = smallest_typecode(max(codes))
+    return ((gap_type + code_type).encode()
+            + array.array(gap_type, gaps).tobytes()
+            + array.array(code_type, codes).tobytes())
+
+
+def decode_postings(data):
+    """(doc ordinals array, tf codes memoryview) of an encoded list"""
+    data = memoryview(data)
+    gap_type, code_type = chr(data[0]), chr(data[1])
+    gap_size = array.array(gap_type).itemsize
+    code_size = array.array(code_type).itemsize
+    count = (len(data) - 2) // (gap_size + code_size)
+    end = 2 + count * gap_size
+    doc_ids = array.array('I', itertools.accumulate(data[2:end].cast(gap_type)))
+    return doc_ids, data[end:].cast(code_type)
+
+
+def encode_impacts(postings):
+    """Bytes of the (doc ordinal, impact) postings, in their order"""
+    return (array.array('I', (doc_id for doc_id, _ in postings)).tobytes()
+            + array.array('d', (impact for _, impact in postings)).tobytes())
+
+
+def decode_impacts(data):
+    """(doc ordinals, impacts) memoryviews of encoded impact postings"""
+    data = memoryview(data)
+    count = len(data) // 12
+    return data[:4 * count].cast('I'), data[4 * count:].cast('d')
+
+
+class Postings(object):
+    """(doc ordinal, weight) postings over parallel sequences, the
+    weights are looked up in `table` when the sequence holds codes"""
+    __slots__ = ('doc_ids', 'weights', 'table')
+
+    def __init__(self, doc_ids, weights, table=None):
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.table = table
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(zip(self.doc_ids[i], self._weights(i)))
+        weight = self.weights[i]
+        if self.table is not None:
+            weight = self.table[weight]
+        return self.doc_ids[i], weight
+
+    def __iter__(self):
+        return zip(self.doc_ids, self._weights(slice(None)))
+
+    def _weights(self, i):
+        if self.table is None:
+            return self.weights[i]
+        return map(self.table.__getitem__, self.weights[i])
+
+    def __sizeof__(self):
+        # Memoryviews of the mapped file only cost their header
+        return (object.__sizeof__(self) + sys.getsizeof(self.doc_ids)
+                + sys.getsizeof(self.weights))
@@ -1,60 +1,246 @@
 #!/usr/bin/python3
 
 import argparse
+import array
 import os
-import math
-import nltk
 import collections
 import pickle
+import multiprocessing
 
+from analyzer import Analyzer
+import compact
+import segments
+import shards
+import termdict
+import topk
+from postings import doc_order
+from spimi import SpimiInverter
 
-porter = nltk.PorterStemmer()
+
+analyzer = Analyzer()
+
+# Arrays of the index in a term dictionary file, and columns of the
+# dictionary entries
+ARRAYS = ('doc_length', 'tfs')
+COLUMNS = ('max_impacts',)
 
 def extract(document):
     """Extraction of terms in the document"""
-    terms = []
-    for term in nltk.word_tokenize(document):
-        terms.append(porter.stem(term).lower())
-    return terms
+    return list(analyzer.terms(document))
 
 
-def main(index_dir, dict_file, postings_file):
-
-    dictionary = {}
-    postings = collections.defaultdict(set)
-    doc_id_set = set()
-    doc_length = {}
+def invert(batch):
+    """Partial inverted lists of (doc_id, tf) and document lengths of
+    a batch of (doc_id, filepath), in the order of the batch"""
+    postings = collections.defaultdict(list)
+    doc_length = []
 
-    for filename in os.listdir(index_dir):
-        doc_id = filename
-        filepath = os.path.join(index_dir, filename)
+    for doc_id, filepath in batch:
         with open(filepath) as f:
             document = f.read()
 
         tokens = extract(document)
         term_freq = collections.Counter(tokens)
 
-        log_tf = {t: 1 + math.log10(tf) for t, tf in term_freq.items()}
+        for token, tf in term_freq.items():
+            postings[token].append((doc_id, tf))
 
-        for token in tokens:
-            postings[token].add((doc_id, log_tf[token]))
-            doc_id_set.add(doc_id)
+        # Lenght of the documents for normalization
+        doc_length.append(len(tokens))
+    return postings, doc_length
 
 
-        # Lenght of the documents for normalization
-        doc_length[doc_id] = len(tokens)
+def parallel_map(function, iterable, workers, in_flight=None):
+    """Ordered map, over a process pool when there is more than 1 worker
+    @in_flight maximum number of items sent and not yielded yet, 2 per
+    worker by default: the pool does not read ahead of a slow consumer,
+    and holds at most that many results in memory"""
+    if workers <= 1:
+        yield from map(function, iterable)
+        return
+    in_flight = in_flight or 2 * workers
+    pending = collections.deque()
+    with multiprocessing.Pool(workers) as pool:
+        for item in iterable:
+            if len(pending) >= in_flight:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(function, (item,)))
+        while pending:
+            yield pending.popleft().get()
+
 
+def build(index_dir, filenames, dict_file, postings_file, workers=1,
+        batch_size=64, memory_budget=None, impact_ordered=False,
+        champions=None, term_dictionary=False):
+    """Index the documents `filenames` of index_dir"""
+
+    postings = SpimiInverter(memory_budget, posting_size=80)
+
+    # Documents are numbered in sorted order, so that the postings
+    # lists are built already sorted by doc ordinal
+    doc_ids = sorted(filenames, key=doc_order)
+    doc_length = array.array('I', [0]) * len(doc_ids)
+
+    documents = [(doc_id, os.path.join(index_dir, filename))
+            for doc_id, filename in enumerate(doc_ids)]
+    batches = [documents[i:i + batch_size]
+            for i in range(0, len(documents), batch_size)]
+
+    # Partial lists are merged in batch order, whatever the number of
+    # workers, which keeps the output identical
+    partials = parallel_map(invert, batches, workers)
+    for batch, (partial_postings, partial_length) in zip(batches, partials):
+        postings.add(partial_postings)
+        for (doc_id, _), length in zip(batch, partial_length):
+            doc_length[doc_id] = length
+
+    if workers <= 1:
+        print("Stem cache: {hits} hits, {misses} misses".format(
+            **analyzer.stats()))
     print("Saving Index")
+    write_index(doc_ids, doc_length, postings, dict_file, postings_file,
+            impact_ordered, champions, term_dictionary)
+
+
+def write_index(doc_ids, doc_length, postings, dict_file, postings_file,
+        impact_ordered=False, champions=None, term_dictionary=False):
+    """Write the (term, [(doc_id, tf)]) of postings, in term order,
+    @impact_ordered also writes the postings by descending impact,
+    limited to the `champions` best documents of the term when given
+    @term_dictionary writes a term dictionary file (see termdict.py)
+    instead of a pickled dictionary"""
+    dictionary = {}
+    tf_codes = {}
+    # Column of the max impacts, in term order
+    max_impacts = array.array('d')
 
     with open(postings_file, 'wb') as f:
-        for term, doc_set in postings.items():
+        for term, doc_list in postings:
+            for _, tf in doc_list:
+                tf_codes.setdefault(tf, len(tf_codes))
             posting_offset = f.tell()
-            dictionary[term] = (len(doc_set), posting_offset)
-            pickle.dump(doc_set, f)
+            posting_length = f.write(compact.encode_postings(
+                [doc_id for doc_id, _ in doc_list],
+                [tf_codes[tf] for _, tf in doc_list]))
+
+            weights = [(doc_id, compact.tf_weight(tf)) for doc_id, tf in doc_list]
+            entry = (len(doc_list), posting_offset, posting_length)
+            max_impacts.append(topk.max_impact(weights, doc_length))
+            if impact_ordered or champions:
+                impacts = topk.impact_order(weights, doc_length, champions)
+                impact_offset = f.tell()
+                impact_length = f.write(compact.encode_impacts(impacts))
+                entry += (impact_offset, impact_length)
+            dictionary[term] = entry
 
 
+    tfs = array.array('I', tf_codes)
+    if term_dictionary:
+        termdict.write_dictionary(dict_file, doc_ids, dictionary.items(),
+                {'doc_length': doc_length, 'tfs': tfs,
+                    'max_impacts': max_impacts})
+        return
     with open(dict_file, 'wb') as f:
-        pickle.dump((doc_id_set, doc_length, dictionary), f)
+        pickle.dump((doc_ids, doc_length, tfs, max_impacts, dictionary), f)
+
+
+def update(index_dir, dict_file, postings_file, **options):
+    """Index the new and changed documents into a new segment"""
+    manifest = segments.load_manifest(dict_file)
+    docs = segments.plan_update(manifest, index_dir)
+    if docs:
+        segment_dict, segment_postings = segments.add_segment(
+                manifest, dict_file, postings_file, docs)
+        build(index_dir, docs, segment_dict, segment_postings, **options)
+    segments.save_manifest(manifest, dict_file)
+    print("{} documents indexed, {} segments".format(
+        len(docs), len(manifest['segments'])))
+
+
+def build_shards(index_dir, filenames, dict_file, postings_file, shard_count,
+        **options):
+    """Index the documents `filenames` of index_dir into `shard_count`
+    segments of contiguous documents, searched as shards"""
+    manifest = segments.new_manifest(sharded=True)
+    for docs in shards.partition(sorted(filenames, key=doc_order),
+            shard_count):
+        signatures = {doc: segments.signature(os.path.join(index_dir, doc))
+                for doc in docs}
+        segment_dict, segment_postings = segments.add_segment(
+                manifest, dict_file, postings_file, signatures)
+        build(index_dir, docs, segment_dict, segment_postings, **options)
+    segments.save_manifest(manifest, dict_file)
+    print("{} documents indexed into {} shards".format(
+        len(filenames), len(manifest['segments'])))
+
+
+def merge(dict_file, postings_file, impact_ordered=False, champions=None,
+        term_dictionary=False):
+    """Merge the live documents of every segment into a single one"""
+    manifest = segments.load_manifest(dict_file)
+    old_segments = list(manifest['segments'])
+    if not old_segments:
+        print("No segment to merge")
+        return
+
+    indexes = []
+    docs = {}
+    lengths = {}
+    for segment in old_segments:
+        segment_doc_ids, segment_length, tfs, dictionary = termdict.load(
+                segments.segment_path(dict_file, segment['dict_file']),
+                ARRAYS, COLUMNS)
+        with open(segments.segment_path(
+                dict_file, segment['postings_file']), 'rb') as f:
+            data = f.read()
+        indexes.append((segment, segment_doc_ids, tfs, dictionary, data))
+        for doc_id, doc in enumerate(segment_doc_ids):
+            if doc not in segment['deleted']:
+                docs[doc] = segment['docs'][doc]
+                lengths[doc] = segment_length[doc_id]
+
+    doc_ids = sorted(docs, key=doc_order)
+    doc_length = array.array('I', (lengths[doc] for doc in doc_ids))
+    ordinals = {doc: doc_id for doc_id, doc in enumerate(doc_ids)}
+
+    def merged_postings():
+        terms = set()
+        for _, _, _, dictionary, _ in indexes:
+            terms.update(dictionary)
+        for term in sorted(terms):
+            doc_list = []
+            for segment, segment_doc_ids, tfs, dictionary, data in indexes:
+                if term not in dictionary:
+                    continue
+                _, offset, length = dictionary[term][:3]
+                local_ids, codes = compact.decode_postings(
+                        data[offset:offset + length])
+                for local_id, code in zip(local_ids, codes):
+                    doc = segment_doc_ids[local_id]
+                    if doc not in segment['deleted']:
+                        doc_list.append((ordinals[doc], tfs[code]))
+            if doc_list:
+                doc_list.sort()
+                yield term, doc_list
+
+    segment_dict, segment_postings = segments.add_segment(
+            manifest, dict_file, postings_file, docs)
+    write_index(doc_ids, doc_length, merged_postings(),
+            segment_dict, segment_postings, impact_ordered, champions,
+            term_dictionary)
+    manifest['segments'] = manifest['segments'][-1:]
+    segments.save_manifest(manifest, dict_file)
+    segments.remove_segments(dict_file, old_segments)
+    print("{} segments merged, {} documents".format(
+        len(old_segments), len(doc_ids)))
+
+
+def main(index_dir, dict_file, postings_file, workers=1, batch_size=64,
+        memory_budget=None, impact_ordered=False, champions=None,
+        term_dictionary=False):
+    build(index_dir, os.listdir(index_dir), dict_file, postings_file,
+            workers, batch_size, memory_budget, impact_ordered, champions,
+            term_dictionary)
 
 
 
@@ -62,14 +248,55 @@ def main(index_dir, dict_file, postings_file):
 
 def _getCommandArgs():
     parser = argparse.ArgumentParser(description='Document indexer')
-    parser.add_argument('-i', dest='index_dir', required=True,
+    parser.add_argument('-i', dest='index_dir',
             help='directory of documents')
     parser.add_argument('-d', dest='dict_file', required=True,
             help='dictionary file')
     parser.add_argument('-p', dest='postings_file', required=True,
             help='postings file')
-    return parser.parse_args()
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+            help='number of indexing processes')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=float,
+            help='memory for the inverted lists in MB, '
+            'sorted runs are spilled to temporary files above it')
+    parser.add_argument('--impact-ordered', dest='impact_ordered',
+            action='store_true',
+            help='also store the postings by descending impact, '
+            'for the impact search mode')
+    parser.add_argument('--champions', dest='champions', type=int,
+            help='keep only this many best documents per term in the '
+            'impact-ordered postings, implies --impact-ordered')
+    parser.add_argument('--term-dictionary', dest='term_dictionary',
+            action='store_true',
+            help='write a front-coded term dictionary, read lazily by '
+            'the searcher, instead of a pickled dictionary')
+    parser.add_argument('--shards', dest='shards', type=int,
+            help='split the documents into this many shards, searched '
+            'in parallel, the dictionary file is then their manifest')
+    parser.add_argument('--incremental', action='store_true',
+            help='index the new and changed documents into a new segment, '
+            'the dictionary file is then the manifest of the segments')
+    parser.add_argument('--merge', action='store_true',
+            help='merge the segments of an incremental index')
+    args = parser.parse_args()
+    if not args.merge and args.index_dir is None:
+        parser.error('the directory of documents (-i) is required')
+    return args
 
 if __name__ == '__main__':
     args = _getCommandArgs()
-    main(args.index_dir, args.dict_file, args.postings_file)
+    memory_budget = (int(args.memory_budget * 1024 * 1024)
+            if args.memory_budget is not None else None)
+    options = dict(workers=args.workers, memory_budget=memory_budget,
+            impact_ordered=args.impact_ordered, champions=args.champions,
+            term_dictionary=args.term_dictionary)
+    if args.merge:
+        merge(args.dict_file, args.postings_file,
+                args.impact_ordered, args.champions, args.term_dictionary)
+    elif args.incremental:
+        update(args.index_dir, args.dict_file, args.postings_file, **options)
+    elif args.shards:
+        build_shards(args.index_dir, os.listdir(args.index_dir),
+                args.dict_file, args.postings_file, args.shards, **options)
+    else:
+        main(args.index_dir, args.dict_file, args.postings_file, **options)
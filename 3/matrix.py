@@ -0,0 +1,112 @@
+"""Batch scoring of weighted queries as a sparse matrix product.
+
+The postings are loaded once into a CSR term-document matrix of the
+weights w_td, with the documents as columns in doc order. The weighted
+query vectors of a batch are stacked into a sparse query-term matrix,
+so the scores of every query are the rows of a single product, which
+are then normalized by sqrt(doc_length).
+
+The top k of each row is selected with a partition, and ties are
+broken by doc order like the other scoring paths. Documents only
+matched by terms with a zero query weight (terms present in every
+document) have a score of 0 and are only ranked when fewer than k
+documents have a positive score.
+
+Requires NumPy and SciPy.
+"""
+
+import numpy as np
+import scipy.sparse
+
+
+class MatrixScorer(object):
+    def __init__(self, dictionary, doc_ids, doc_length, postings):
+        """
+        @doc_ids documents in doc order, their ordinals are the columns
+        of the matrix
+        @postings term -> postings list retriever
+        """
+        self.doc_count = len(doc_ids)
+        self.postings = postings
+        self.terms = {term: row for row, term in enumerate(sorted(dictionary))}
+
+        indptr = [0]
+        indices = []
+        data = []
+        for term in sorted(dictionary):
+            for doc_id, weight in postings(term):
+                indices.append(doc_id)
+                data.append(weight)
+            indptr.append(len(indices))
+        self.weights = scipy.sparse.csr_matrix(
+                (np.array(data, dtype=np.float64),
+                    np.array(indices, dtype=np.int64),
+                    np.array(indptr, dtype=np.int64)),
+                shape=(len(self.terms), self.doc_count))
+        self.norms = np.sqrt(np.array(doc_length, dtype=np.float64))
+
+    def query_matrix(self, queries):
+        """Sparse matrix of the weighted query terms, one row per query"""
+        rows = []
+        columns = []
+        data = []
+        for i, query_terms in enumerate(queries):
+            for term, weight in query_terms:
+                if term in self.terms:
+                    rows.append(i)
+                    columns.append(self.terms[term])
+                    data.append(weight)
+        # Repeated terms of a query are summed
+        return scipy.sparse.csr_matrix(
+                (np.array(data, dtype=np.float64), (rows, columns)),
+                shape=(len(queries), len(self.terms)))
+
+    def search_batch(self, queries, result_count, stats=None):
+        """Top result_count (doc ordinal, score) of each list of weighted
+        query terms
+        @stats optional list of a dict per query, receiving its number
+        of candidates"""
+        if not queries:
+            return []
+        scores = self.query_matrix(queries).dot(self.weights).tocsr()
+        scores.sort_indices()
+
+        results = []
+        for i, query_terms in enumerate(queries):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            columns = scores.indices[start:end]
+            row = scores.data[start:end] / self.norms[columns]
+            if stats is not None:
+                stats[i]['candidates'] = int(end - start)
+            results.append(self.top(query_terms, columns, row, result_count))
+        return results
+
+    def top(self, query_terms, columns, row, result_count):
+        if result_count <= 0:
+            return []
+        if len(row) > result_count:
+            # Every document tied with the k-th score is kept, so that
+            # the ties are broken by doc order
+            kth = np.partition(row, len(row) - result_count)[
+                    len(row) - result_count]
+            selected = np.flatnonzero(row >= kth)
+            columns, row = columns[selected], row[selected]
+        order = np.lexsort((columns, -row))[:result_count]
+        top = [(int(column), float(score))
+                for column, score in zip(columns[order], row[order])]
+
+        if len(top) < result_count:
+            top.extend(self.zero_scores(query_terms, columns,
+                result_count - len(top)))
+        return top
+
+    def zero_scores(self, query_terms, scored, count):
+        """First documents in doc order matched by the query terms
+        without a score"""
+        scored = set(scored.tolist())
+        matched = set()
+        for term, weight in query_terms:
+            if term in self.terms and weight == 0:
+                matched.update(doc_id for doc_id, _ in self.postings(term))
+        zeros = sorted(matched - scored)
+        return [(doc_id, 0.0) for doc_id in zeros[:count]]
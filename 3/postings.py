@@ -0,0 +1 @@
+../2/postings.py
\ No newline at end of file
@@ -0,0 +1 @@
+../2/queryserver.py
\ No newline at end of file
@@ -1,33 +1,256 @@
 #!/usr/bin/python3
 
-import nltk
-import pickle
 import argparse
+import array
 import math
 import collections
+import collections.abc
+import functools
+import heapq
+import itertools
+import time
+
+import batch
+import compact
+import segments
+import shards
+import termdict
+import topk
+import tracing
+from analyzer import Analyzer
+from postings import PostingsReader, LRUCache, doc_order
+
+analyzer = Analyzer()
+
+# Search modes
+MAXSCORE = 'maxscore'
+EXHAUSTIVE = 'exhaustive'
+IMPACT = 'impact'
+MATRIX = 'matrix'
+MODES = (MAXSCORE, EXHAUSTIVE, IMPACT, MATRIX)
+
+# Arrays of the index in a term dictionary file, and columns of the
+# dictionary entries
+ARRAYS = ('doc_length', 'tfs')
+COLUMNS = ('max_impacts',)
+
+def postings_decoder(tfs):
+    """Decoder of the postings of an index with the tf table `tfs`"""
+    weights = [compact.tf_weight(tf) for tf in tfs]
+    def decode(data, entry):
+        doc_ids, codes = compact.decode_postings(data)
+        return compact.Postings(doc_ids, codes, weights)
+    return decode
+
+
+def decode_impacts(data, entry):
+    return compact.Postings(*compact.decode_impacts(data))
+
+
+class SegmentedPostings(object):
+    """Postings retriever over every segment of an incremental index.
+
+    The postings of a term are the postings of each segment without the
+    deleted documents. The document frequencies are summed over the
+    segments, so the idf is computed from the global statistics; the
+    deleted documents are only discounted once the segments are merged.
+    The number of documents of the idf, `doc_count`, counts them as well
+    (like the maxDoc of Lucene), so that a df never exceeds it.
+    """
+    def __init__(self, manifest, dict_file, cache_size):
+        self.dictionary = {}
+        self.readers = []
+        self.impact_readers = []
+        lengths = {}
+        segment_doc_ids = []
+
+        for segment in manifest['segments']:
+            doc_ids, doc_length, tfs, dictionary = termdict.load(
+                    segments.segment_path(dict_file, segment['dict_file']),
+                    ARRAYS, COLUMNS)
+            segment_doc_ids.append(doc_ids)
+            deleted = set()
+            for doc_id, doc in enumerate(doc_ids):
+                if doc in segment['deleted']:
+                    deleted.add(doc_id)
+                else:
+                    lengths[doc] = doc_length[doc_id]
+
+            # Global statistics, with the same layout as index entries
+            for term, entry in dictionary.items():
+                df, _, _, impact = self.dictionary.get(
+                        term, (0, None, None, 0.0))
+                self.dictionary[term] = (
+                        df + entry[0], None, None,
+                        max(impact, entry[topk.MAX_IMPACT]))
+
+            segment_postings = segments.segment_path(
+                    dict_file, segment['postings_file'])
+            segment_cache = cache_size // max(len(manifest['segments']), 1)
+            self.readers.append((deleted, PostingsReader(
+                segment_postings, dictionary, decode=postings_decoder(tfs),
+                cache_size=segment_cache, view=True)))
+            if has_impacts(dictionary):
+                self.impact_readers.append((deleted, PostingsReader(
+                    segment_postings, dictionary, decode=decode_impacts,
+                    cache_size=segment_cache, fields=topk.IMPACT_FIELDS,
+                    view=True)))
+
+        # Documents of the df, deleted ones included
+        self.doc_count = sum(len(doc_ids) for doc_ids in segment_doc_ids)
+
+        # Global doc ordinals, and the ordinal of each segment document
+        self.doc_ids = sorted(lengths, key=doc_order)
+        self.doc_length = array.array('I',
+                (lengths[doc] for doc in self.doc_ids))
+        ordinals = {doc: doc_id for doc_id, doc in enumerate(self.doc_ids)}
+        self.ordinals = [array.array('I', (ordinals.get(doc, 0)
+                    for doc in doc_ids))
+                for doc_ids in segment_doc_ids]
+
+    def __call__(self, term):
+        postings = []
+        segment_count = 0
+        for (deleted, reader), ordinals in zip(self.readers, self.ordinals):
+            if term not in reader.dictionary:
+                continue
+            segment_count += 1
+            postings.extend((ordinals[doc_id], weight)
+                    for doc_id, weight in reader(term) if doc_id not in deleted)
+        if segment_count > 1:
+            postings.sort()
+        return postings
+
+    def impacts(self, term):
+        """Impact-ordered postings of the term over every segment"""
+        lists = [[(ordinals[doc_id], impact)
+                    for doc_id, impact in reader(term) if doc_id not in deleted]
+                for (deleted, reader), ordinals
+                in zip(self.impact_readers, self.ordinals)
+                if term in reader.dictionary]
+        if len(lists) == 1:
+            return lists[0]
+        return list(heapq.merge(*lists,
+            key=lambda posting: (-posting[1], posting[0])))
+
+    def has_impacts(self):
+        return (len(self.impact_readers) == len(self.readers)
+                and bool(self.readers))
+
+    def stats(self):
+        stats = [reader.stats()
+                for _, reader in self.readers + self.impact_readers]
+        return {key: sum(stat[key] for stat in stats)
+                for key in ('hits', 'misses', 'evictions', 'bytes_read')}
+
+    def close(self):
+        for _, reader in self.readers + self.impact_readers:
+            reader.close()
+
+
+def has_impacts(dictionary):
+    """Whether the index was built with impact-ordered postings,
+    the entries of an index all have the same fields"""
+    for entry in dictionary.values():
+        return len(entry) > topk.IMPACT_FIELDS[-1]
+    return False
+
+
+def load_index(dict_file, postings_file, cache_size, index=None):
+    """Load a single or incremental index,
+    return (doc_ids, doc_length, dictionary, postings retriever)
+    @index contents of dict_file, when already loaded"""
+    if index is None:
+        index = termdict.load(dict_file, ARRAYS, COLUMNS)
+
+    if segments.is_manifest(index):
+        postings = SegmentedPostings(index, dict_file, cache_size)
+        return (postings.doc_ids, postings.doc_length,
+                postings.dictionary, postings)
+
+    doc_ids, doc_length, tfs, dictionary = index
+    postings = PostingsReader(postings_file, dictionary,
+            decode=postings_decoder(tfs), cache_size=cache_size, view=True)
+    return doc_ids, doc_length, dictionary, postings
+
+
+def load_impacts(postings_file, dictionary, postings, cache_size):
+    """Retriever of the impact-ordered postings of an index loaded by
+    `load_index`, None when the index has none"""
+    if isinstance(postings, SegmentedPostings):
+        return postings.impacts if postings.has_impacts() else None
+    if not has_impacts(dictionary):
+        return None
+    return PostingsReader(postings_file, dictionary, decode=decode_impacts,
+            cache_size=cache_size, fields=topk.IMPACT_FIELDS, view=True)
+
+
+def load_segment(dict_file, segment, cache_size):
+    """Load a segment of a segmented index on its own,
+    return (doc_ids, doc_length, dictionary, postings, impacts)"""
+    if segment['deleted']:
+        postings = SegmentedPostings({'segments': [segment]}, dict_file,
+                cache_size)
+        impacts = postings.impacts if postings.has_impacts() else None
+        return (postings.doc_ids, postings.doc_length, postings.dictionary,
+                postings, impacts)
+
+    segment_postings = segments.segment_path(dict_file,
+            segment['postings_file'])
+    doc_ids, doc_length, dictionary, postings = load_index(
+            segments.segment_path(dict_file, segment['dict_file']),
+            segment_postings, cache_size)
+    impacts = load_impacts(segment_postings, dictionary, postings, cache_size)
+    return doc_ids, doc_length, dictionary, postings, impacts
+
+
+def result_key(query_terms, result_count, mode):
+    """Result cache key of weighted query terms: the vector of the terms
+    whatever their order, with the weights rounded so that the rounding
+    errors of the query normalization do not matter"""
+    vector = tuple(sorted((term, round(weight, 12))
+        for term, weight in query_terms))
+    return (vector, result_count, mode)
 
-porter = nltk.PorterStemmer()
-
-def postings_opener(postings_file, dictionary):
-    """Retriever helper function (wrapper)"""
-    def postings(term):
-        with open(postings_file, 'rb') as f:
-            try:
-                f.seek(dictionary[term][1])
-            except KeyError:
-                doc_set = set()
-            else:
-                doc_set = pickle.load(f)
-        return doc_set
-    return postings
 
 class SearchEngine(object):
-    def __init__(self, dictionary, doc_set, doc_length, postings):
+    def __init__(self, dictionary, doc_set, doc_length, postings,
+            impacts=None, budget=None, results=None, doc_count=None):
+        """
+        @impacts retriever of the impact-ordered postings, for the
+        impact mode
+        @budget maximum number of postings processed in impact mode
+        @results optional `postings.LRUCache` of the query results,
+        which must be invalidated when the index changes
+        @doc_count number of documents of the idf, counted like the df:
+        the one of a segmented postings retriever, else len(doc_set)
+        """
         self.dictionary = dictionary
         self.doc_set = doc_set
         self.postings = postings
         self.doc_length = doc_length
+        self.impacts = impacts
+        self.budget = budget
+        self.results = results
+        if doc_count is None:
+            doc_count = getattr(postings, 'doc_count', len(doc_set))
+        self.doc_count = doc_count
+        self._matrix = None
 
+    @property
+    def matrix(self):
+        """Sparse term-document matrix scorer, loaded on first use"""
+        if self._matrix is None:
+            # NumPy and SciPy are only required by the matrix mode
+            from matrix import MatrixScorer
+            self._matrix = MatrixScorer(self.dictionary, self.doc_set,
+                    self.doc_length, self.postings)
+        return self._matrix
+
+    def has_impacts(self):
+        """Whether the index has impact-ordered postings, for the impact
+        mode"""
+        return self.impacts is not None
 
     def generate_query_weighting(self, query):
         tf = collections.Counter(query)
@@ -35,7 +258,7 @@ class SearchEngine(object):
                 1 + tf[q]
                 if tf[q] > 0 else 0)
         calculate_idf = lambda q: (
-                math.log10(len(self.doc_set)/self.dictionary[q][0])
+                math.log10(self.doc_count/self.dictionary[q][0])
                 if q in self.dictionary else 0)
         calculate_weight = (
                 lambda q: calculate_log_tf(q) * calculate_idf(q))
@@ -43,21 +266,129 @@ class SearchEngine(object):
         weighted_qt = [
             (term, calculate_weight(term)) for term in query]
         sum_of_square_weight = sum(weight**2 for term,weight in weighted_qt)
+        # Queries of unknown terms, or of terms in every document, have
+        # no weight to normalize
+        norm = math.sqrt(sum_of_square_weight) or 1
         normalized_wqt = map(
-            lambda x: (x[0], x[1]/math.sqrt(sum_of_square_weight)),
+            lambda x: (x[0], x[1]/norm),
             weighted_qt)
         return normalized_wqt
 
     def tokenize(self, text):
-        terms = nltk.word_tokenize(text)
-        terms = map(lambda term: porter.stem(term).lower(), terms)
-        return terms
+        return analyzer.terms(text)
+
+    def weigh(self, query):
+        """Weighted terms of a query text"""
+        return list(self.generate_query_weighting(list(self.tokenize(query))))
+
+    def search(self, query, result_count, mode=MAXSCORE):
+        """Perform the search queries,
+        @mode MAXSCORE top-k traversal, EXHAUSTIVE scoring of every
+        document of the postings, IMPACT for the highest impacts first,
+        or MATRIX product with the term-document matrix
+        """
+        return self.search_weighted(
+                [self.weigh(query)], result_count, mode)[0]
 
-    def search(self, query, result_count):
-        """Perform the search queries"""
-        query = list(self.tokenize(query))
-        query_terms = self.generate_query_weighting(query)
+    def search_batch(self, queries, result_count, mode=MAXSCORE):
+        """Perform a batch of search queries, scored together by a
+        single matrix product in MATRIX mode"""
+        return self.search_weighted([self.weigh(query) for query in queries],
+                result_count, mode)
 
+    def search_weighted(self, batch, result_count, mode=MAXSCORE):
+        """(filename, score) results of a batch of weighted query terms,
+        from the result cache when they are in it. The cached results
+        are shared, and must not be modified by the caller."""
+        results = [None] * len(batch)
+        # Key -> positions in the batch of the queries to score, the
+        # repeated queries of the batch are only scored once
+        pending = collections.OrderedDict()
+        for i, query_terms in enumerate(batch):
+            if self.results is None:
+                pending[i] = [i]
+                continue
+            key = result_key(query_terms, result_count, mode)
+            if key in pending:
+                pending[key].append(i)
+                continue
+            results[i] = self.results.get(key)
+            if results[i] is None:
+                pending[key] = [i]
+
+        scored = self.score_batch([batch[positions[0]]
+            for positions in pending.values()], result_count, mode)
+        for (key, positions), result in zip(pending.items(), scored):
+            result = self.filenames(result)
+            results[positions[0]] = result
+            if self.results is None:
+                continue
+            self.results.put(key, result)
+            for i in positions[1:]:
+                results[i] = self.results.get(key, result)
+        return results
+
+    def score_batch(self, batch, result_count, mode=MAXSCORE):
+        """(doc ordinal, score) results of a batch of weighted query terms"""
+        if not batch:
+            return []
+        if mode == MATRIX:
+            return self.matrix.search_batch(batch, result_count)
+        return [self.score(query_terms, result_count, mode)
+                for query_terms in batch]
+
+    def score(self, query_terms, result_count, mode=MAXSCORE, stats=None):
+        """(doc ordinal, score) results of weighted query terms,
+        @stats optional dict receiving the counters of the scoring"""
+        if mode in (MAXSCORE, IMPACT) and topk.has_negative_weights(
+                query_terms):
+            # The bounds of the top-k traversals do not hold
+            mode = EXHAUSTIVE
+        if mode == MATRIX:
+            return self.matrix.search_batch([query_terms], result_count,
+                    None if stats is None else [stats])[0]
+        if mode == EXHAUSTIVE:
+            return self.score_exhaustive(query_terms, result_count, stats)
+        if mode == IMPACT:
+            if self.impacts is None:
+                raise ValueError('the index has no impact-ordered postings, '
+                        'build it with --impact-ordered')
+            return topk.score_at_a_time(query_terms, self.impacts,
+                    result_count, self.budget, stats)
+        return topk.maxscore(query_terms, self.postings,
+                self.dictionary, self.doc_length, result_count, stats)
+
+    def search_traced(self, query, result_count, tracer, mode=MAXSCORE):
+        """search() of a single query, recording its phases and counters
+        into tracer; the retrievers of the engine should be wrapped in
+        `tracing.TracedPostings`"""
+        with tracer.phase('analyze'):
+            terms = list(self.tokenize(query))
+        with tracer.phase('weigh'):
+            query_terms = list(self.generate_query_weighting(terms))
+
+        if self.results is not None:
+            key = result_key(query_terms, result_count, mode)
+            result = self.results.get(key)
+            if result is not None:
+                tracer.set(cached=True)
+                return result
+
+        stats = {}
+        with tracer.phase('score'):
+            result = self.score(query_terms, result_count, mode, stats)
+        with tracer.phase('names'):
+            result = self.filenames(result)
+        tracer.set(**stats)
+        if self.results is not None:
+            self.results.put(key, result)
+        return result
+
+    def filenames(self, result):
+        """(filename, score) of the (doc ordinal, score) results"""
+        return [(self.doc_set[doc_id], score) for doc_id, score in result]
+
+    def score_exhaustive(self, query_terms, result_count, stats=None):
         scores = collections.defaultdict(int)
         for query_term, term_query_weight in query_terms:
             for doc in self.postings(query_term):
@@ -66,39 +397,294 @@ class SearchEngine(object):
 
         normalized_scores = {doc:score/math.sqrt(self.doc_length[doc])
             for doc, score in scores.items()}
+        if stats is not None:
+            stats['candidates'] = len(scores)
 
-        sorted_scores = sorted(normalized_scores.items(), 
-                key=lambda x: x[1], reverse=True)
+        # Ties are broken by doc order
+        sorted_scores = sorted(normalized_scores.items(),
+                key=lambda x: (-x[1], x[0]))
         return sorted_scores[:result_count]
 
 
-def main(dict_file, postings_file, queries_file, output_file):
-    # Load Dictionary
-    with open(dict_file, 'rb') as f:
-        doc_id_set, doc_length, dictionary = pickle.loads(f.read())
+class ShardSearcher(object):
+    """Search engine of a shard of a sharded index, in a worker process"""
+    def __init__(self, dict_file, segment, cache_size, budget=None):
+        doc_ids, doc_length, dictionary, self.postings, self.impacts = \
+                load_segment(dict_file, segment, cache_size)
+        self.search_engine = SearchEngine(dictionary, doc_ids, doc_length,
+                self.postings, self.impacts, budget)
+
+    def score_batch(self, batch, result_count, mode, with_stats=False):
+        """(filename, score) results of the shard for a batch of weighted
+        query terms, and the scoring counters of each query when asked"""
+        search_engine = self.search_engine
+        if not with_stats:
+            scored = search_engine.score_batch(batch, result_count, mode)
+            stats = None
+        else:
+            stats = [{} for _ in batch]
+            scored = [search_engine.score(query_terms, result_count,
+                mode, query_stats)
+                for query_terms, query_stats in zip(batch, stats)]
+        return [search_engine.filenames(result) for result in scored], stats
+
+    def load_matrix(self):
+        """Load the term-document matrix of the shard, for the matrix
+        mode"""
+        self.search_engine.matrix
 
-    postings = postings_opener(postings_file, dictionary)
+    def stats(self):
+        return self.postings.stats()
 
-    # Read queries
-    with open(queries_file) as f:
-        queries = f.readlines()
+    def close(self):
+        self.postings.close()
+        if isinstance(self.impacts, PostingsReader):
+            self.impacts.close()
 
-    # Perform Queries
+
+class ShardStatistics(collections.abc.Mapping):
+    """term -> (df,) over the dictionaries of every shard"""
+    def __init__(self, dictionaries):
+        self.dictionaries = dictionaries
+
+    def __getitem__(self, term):
+        df = sum(dictionary[term][0] for dictionary in self.dictionaries
+                if term in dictionary)
+        if not df:
+            raise KeyError(term)
+        return (df,)
+
+    def __iter__(self):
+        return iter(set().union(*self.dictionaries))
+
+    def __len__(self):
+        return len(set().union(*self.dictionaries))
+
+
+class ShardedSearchEngine(SearchEngine):
+    """Coordinator of the shards of a sharded index (see shards.py).
+
+    The queries are weighted with the global df and number of documents,
+    the shards score them on their own documents in parallel, and the top
+    k of each shard are merged into the global top k. As every document
+    is in a single shard, the global top k is among them, and the merge
+    breaks the ties by doc order, so the results are the ones of a single
+    index. In impact mode, the shards rescore their top k exactly before
+    the merge, and the budget applies to each shard.
+    """
+    def __init__(self, manifest, dict_file, cache_size, budget=None,
+            results=None, processes=None):
+        """
+        @processes number of worker processes, one per shard by default,
+        0 searches the shards in this process
+        """
+        dictionaries = [termdict.load(segments.segment_path(
+            dict_file, segment['dict_file']), ARRAYS, COLUMNS)[-1]
+            for segment in manifest['segments']]
+        # Documents of the df of the shards, deleted ones included, as
+        # in SegmentedPostings
+        doc_count = sum(len(segment['docs'])
+                for segment in manifest['segments'])
+        # Only the number of documents is used by the query weighting
+        SearchEngine.__init__(self, ShardStatistics(dictionaries),
+                range(doc_count), None, None, budget=budget, results=results,
+                doc_count=doc_count)
+        self.shards = shards.ShardPool(functools.partial(ShardSearcher,
+            dict_file, cache_size=cache_size, budget=budget),
+            manifest['segments'], processes)
+        self._has_impacts = all(has_impacts(dictionary)
+                for dictionary in dictionaries)
+
+    def score_batch(self, batch, result_count, mode=MAXSCORE, stats=None):
+        """(filename, score) results of a batch of weighted query terms,
+        merged from every shard
+        @stats optional list of a dict per query, receiving the counters
+        of the scoring summed over the shards"""
+        if not batch:
+            return []
+        replies = self.shards.scatter('score_batch', batch, result_count,
+                mode, stats is not None)
+        results = []
+        for i in range(len(batch)):
+            merged = heapq.merge(*(shard_results[i]
+                for shard_results, _ in replies),
+                key=lambda result: (-result[1], doc_order(result[0])))
+            results.append(list(itertools.islice(merged, result_count)))
+        if stats is not None:
+            for _, shard_stats in replies:
+                for query_stats, counters in zip(stats, shard_stats):
+                    for key, value in counters.items():
+                        query_stats[key] = query_stats.get(key, 0) + value
+        return results
+
+    def score(self, query_terms, result_count, mode=MAXSCORE, stats=None):
+        return self.score_batch([query_terms], result_count, mode,
+                None if stats is None else [stats])[0]
+
+    @property
+    def matrix(self):
+        """The matrix mode scores every shard with its own matrix: loads
+        the matrices of the shards, which have none to return"""
+        self.shards.scatter('load_matrix')
+
+    def filenames(self, result):
+        # The shards return filenames
+        return result
+
+    def has_impacts(self):
+        return self._has_impacts
+
+    def stats(self):
+        """Postings cache counters summed over the shards"""
+        stats = self.shards.scatter('stats')
+        return {key: sum(stat[key] for stat in stats)
+                for key in ('hits', 'misses', 'evictions', 'bytes_read')}
+
+    def close(self):
+        self.shards.close()
+
+
+def compare_scoring(search_engine, queries, result_count, mode):
+    """Check that the search mode and exhaustive scoring return the same
+    results, and report their scoring latencies, without result cache.
+    The query weights are checked as well: a negative weight means that
+    the df and the number of documents of the idf were not counted over
+    the same documents, e.g. after an incremental update."""
+    latencies = {EXHAUSTIVE: 0.0, mode: 0.0}
+    mismatches = 0
+    negatives = 0
+    for query in queries:
+        query_terms = search_engine.weigh(query)
+        negative = sorted({term for term, weight in query_terms
+                if weight < 0})
+        if negative:
+            negatives += 1
+            print("Negative weights for query: {} ({})".format(
+                query.strip(), ', '.join(negative)))
+        results = {}
+        for compared in (EXHAUSTIVE, mode):
+            start = time.perf_counter()
+            results[compared] = search_engine.score(
+                    query_terms, result_count, mode=compared)
+            latencies[compared] += time.perf_counter() - start
+        if ([doc_id for doc_id, _ in results[EXHAUSTIVE]] !=
+                [doc_id for doc_id, _ in results[mode]]):
+            mismatches += 1
+            print("Different results for query: {}".format(query.strip()))
+    print("Exhaustive: {:.4f}s, {}: {:.4f}s, {} different results "
+            "out of {} queries, {} with negative weights".format(
+                latencies[EXHAUSTIVE], mode, latencies[mode], mismatches,
+                len(queries), negatives))
+
+
+def search_traced(search_engine, queries, result_count, mode, tracer):
+    """Search the queries one at a time, tracing each of them"""
+    if mode == MATRIX:
+        # Loaded before the first query, outside of its trace
+        search_engine.matrix
     results = []
     for query in queries:
-        search_engine = SearchEngine(dictionary, doc_id_set, doc_length, postings)
-        result = search_engine.search(query, result_count=10)
+        tracer.begin(query)
+        result = search_engine.search_traced(query, result_count, tracer, mode)
+        tracer.end(results=len(result))
         results.append(result)
+    return results
+
+
+def format_result(result):
+    """Output line of the (filename, score) results of a query"""
+    return ' '.join(str(int(filename)) for filename, _ in result)
+
+
+def main(dict_file, postings_file, queries_file, output_file,
+        cache_size=64, mode=MAXSCORE, compare=False, budget=None,
+        result_cache_size=16, result_cache_ttl=None, trace_file=None,
+        shard_workers=None, jobs=1, error=None):
+    """
+    @error reports an invalid combination of the arguments, like
+    ArgumentParser.error, raises ValueError by default
+    """
+    if error is None:
+        def error(message):
+            raise ValueError(message)
+
+    result_cache = (LRUCache(result_cache_size * 1024 * 1024,
+        ttl=result_cache_ttl) if result_cache_size > 0 else None)
 
-    # Store Result
-    with open(output_file, 'w') as f:
-        for result in results:
-            result = (int(i[0]) for i in result)
-            x = ' '.join(str(doc_id) for doc_id in result)
-            f.write(x + '\n')
+    # Load Dictionary
+    index = termdict.load(dict_file, ARRAYS, COLUMNS)
+    if segments.is_manifest(index) and segments.is_sharded(index):
+        readers = []
+        tracer = tracing.open_tracer(trace_file)
+        search_engine = ShardedSearchEngine(index, dict_file,
+                cache_size * 1024 * 1024, budget, result_cache,
+                shard_workers)
+    else:
+        doc_ids, doc_length, dictionary, postings = load_index(
+                dict_file, postings_file, cache_size * 1024 * 1024, index)
+        impacts = load_impacts(postings_file, dictionary, postings,
+                cache_size * 1024 * 1024)
+        readers = [postings]
+        if isinstance(impacts, PostingsReader):
+            readers.append(impacts)
+        tracer = tracing.open_tracer(trace_file, readers)
+        if tracer is not None:
+            postings = tracing.TracedPostings(postings, tracer)
+            if impacts is not None:
+                impacts = tracing.TracedPostings(impacts, tracer)
+        search_engine = SearchEngine(dictionary, doc_ids, doc_length,
+                postings, impacts, budget, result_cache)
+
+    if mode == IMPACT and not search_engine.has_impacts():
+        error('the impact mode requires an index built with '
+                '--impact-ordered or --champions')
+    if jobs > 1:
+        if not readers:
+            error('--jobs does not apply to a sharded index, '
+                    'its shards are searched by --shard-workers')
+        if tracer is not None:
+            error('--jobs cannot be combined with tracing')
+        if mode == MATRIX:
+            # Loaded before the fork, shared by the workers
+            search_engine.matrix
+
+    # Queries are read and results written as the batch goes
+    with open(queries_file) as queries, open(output_file, 'w') as f:
+        if compare:
+            queries = queries.readlines()
+            compare_scoring(search_engine, queries, 10, mode)
+        if tracer is None:
+            search = lambda queries: search_engine.search_batch(
+                    queries, 10, mode)
+        else:
+            search = lambda queries: search_traced(
+                    search_engine, queries, 10, mode, tracer)
+        throughput = batch.Throughput()
+        count = batch.run(lambda queries: [format_result(result)
+                for result in search(queries)],
+                queries, lambda line: f.write(line + '\n'), jobs)
+
+    if readers:
+        for reader in readers:
+            reader.close()
+        postings_stats = readers[0].stats()
+    else:
+        postings_stats = search_engine.stats()
+        search_engine.close()
+    if jobs <= 1:
+        # The caches of forked workers are not reported back
+        print("Postings cache: {hits} hits, {misses} misses, "
+                "{evictions} evictions".format(**postings_stats))
+        if result_cache is not None:
+            print("Result cache: {hits} hits, {misses} misses, "
+                    "{hit_rate:.1%} hit rate".format(**result_cache.stats()))
+    if tracer is not None:
+        print("Traced {queries} queries: {seconds:.4f}s, "
+                "p95 {latency_p95_ms:.2f} ms".format(**tracer.close()))
+    print(throughput.report(count, jobs))
         
 
-def _getCommandArgs():
+def _getCommandParser():
     parser = argparse.ArgumentParser(description='Document search')
     parser.add_argument('-d', dest='dict_file', required=True,
             help='directory file')
@@ -108,9 +694,159 @@ def _getCommandArgs():
             help='queries file')
     parser.add_argument('-o', dest='output_file', required=True,
             help='search result output file')
-    return parser.parse_args()
+    parser.add_argument('--cache-size', dest='cache_size', type=int,
+            default=64, help='decoded postings cache size in MB')
+    parser.add_argument('--mode', dest='mode', choices=MODES,
+            default=MAXSCORE,
+            help='MaxScore top-k traversal, exhaustive scoring, highest '
+            'impacts first on an index built with --impact-ordered, or '
+            'sparse matrix product of each batch of queries (NumPy and SciPy)')
+    parser.add_argument('--budget', dest='budget', type=int,
+            help='maximum number of postings processed per query '
+            'in impact mode')
+    parser.add_argument('--result-cache-size', dest='result_cache_size',
+            type=int, default=16,
+            help='cache size in MB of the query results, 0 disables it')
+    parser.add_argument('--result-cache-ttl', dest='result_cache_ttl',
+            type=float, help='lifetime in seconds of the cached results')
+    parser.add_argument('--compare', action='store_true',
+            help='compare the results and latencies of the search mode '
+            'and exhaustive scoring before the search')
+    parser.add_argument('--shard-workers', dest='shard_workers', type=int,
+            help='number of processes searching the shards of a sharded '
+            'index, one per shard by default, 0 searches them in this '
+            'process')
+    parser.add_argument('--trace', dest='trace_file', nargs='?', const='-',
+            help='write a JSON line of timings and counters per query to '
+            'this file, or to stderr, also enabled by the {} environment '
+            'variable'.format(tracing.ENVIRONMENT))
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+            help='number of processes searching the queries, forked once '
+            'the index is loaded')
+    return parser
+
+
+
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+class IndexTestCase(unittest.TestCase):
+    docs = {
+        '1': 'The bank raised its rates.',
+        '2': 'Oil prices fell as the bank cut rates.',
+        '3': 'Wheat and corn exports rose.',
+        '4': 'The central bank kept oil reserves.',
+        '5': 'Corn prices rose on weak exports.',
+        '6': 'Rates of the bank rose again.',
+    }
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.doc_dir = os.path.join(self.tmp_dir, 'docs')
+        os.mkdir(self.doc_dir)
+        for doc, text in self.docs.items():
+            self.write_doc(doc, text)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_doc(self, doc, text):
+        with open(os.path.join(self.doc_dir, doc), 'w') as f:
+            f.write(text)
+
+    def build(self, name, function, *args):
+        dict_file = os.path.join(self.tmp_dir, name + '.dict')
+        postings_file = os.path.join(self.tmp_dir, name + '.post')
+        with contextlib.redirect_stdout(io.StringIO()):
+            function(*(args + (dict_file, postings_file)))
+        return dict_file, postings_file
+
+    def engine(self, dict_file, postings_file):
+        doc_ids, doc_length, dictionary, postings = load_index(
+                dict_file, postings_file, 1024 * 1024)
+        self.addCleanup(postings.close)
+        return SearchEngine(dictionary, doc_ids, doc_length, postings)
+
+
+
+class TestIncrementalIndex(IndexTestCase):
+    def idf(self, engine):
+        return {term: math.log10(engine.doc_count / engine.dictionary[term][0])
+                for term in engine.dictionary}
+
+    def test_idf_after_deletions(self):
+        import index
+        segmented = self.build('segmented', index.update, self.doc_dir)
+        os.remove(os.path.join(self.doc_dir, '2'))
+        os.remove(os.path.join(self.doc_dir, '5'))
+        self.write_doc('4', 'The central bank sold its oil reserves.')
+        self.write_doc('7', 'Wheat exports of the bank.')
+        self.build('segmented', index.update, self.doc_dir)
+        full = self.engine(*self.build('full', index.main, self.doc_dir))
+
+        # The deleted documents count in the df and in the number of
+        # documents alike, until the segments are merged
+        engine = self.engine(*segmented)
+        self.assertEqual(len(engine.doc_set), len(full.doc_set))
+        self.assertEqual(engine.doc_count, full.doc_count + 3)
+        for term, idf in self.idf(engine).items():
+            self.assertGreaterEqual(idf, 0, term)
+
+        self.build('segmented', index.merge)
+        merged = self.engine(*segmented)
+        self.assertEqual(merged.doc_count, full.doc_count)
+        self.assertEqual(self.idf(merged), self.idf(full))
+        for query in ('bank rates', 'oil exports', 'corn wheat prices'):
+            self.assertEqual(merged.search(query, 10, EXHAUSTIVE),
+                    full.search(query, 10, EXHAUSTIVE))
+
+
+class TestShardedSearch(IndexTestCase):
+    queries = ['bank rates', 'oil exports', 'corn wheat prices', 'gold']
+
+    def test_traced_search(self):
+        import index
+        dict_file, _ = self.build('sharded',
+                lambda dict_file, postings_file: index.build_shards(
+                    self.doc_dir, sorted(self.docs), dict_file,
+                    postings_file, 3, impact_ordered=True))
+        full = self.engine(*self.build('full', index.main, self.doc_dir))
+        expected = full.search_batch(self.queries, 10, EXHAUSTIVE)
+
+        sharded = ShardedSearchEngine(segments.load_manifest(dict_file),
+                dict_file, 1024 * 1024, processes=0)
+        self.addCleanup(sharded.close)
+        modes = [mode for mode in MODES if mode != MATRIX
+                or importlib.util.find_spec('scipy') is not None]
+        for mode in modes:
+            with self.subTest(mode=mode):
+                output = io.StringIO()
+                tracer = tracing.Tracer(output)
+                results = search_traced(sharded, self.queries, 10, mode,
+                        tracer)
+                self.assertEqual([[doc for doc, _ in result]
+                        for result in results],
+                    [[doc for doc, _ in result] for result in expected])
+                for result, expected_result in zip(results, expected):
+                    for (_, score), (_, expected_score) in zip(
+                            result, expected_result):
+                        self.assertAlmostEqual(score, expected_score)
+                records = [json.loads(line)
+                        for line in output.getvalue().splitlines()]
+                self.assertEqual([record['query'] for record in records],
+                        self.queries)
+
 
 if __name__ == '__main__':
-    args = _getCommandArgs()
+    parser = _getCommandParser()
+    args = parser.parse_args()
     main(args.dict_file, args.postings_file,
-        args.queries_file, args.output_file)
+        args.queries_file, args.output_file, args.cache_size,
+        args.mode, args.compare, args.budget,
+        args.result_cache_size, args.result_cache_ttl, args.trace_file,
+        args.shard_workers, args.jobs, parser.error)
@@ -0,0 +1 @@
+../2/segments.py
\ No newline at end of file
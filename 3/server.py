@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import argparse
+
+import search
+import segments
+from postings import LRUCache
+from queryserver import QueryServer, add_server_arguments
+
+
+class RankedQueryHandler(object):
+    """Ranked queries against an index loaded once, and reloaded when
+    the dictionary file changes"""
+    def __init__(self, dict_file, postings_file, cache_size=64,
+            result_cache_size=16, result_cache_ttl=None):
+        self.dict_file = dict_file
+        self.postings_file = postings_file
+        self.cache_size = cache_size * 1024 * 1024
+        self.results = (LRUCache(result_cache_size * 1024 * 1024,
+            ttl=result_cache_ttl) if result_cache_size > 0 else None)
+        self.load()
+
+    def load(self):
+        self.signature = segments.signature(self.dict_file)
+        doc_ids, doc_length, dictionary, self.postings = search.load_index(
+                self.dict_file, self.postings_file, self.cache_size)
+        self.search_engine = search.SearchEngine(
+                dictionary, doc_ids, doc_length, self.postings,
+                results=self.results)
+
+    def reload_if_changed(self):
+        if segments.signature(self.dict_file) == self.signature:
+            return
+        self.postings.close()
+        if self.results is not None:
+            self.results.invalidate()
+        self.load()
+
+    def __call__(self, request):
+        self.reload_if_changed()
+        result_count = request.get('result_count', 10)
+        return [[doc_id, score] for doc_id, score in
+                self.search_engine.search(request['query'], result_count)]
+
+    def stats(self):
+        stats = {'postings_cache': self.postings.stats()}
+        if self.results is not None:
+            stats['result_cache'] = self.results.stats()
+        return stats
+
+
+def main(dict_file, postings_file, host, port, unix_socket, **options):
+    handler = RankedQueryHandler(dict_file, postings_file, **options)
+    QueryServer(handler).run(host, port, unix_socket)
+
+
+def _getCommandArgs():
+    parser = argparse.ArgumentParser(description='Ranked search server')
+    parser.add_argument('-d', dest='dict_file', required=True,
+            help='directory file')
+    parser.add_argument('-p', dest='postings_file', required=True,
+            help='postings file')
+    parser.add_argument('--cache-size', dest='cache_size', type=int,
+            default=64, help='decoded postings cache size in MB')
+    parser.add_argument('--result-cache-size', dest='result_cache_size',
+            type=int, default=16,
+            help='cache size in MB of the query results, 0 disables it')
+    parser.add_argument('--result-cache-ttl', dest='result_cache_ttl',
+            type=float, help='lifetime in seconds of the cached results')
+    add_server_arguments(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _getCommandArgs()
+    main(args.dict_file, args.postings_file, args.host, args.port,
+            args.unix_socket, cache_size=args.cache_size,
+            result_cache_size=args.result_cache_size,
+            result_cache_ttl=args.result_cache_ttl)
@@ -0,0 +1 @@
+../2/shards.py
\ No newline at end of file
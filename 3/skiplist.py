@@ -1,70 +1,151 @@
+import bisect
 import collections.abc
+import functools
+import sys
+
+
+def _gallop(data, target, lo=0):
+    """Index of the first element >= target in data[lo:],
+    exponential search followed by a binary search"""
+    n = len(data)
+    step = 1
+    hi = lo
+    while hi < n and data[hi] < target:
+        lo = hi + 1
+        hi += step
+        step <<= 1
+    return bisect.bisect_left(data, target, lo, min(hi, n))
 
 
 class SkipList(collections.abc.MutableSet, collections.abc.Sequence):
-    def __init__(self, data):
-        self._data = list(data)
+    """Sorted list of unique elements backed by a python list.
+
+    Instead of explicit skip pointers, the set operations skip over the
+    list with galloping (exponential) search, so they cost
+    O(m log(n/m)) for lists of size m <= n, and whole runs of elements
+    are copied as slices.
+    """
+    def __init__(self, data=()):
+        self._data = sorted(set(data))
+
+    @classmethod
+    def from_sorted(cls, data):
+        """Build from data already sorted without duplicate"""
+        skiplist = cls.__new__(cls)
+        skiplist._data = list(data)
+        return skiplist
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return cls(iterable)
 
     def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SkipList.from_sorted(self._data[index])
         return self._data[index]
 
     def __contains__(self, item):
-        return item in self._data
+        i = bisect.bisect_left(self._data, item)
+        return i < len(self._data) and self._data[i] == item
 
     def __iter__(self):
-        for element in self._data:
-            yield element
+        return iter(self._data)
 
     def __or__(self, l2):
+        if not isinstance(l2, SkipList):
+            return NotImplemented
+        p1, p2 = self._data, l2._data
         result = []
-        p1, p2 = iter(self), iter(l2)
-        cur_p1, cur_p2 = next(p1, None), next(p2, None)
-
-        while cur_p1 is not None or cur_p2 is not None:
-            if cur_p1 is None:
-                result+=[cur_p2]
-                cur_p2 = next(p2, None)
-            elif cur_p2 is None:
-                result+=[cur_p1]
-                cur_p1 = next(p1, None)
-            elif cur_p1 < cur_p2:
-                result+=[cur_p1]
-                cur_p1 = next(p1, None)
-            elif cur_p1 > cur_p2:
-                result+=[cur_p2]
-                cur_p2 = next(p2, None)
+        i, j = 0, 0
+        while i < len(p1) and j < len(p2):
+            if p1[i] < p2[j]:
+                k = _gallop(p1, p2[j], i)
+                result += p1[i:k]
+                i = k
+            elif p1[i] > p2[j]:
+                k = _gallop(p2, p1[i], j)
+                result += p2[j:k]
+                j = k
             else:
-                result+=[cur_p1]
-                cur_p1 = next(p1, None)
-                cur_p2 = next(p2, None)
-        return SkipList(result)
+                result.append(p1[i])
+                i += 1
+                j += 1
+        result += p1[i:]
+        result += p2[j:]
+        return SkipList.from_sorted(result)
 
     def __and__(self, l2):
+        if not isinstance(l2, SkipList):
+            return NotImplemented
+        p1, p2 = self._data, l2._data
         result = []
-        p1, p2 = iter(self), iter(l2)
-        cur_p1, cur_p2 = next(p1, None), next(p2, None)
-
-        while cur_p1 is not None and cur_p2 is not None:
-            if cur_p1 == cur_p2:
-                result+=[cur_p1]
-
-                cur_p1 = next(p1, None)
-                cur_p2 = next(p2, None)
+        i, j = 0, 0
+        while i < len(p1) and j < len(p2):
+            if p1[i] < p2[j]:
+                i = _gallop(p1, p2[j], i)
+            elif p1[i] > p2[j]:
+                j = _gallop(p2, p1[i], j)
             else:
-                if cur_p1 < cur_p2:
-                    cur_p1 = next(p1, None)
-                else:
-                    cur_p2 = next(p2, None)
-        return SkipList(result)
+                result.append(p1[i])
+                i += 1
+                j += 1
+        return SkipList.from_sorted(result)
+
+    def __sub__(self, l2):
+        if not isinstance(l2, SkipList):
+            return NotImplemented
+        p1, p2 = self._data, l2._data
+        result = []
+        i, j = 0, 0
+        while i < len(p1) and j < len(p2):
+            if p1[i] < p2[j]:
+                k = _gallop(p1, p2[j], i)
+                result += p1[i:k]
+                i = k
+            elif p1[i] > p2[j]:
+                j = _gallop(p2, p1[i], j)
+            else:
+                i += 1
+                j += 1
+        result += p1[i:]
+        return SkipList.from_sorted(result)
 
     def __len__(self):
         return len(self._data)
 
-    def add(self):
-        pass
+    def __sizeof__(self):
+        return (object.__sizeof__(self) + sys.getsizeof(self._data)
+                + sum(map(sys.getsizeof, self._data)))
+
+    def __repr__(self):
+        return 'SkipList({})'.format(self._data)
+
+    def add(self, item):
+        i = bisect.bisect_left(self._data, item)
+        if i == len(self._data) or self._data[i] != item:
+            self._data.insert(i, item)
+
+    def discard(self, item):
+        i = bisect.bisect_left(self._data, item)
+        if i < len(self._data) and self._data[i] == item:
+            del self._data[i]
 
-    def discard(self):
-        pass
+
+def intersect_all(*lists):
+    """N-way intersection, starting from the smallest list"""
+    lists = sorted(lists, key=len)
+    result = lists[0]
+    for l in lists[1:]:
+        if not result:
+            break
+        result = result & l
+    return result
+
+
+def union_all(*lists):
+    """N-way union, merging the smallest lists first"""
+    return functools.reduce(
+            lambda l1, l2: l1 | l2, sorted(lists, key=len))
 
 
 
@@ -78,21 +159,45 @@ class TestSkipList(unittest.TestCase):
 
         self.union_prime_fibprime = list(set(prime) | set(fibprime))
         self.intersect_prime_fibprime = list(set(prime) & set(fibprime))
+        self.difference_prime_fibprime = list(set(prime) - set(fibprime))
 
         # SkipList Setup
         self.l1 = SkipList(prime)
         self.l2 = SkipList(fibprime)
 
     def test_union(self):
-        l3 = self.l1 | self.l2 
+        l3 = self.l1 | self.l2
         self.assertSequenceEqual(l3, SkipList(self.union_prime_fibprime))
 
 
     def test_intersect(self):
-        l3 = self.l1 & self.l2 
+        l3 = self.l1 & self.l2
         self.assertSequenceEqual(l3, SkipList(self.intersect_prime_fibprime))
 
-        
+    def test_difference(self):
+        l3 = self.l1 - self.l2
+        self.assertSequenceEqual(l3, SkipList(self.difference_prime_fibprime))
+
+    def test_intersect_all(self):
+        l3 = intersect_all(self.l1, self.l2, SkipList([3, 131, 500]))
+        self.assertSequenceEqual(l3, SkipList([3, 131]))
+
+    def test_union_all(self):
+        l3 = union_all(self.l1, self.l2, SkipList([1, 500]))
+        self.assertSequenceEqual(
+                l3, SkipList(self.union_prime_fibprime + [1, 500]))
+
+    def test_contains(self):
+        self.assertIn(359, self.l1)
+        self.assertNotIn(360, self.l1)
+
+    def test_add_discard(self):
+        self.l1.add(4)
+        self.l1.add(4)
+        self.l1.discard(3)
+        self.assertSequenceEqual(self.l1[:3], SkipList([4, 17, 37]))
+
+
 
 if __name__ == '__main__':
     unittest.main()
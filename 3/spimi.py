@@ -0,0 +1 @@
+../2/spimi.py
\ No newline at end of file
@@ -0,0 +1 @@
+../2/termdict.py
\ No newline at end of file
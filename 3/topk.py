@@ -0,0 +1,478 @@
+"""Top-k retrieval without scoring every document.
+
+The score of a document is sum(w_tq * w_td) / sqrt(doc_length), and the
+index records for every term its maximum impact max(w_td / sqrt(doc_length)),
+so w_tq * max impact bounds the contribution of a query term.
+
+`maxscore` traverses the postings document at a time, in doc order, and
+keeps the k best documents in a heap. Terms are sorted by their bound;
+the lists whose cumulated bounds cannot reach the current k-th score are
+non-essential: their documents are never candidates, and they are only
+probed for candidates of the essential lists while the candidate can
+still enter the heap.
+
+Scores are summed in the order of the query terms, like the exhaustive
+scoring, and ties are broken by doc order, so the results are identical.
+
+Both traversals bound the contributions still to come by their
+maximum, which only holds for non-negative query weights: they raise
+ValueError for negative ones, which must be scored exhaustively.
+
+`score_at_a_time` works on impact-ordered postings instead, lists of
+(doc_id, w_td / sqrt(doc_length)) by descending impact, which may be
+truncated to champion lists of the best documents of each term. The
+blocks of postings with the highest contributions are processed first,
+and the traversal stops once the remaining contributions cannot change
+which documents are in the top k, or after a budget of postings. A
+document can only gain from the lists it was not scored from yet, up
+to the next contribution of each of them. The k-th score is kept in a
+heap as the scores grow, and once unseen documents cannot reach it, only
+the documents that still can are checked again. At the stop, the top k
+are rescored from the impact lists already fetched, looking each of
+them up in the lists it was not scored from, and the contributions are
+summed in the order of the query terms: the results are the ones of the
+exhaustive scoring, up to the rounding of the impacts.
+
+With a budget, the top k are the best documents of the postings
+processed, and their scores are still exact. Champion lists drop the
+other documents of the terms, from the top k and from the scores: the
+results are approximate, e.g. 142 of the 200 queries of the bench
+differ from the exhaustive scoring with --champions 50.
+"""
+
+import array
+import heapq
+import math
+
+# Fields of the dictionary entries: location of the impact-ordered
+# postings when the index has them, and max impact, the last field, from
+# the column of the dictionary file (see termdict.py)
+IMPACT_FIELDS = (3, 4)
+MAX_IMPACT = -1
+
+# Safety margin of the bounds against floating point rounding
+_MARGIN = 1 + 1e-9
+
+# Postings processed between two checks of the top k
+BLOCK_SIZE = 64
+
+
+def max_impact(doc_list, doc_length):
+    """Maximum normalized weight of a postings list"""
+    return max((weight / math.sqrt(doc_length[doc_id])
+            for doc_id, weight in doc_list), default=0.0)
+
+
+def impact_order(doc_list, doc_length, champions=None):
+    """(doc_id, impact) postings by descending impact, ties in doc order,
+    only the `champions` first ones when given"""
+    impacts = [(doc_id, weight / math.sqrt(doc_length[doc_id]))
+            for doc_id, weight in doc_list]
+    impacts.sort(key=lambda posting: -posting[1])
+    return impacts[:champions] if champions else impacts
+
+
+def has_negative_weights(query_terms):
+    """Whether the weighted query terms break the bounds of the top-k
+    traversals"""
+    return any(weight < 0 for _, weight in query_terms)
+
+
+def _check_weights(query_terms):
+    if has_negative_weights(query_terms):
+        raise ValueError('top-k retrieval requires non-negative query '
+                'weights')
+
+
+def _gallop(postings, target, lo):
+    """Index of the first posting of doc ordinal >= target in postings[lo:]"""
+    n = len(postings)
+    step = 1
+    hi = lo
+    while hi < n and postings[hi][0] < target:
+        lo = hi + 1
+        hi += step
+        step <<= 1
+    hi = min(hi, n)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if postings[mid][0] < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def maxscore(query_terms, postings, dictionary, doc_length, result_count,
+        stats=None):
+    """Top result_count (doc_id, score) of the weighted query terms
+    @postings term -> postings list retriever, lists sorted by doc ordinal
+    @dictionary entries with the max impact of the term
+    @stats optional dict receiving the number of candidates and of
+    fully scored documents
+    """
+    if result_count <= 0:
+        return []
+    _check_weights(query_terms)
+
+    # Total query weight of each distinct term
+    query_weight = {}
+    for term, weight in query_terms:
+        query_weight[term] = query_weight.get(term, 0) + weight
+
+    terms = [term for term in query_weight if term in dictionary]
+    bound = {term: query_weight[term] * dictionary[term][MAX_IMPACT] for term in terms}
+    terms.sort(key=lambda term: bound[term])
+    lists = [postings(term) for term in terms]
+    cursors = [0] * len(terms)
+
+    # cumulated[i] bounds the score from terms[:i + 1]
+    cumulated = []
+    total = 0.0
+    for term in terms:
+        total += bound[term]
+        cumulated.append(total * _MARGIN)
+
+    heap = []
+    threshold = -1.0
+    visited = 0
+    pruned_count = 0
+    essential = 0
+    while True:
+        # Lists whose cumulated bound cannot beat the threshold
+        while essential < len(terms) and cumulated[essential] <= threshold:
+            essential += 1
+
+        candidate = None
+        for i in range(essential, len(terms)):
+            if cursors[i] < len(lists[i]):
+                doc_id = lists[i][cursors[i]][0]
+                if candidate is None or doc_id < candidate:
+                    candidate = doc_id
+        if candidate is None:
+            break
+
+        doc_weights = {}
+        doc_id = candidate
+        for i in range(essential, len(terms)):
+            if cursors[i] < len(lists[i]):
+                posting = lists[i][cursors[i]]
+                if posting[0] == candidate:
+                    doc_weights[terms[i]] = posting[1]
+                    cursors[i] += 1
+
+        norm = math.sqrt(doc_length[doc_id])
+        upper = sum(query_weight[term] * weight
+                for term, weight in doc_weights.items()) / norm
+
+        # Probe the non-essential lists, from the highest bound
+        pruned = False
+        for i in range(essential - 1, -1, -1):
+            if (upper + cumulated[i]) * _MARGIN <= threshold:
+                pruned = True
+                break
+            cursors[i] = _gallop(lists[i], candidate, cursors[i])
+            if cursors[i] < len(lists[i]):
+                posting = lists[i][cursors[i]]
+                if posting[0] == candidate:
+                    doc_weights[terms[i]] = posting[1]
+                    upper += query_weight[terms[i]] * posting[1] / norm
+        if pruned:
+            pruned_count += 1
+            continue
+
+        score = 0
+        for term, weight in query_terms:
+            if term in doc_weights:
+                score += doc_weights[term] * weight
+        score = score / norm
+
+        # Earlier documents win the ties
+        visited += 1
+        entry = (score, -visited, doc_id)
+        if len(heap) < result_count:
+            heapq.heappush(heap, entry)
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+        if len(heap) == result_count:
+            threshold = heap[0][0]
+
+    if stats is not None:
+        stats.update(candidates=visited + pruned_count, scored=visited)
+    heap.sort(reverse=True)
+    return [(doc_id, score) for score, _, doc_id in heap]
+
+
+def _ordinals(postings):
+    """Doc ordinals of postings, in a sequence searched by index()"""
+    doc_ids = getattr(postings, 'doc_ids', None)
+    if doc_ids is None:
+        return [doc_id for doc_id, _ in postings]
+    return array.array('I', doc_ids)
+
+
+def _reaches(score, seen, remaining, kth):
+    """Whether a document can still reach the k-th score, with the
+    contributions still to come from the lists it was not scored from
+    (bit i of `seen` for list i)"""
+    gain = sum(bound for i, bound in enumerate(remaining)
+            if not seen >> i & 1)
+    return (score + gain) * _MARGIN >= kth
+
+
+def score_at_a_time(query_terms, impacts, result_count, budget=None,
+        stats=None):
+    """Top result_count (doc_id, score) of the weighted query terms,
+    processing the postings by decreasing contribution
+    @impacts term -> impact-ordered postings retriever
+    @budget maximum number of postings processed
+    @stats optional dict receiving the number of candidates, of
+    postings processed, of documents examined by the stop test, and of
+    lookups of the rescoring
+    """
+    if result_count <= 0:
+        return []
+    _check_weights(query_terms)
+
+    query_weight = {}
+    for term, weight in query_terms:
+        query_weight[term] = query_weight.get(term, 0) + weight
+
+    terms = list(query_weight)
+    lists = [(query_weight[term], impacts(term)) for term in terms]
+    cursors = [0] * len(lists)
+
+    # Next block of each list, by its highest contribution
+    blocks = [(-weight * postings[0][1], i)
+            for i, (weight, postings) in enumerate(lists) if postings]
+    heapq.heapify(blocks)
+    # Highest contribution still to come from each list
+    remaining = [0.0] * len(lists)
+    for contribution, i in blocks:
+        remaining[i] = -contribution
+
+    accumulators = {}
+    # Bit i of a document is set once it is scored from list i
+    seen = {}
+    # Documents of the top k, and min-heap of their (score, -doc_id),
+    # whose entries are stale once the document left the top k or its
+    # score grew: the top of the heap is the k-th once they are dropped
+    top = set()
+    heap = []
+    # Documents below the k-th that may still reach it, by increasing
+    # score, collected once the unseen documents no longer can, None
+    # before
+    threats = None
+    processed = 0
+    examined = 0
+    while blocks:
+        _, i = heapq.heappop(blocks)
+        weight, postings = lists[i]
+        start = cursors[i]
+        end = min(start + BLOCK_SIZE, len(postings))
+        bit = 1 << i
+        for doc_id, impact in postings[start:end]:
+            score = accumulators.get(doc_id, 0.0) + weight * impact
+            accumulators[doc_id] = score
+            seen[doc_id] = seen.get(doc_id, 0) | bit
+            if doc_id in top or len(top) < result_count:
+                top.add(doc_id)
+                heapq.heappush(heap, (score, -doc_id))
+                continue
+            while (-heap[0][1] not in top
+                    or accumulators[-heap[0][1]] != heap[0][0]):
+                heapq.heappop(heap)
+            # Ties are won by the earlier documents
+            if (score, -doc_id) > heap[0]:
+                _, evicted = heapq.heapreplace(heap, (score, -doc_id))
+                top.remove(-evicted)
+                top.add(doc_id)
+                if threats is not None:
+                    threats.append(-evicted)
+        cursors[i] = end
+        processed += end - start
+        if end < len(postings):
+            remaining[i] = weight * postings[end][1]
+            heapq.heappush(blocks, (-remaining[i], i))
+        else:
+            remaining[i] = 0.0
+
+        if budget is not None and processed >= budget:
+            break
+        if len(top) < result_count:
+            continue
+        while (-heap[0][1] not in top
+                or accumulators[-heap[0][1]] != heap[0][0]):
+            heapq.heappop(heap)
+        kth = heap[0][0]
+        if threats is None:
+            # Unseen documents may gain from every list, or tie with a
+            # k-th score of 0
+            total = sum(remaining)
+            if kth <= total * _MARGIN:
+                continue
+            # From now on, a document scored for the first time cannot
+            # reach the k-th: its score and the contributions still to
+            # come add up to at most the total above
+            threats = sorted((doc_id for doc_id, score in accumulators.items()
+                    if doc_id not in top and (score + total) * _MARGIN >= kth),
+                    key=accumulators.get)
+            examined += len(accumulators)
+        # The score of a document plus the contributions it can still get
+        # never grows, while the k-th score never drops: a document that
+        # cannot reach the k-th is dropped for good, and the stop only
+        # waits for the last threat to be dropped
+        while threats:
+            doc_id = threats[-1]
+            examined += 1
+            if doc_id not in top and _reaches(accumulators[doc_id],
+                    seen[doc_id], remaining, kth):
+                break
+            threats.pop()
+        if not threats:
+            break
+
+    # Impacts of the top k: a document is in the processed part of the
+    # lists it was scored from, and may be in the rest of the others
+    impact = {}
+    lookups = 0
+    for i, (term, (_, postings)) in enumerate(zip(terms, lists)):
+        doc_ids = None
+        for doc_id in top:
+            scored = seen[doc_id] >> i & 1
+            if not scored and cursors[i] == len(postings):
+                continue
+            if doc_ids is None:
+                doc_ids = _ordinals(postings)
+            lookups += 1
+            try:
+                if scored:
+                    j = doc_ids.index(doc_id, 0, cursors[i])
+                else:
+                    j = doc_ids.index(doc_id, cursors[i])
+            except ValueError:
+                continue
+            impact[doc_id, term] = postings[j][1]
+
+    results = []
+    for doc_id in top:
+        score = 0
+        for term, weight in query_terms:
+            if (doc_id, term) in impact:
+                score += weight * impact[doc_id, term]
+        results.append((doc_id, score))
+
+    if stats is not None:
+        stats.update(candidates=len(accumulators), processed=processed,
+                examined=examined, lookups=lookups)
+    results.sort(key=lambda result: (-result[1], result[0]))
+    return results
+
+
+
+import random
+import unittest
+class TestTopK(unittest.TestCase):
+    def setUp(self):
+        # Term frequencies of 12 documents, 2 and 11 are the same
+        self.doc_length = [3, 5, 2, 8, 4, 6, 1, 7, 3, 5, 9, 2]
+        tfs = {
+            'apple': {0: 1, 1: 2, 3: 1, 4: 3, 7: 1, 9: 1, 10: 4},
+            'banana': {1: 1, 2: 2, 5: 1, 8: 3, 11: 2},
+            'cherry': {0: 2, 3: 5, 6: 1, 10: 1},
+            'date': {4: 1, 7: 2, 9: 1},
+        }
+        self.postings = {term: [(doc_id, 1 + math.log10(tf))
+                for doc_id, tf in sorted(doc_tfs.items())]
+                for term, doc_tfs in tfs.items()}
+        self.dictionary = {term: (len(doc_list), None, None,
+                max_impact(doc_list, self.doc_length))
+                for term, doc_list in self.postings.items()}
+        self.impacts = {term: impact_order(doc_list, self.doc_length)
+                for term, doc_list in self.postings.items()}
+        self.queries = [
+            [('apple', 0.5)],
+            [('apple', 0.3), ('banana', 0.6), ('cherry', 0.2)],
+            [('banana', 0.7), ('date', 0.1), ('banana', 0.2)],
+            [('cherry', 0.4), ('date', 0.9), ('fig', 0.5)],
+        ]
+
+    def exhaustive(self, query_terms, result_count):
+        scores = {}
+        for term, weight in query_terms:
+            for doc_id, doc_weight in self.postings.get(term, []):
+                scores[doc_id] = scores.get(doc_id, 0) + doc_weight * weight
+        results = sorted(((doc_id, score / math.sqrt(self.doc_length[doc_id]))
+                for doc_id, score in scores.items()),
+                key=lambda result: (-result[1], result[0]))
+        return results[:result_count]
+
+    def assertResultsEqual(self, results, expected):
+        self.assertEqual([doc_id for doc_id, _ in results],
+                [doc_id for doc_id, _ in expected])
+        for (_, score), (_, expected_score) in zip(results, expected):
+            self.assertAlmostEqual(score, expected_score)
+
+    def test_maxscore(self):
+        for query_terms in self.queries:
+            for result_count in (1, 3, 20):
+                self.assertResultsEqual(maxscore(query_terms,
+                        lambda term: self.postings.get(term, []),
+                        self.dictionary, self.doc_length, result_count),
+                    self.exhaustive(query_terms, result_count))
+
+    def test_score_at_a_time(self):
+        for query_terms in self.queries:
+            for result_count in (1, 3, 20):
+                self.assertResultsEqual(score_at_a_time(query_terms,
+                        lambda term: self.impacts.get(term, []),
+                        result_count),
+                    self.exhaustive(query_terms, result_count))
+
+    def test_ties_in_doc_order(self):
+        query_terms = [('banana', 1.0)]
+        self.assertEqual(self.exhaustive(query_terms, 2)[0][0], 2)
+        self.assertEqual(score_at_a_time(query_terms, self.impacts.get, 2),
+                self.exhaustive(query_terms, 2))
+        self.assertEqual(maxscore(query_terms, self.postings.get,
+                self.dictionary, self.doc_length, 2),
+                self.exhaustive(query_terms, 2))
+
+    def test_negative_weights(self):
+        query_terms = [('apple', 0.5), ('cherry', -0.2)]
+        self.assertTrue(has_negative_weights(query_terms))
+        self.assertFalse(has_negative_weights(self.queries[1]))
+        with self.assertRaises(ValueError):
+            maxscore(query_terms, self.postings.get, self.dictionary,
+                    self.doc_length, 3)
+        with self.assertRaises(ValueError):
+            score_at_a_time(query_terms, self.impacts.get, 3)
+
+
+class TestScoreAtATime(unittest.TestCase):
+    def setUp(self):
+        # 2000 documents, and three terms of 1500, 600 and 100 documents
+        rng = random.Random(0)
+        self.doc_length = [rng.randint(10, 200) for _ in range(2000)]
+        self.postings = {}
+        for term, df in (('common', 1500), ('medium', 600), ('rare', 100)):
+            doc_ids = sorted(rng.sample(range(2000), df))
+            self.postings[term] = [(doc_id, 1 + math.log10(rng.randint(1, 20)))
+                    for doc_id in doc_ids]
+        self.impacts = {term: impact_order(doc_list, self.doc_length)
+                for term, doc_list in self.postings.items()}
+        self.query_terms = [('common', 0.2), ('medium', 0.5), ('rare', 0.8)]
+
+    def test_stop_test_is_linear(self):
+        # Each candidate is examined a bounded number of times by the
+        # stop test, not once per block of postings
+        stats = {}
+        score_at_a_time(self.query_terms, self.impacts.get, 10, stats=stats)
+        blocks = -(-stats['processed'] // BLOCK_SIZE)
+        self.assertLessEqual(stats['examined'],
+                2 * stats['candidates'] + blocks)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1 @@
+../2/tracing.py
\ No newline at end of file
@@ -0,0 +1,11 @@
+"""Reproducible benchmarks of the indexers, searchers and language models.
+
+    python -m bench generate -o corpus/ --docs 2000
+    python -m bench run -c corpus/ -o results.json
+    python -m bench compare baseline.json results.json
+
+`generate` writes a deterministic synthetic corpus (see corpus.py),
+`run` times each benchmark in fresh processes and records its peak
+memory (see harness.py), and `compare` flags the regressions between
+two result files (see compare.py).
+"""
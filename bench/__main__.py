@@ -0,0 +1,75 @@
+import argparse
+import sys
+
+from bench import compare, corpus, harness
+
+
+def _getCommandArgs():
+    parser = argparse.ArgumentParser(prog='python -m bench',
+            description='Benchmarks of the indexers, searchers and '
+            'language models')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    generate = commands.add_parser('generate',
+            help='generate a synthetic corpus')
+    generate.add_argument('-o', dest='output_dir', required=True,
+            help='output directory of the corpus')
+    generate.add_argument('--docs', dest='docs', type=int, default=1000,
+            help='number of documents')
+    generate.add_argument('--vocabulary', dest='vocabulary_size', type=int,
+            default=20000, help='number of distinct words')
+    generate.add_argument('--doc-length', dest='doc_length', type=int,
+            default=150, help='average number of words of a document')
+    generate.add_argument('--queries', dest='queries', type=int,
+            default=200, help='number of boolean and of ranked queries')
+    generate.add_argument('--exponent', dest='exponent', type=float,
+            default=1.0, help='exponent of the Zipfian word distribution')
+    generate.add_argument('--languages', dest='languages', type=int,
+            default=3, help='number of languages of the language models')
+    generate.add_argument('--lm-sentences', dest='lm_sentences', type=int,
+            default=2000, help='number of training sentences, a tenth '
+            'as many test sentences')
+    generate.add_argument('--seed', dest='seed', type=int, default=0,
+            help='random seed')
+
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('-c', dest='corpus_dir', required=True,
+            help='corpus directory')
+    run.add_argument('-o', dest='output_file', required=True,
+            help='JSON results file')
+    run.add_argument('-r', dest='repeat', type=int, default=3,
+            help='number of runs per benchmark')
+    run.add_argument('--only', dest='names', nargs='+',
+            choices=harness.ORDER, default=harness.ORDER,
+            help='benchmarks to run')
+    run.add_argument('--work-dir', dest='work_dir',
+            help='directory of the indexes and outputs, '
+            'a temporary directory by default')
+    run.add_argument('--workers', dest='workers', type=int, default=1,
+            help='number of indexing processes')
+    run.add_argument('--mode', dest='mode', default='maxscore',
+            choices=harness.SEARCH_MODES, help='search mode of the ranked queries')
+
+    compare_parser = commands.add_parser('compare',
+            help='flag the regressions between two result files')
+    compare_parser.add_argument('baseline_file', help='baseline results')
+    compare_parser.add_argument('current_file', help='compared results')
+    compare_parser.add_argument('-t', dest='threshold', type=float,
+            default=0.1, help='relative change flagged as a regression')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _getCommandArgs()
+    if args.command == 'generate':
+        corpus.generate(args.output_dir, args.docs, args.vocabulary_size,
+                args.doc_length, args.queries, args.exponent,
+                args.languages, args.lm_sentences, args.seed)
+    elif args.command == 'run':
+        harness.run(args.corpus_dir, args.output_file, args.names,
+                args.repeat, args.work_dir, workers=args.workers,
+                mode=args.mode)
+    else:
+        regressions = compare.main(args.baseline_file, args.current_file,
+                args.threshold)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,58 @@
+"""Comparison of two benchmark result files.
+
+Each summarized metric of the benchmarks present in both runs is
+compared, and flagged as a regression when it is worse than the
+baseline by more than the threshold: slower, larger or less accurate.
+"""
+
+import json
+
+from bench.harness import METRICS, ORDER
+
+
+def load(results_file):
+    with open(results_file) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=0.1):
+    """(benchmark, metric, baseline value, current value, relative
+    change, is regression) of the metrics of both result dicts"""
+    rows = []
+    names = [name for name in ORDER if name in baseline['benchmarks']
+            and name in current['benchmarks']]
+    for name in names:
+        old = baseline['benchmarks'][name]['summary']
+        new = current['benchmarks'][name]['summary']
+        for metric, (_, higher_is_better) in METRICS.items():
+            if metric not in old or metric not in new:
+                continue
+            change = (new[metric] - old[metric]) / old[metric] \
+                    if old[metric] else 0.0
+            worse = -change if higher_is_better else change
+            rows.append((name, metric, old[metric], new[metric], change,
+                worse > threshold))
+    return rows
+
+
+def main(baseline_file, current_file, threshold=0.1):
+    """Print the comparison, return the number of regressions"""
+    baseline = load(baseline_file)
+    current = load(current_file)
+    if baseline.get('corpus') != current.get('corpus'):
+        print("Warning: the runs used different corpus parameters")
+    if baseline.get('options') != current.get('options'):
+        print("Warning: the runs used different options")
+
+    rows = compare(baseline, current, threshold)
+    for name, metric, old, new, change, regression in rows:
+        print("{:>10} {:<20} {:>14.4f} {:>14.4f} {:>+8.1%}{}".format(
+            name, metric, old, new, change,
+            '  REGRESSION' if regression else ''))
+    missing = set(baseline['benchmarks']) ^ set(current['benchmarks'])
+    if missing:
+        print("Not compared: {}".format(', '.join(sorted(missing))))
+
+    regressions = sum(row[-1] for row in rows)
+    print("{} regressions above {:.0%}".format(regressions, threshold))
+    return regressions
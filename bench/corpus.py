@@ -0,0 +1,146 @@
+"""Deterministic synthetic corpus and queries.
+
+Words are made of random syllables, and are drawn from a Zipfian
+distribution: the word of rank r has a probability proportional to
+1 / r ** exponent, like the terms of natural language text. The same
+parameters and seed always generate the same files, whatever the
+platform, so that runs on different machines measure the same work.
+
+    <output_dir>/
+        corpus.json    parameters of the corpus
+        docs/          documents 1..docs, for 2/index.py and 3/index.py
+        boolean.txt    boolean queries, for 2/search.py
+        ranked.txt     free text queries, for 3/search.py
+        lm.train.txt   "<language> <sentence>" lines, for build_LM
+        lm.test.txt    sentences, for test_LM
+        lm.correct.txt expected labels of lm.test.txt, 'other' for the
+                       sentences of a language absent from the training
+"""
+
+import bisect
+import itertools
+import json
+import os
+import random
+
+CONSONANTS = 'bcdfghjklmnprstvwz'
+VOWELS = 'aeiou'
+
+
+class Zipf(object):
+    """Sampler of the items of a sequence, by Zipfian rank"""
+    def __init__(self, items, exponent, rng):
+        self.items = items
+        self.rng = rng
+        self.cumulative = list(itertools.accumulate(
+            1 / rank ** exponent for rank in range(1, len(items) + 1)))
+
+    def __call__(self):
+        # random() is reproducible across Python versions, unlike choices()
+        position = self.rng.random() * self.cumulative[-1]
+        index = bisect.bisect_right(self.cumulative, position)
+        return self.items[min(index, len(self.items) - 1)]
+
+    def sample(self, count):
+        return [self() for _ in range(count)]
+
+
+def vocabulary(size, rng, consonants=CONSONANTS, vowels=VOWELS):
+    """`size` distinct words of 1 to 4 syllables"""
+    syllables = [c + v for c in consonants for v in vowels]
+    words = []
+    seen = set()
+    while len(words) < size:
+        word = ''.join(rng.choice(syllables)
+                for _ in range(rng.randint(1, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def sentences(words, length, rng):
+    """Text of about `length` words, in sentences of 4 to 16 words"""
+    text = []
+    while length > 0:
+        count = min(rng.randint(4, 16), length)
+        text.append(' '.join(words.sample(count)) + '.')
+        length -= count
+    return ' '.join(text)
+
+
+def boolean_query(words, rng):
+    """Boolean query of 1 to 4 terms, with AND, OR, NOT and parentheses"""
+    def operand():
+        term = words()
+        return 'NOT ' + term if rng.random() < 0.2 else term
+
+    query = operand()
+    for _ in range(rng.randint(0, 3)):
+        operator = rng.choice(('AND', 'AND', 'OR'))
+        right = operand()
+        if rng.random() < 0.3:
+            right = '({} {} {})'.format(
+                    right, rng.choice(('AND', 'OR')), operand())
+        query = '{} {} {}'.format(query, operator, right)
+    return query
+
+
+def generate(output_dir, docs=1000, vocabulary_size=20000, doc_length=150,
+        queries=200, exponent=1.0, languages=3, lm_sentences=2000, seed=0):
+    """Write the corpus files into output_dir
+    @doc_length average number of words of a document
+    @languages number of languages of the language model files, plus
+    one unknown language in the test sentences"""
+    parameters = dict(docs=docs, vocabulary_size=vocabulary_size,
+            doc_length=doc_length, queries=queries, exponent=exponent,
+            languages=languages, lm_sentences=lm_sentences, seed=seed)
+    rng = random.Random(seed)
+    words = Zipf(vocabulary(vocabulary_size, rng), exponent, rng)
+
+    doc_dir = os.path.join(output_dir, 'docs')
+    os.makedirs(doc_dir, exist_ok=True)
+    for doc_id in range(1, docs + 1):
+        length = rng.randint(doc_length // 2, doc_length * 3 // 2)
+        with open(os.path.join(doc_dir, str(doc_id)), 'w') as f:
+            f.write(sentences(words, length, rng) + '\n')
+
+    with open(os.path.join(output_dir, 'boolean.txt'), 'w') as f:
+        for _ in range(queries):
+            f.write(boolean_query(words, rng) + '\n')
+    with open(os.path.join(output_dir, 'ranked.txt'), 'w') as f:
+        for _ in range(queries):
+            f.write(' '.join(words.sample(rng.randint(1, 6))) + '\n')
+
+    write_languages(output_dir, languages, lm_sentences, exponent, rng)
+
+    with open(os.path.join(output_dir, 'corpus.json'), 'w') as f:
+        json.dump(parameters, f, indent=2, sort_keys=True)
+    return parameters
+
+
+def write_languages(output_dir, languages, count, exponent, rng):
+    """Training and test sentences of synthetic languages, each made of
+    its own subset of the syllables"""
+    models = []
+    for language in range(languages + 1):
+        consonants = ''.join(rng.sample(CONSONANTS, 10))
+        vowels = ''.join(rng.sample(VOWELS, 3))
+        label = ('language{}'.format(language + 1)
+                if language < languages else 'other')
+        models.append((label, Zipf(vocabulary(2000, rng, consonants, vowels),
+            exponent, rng)))
+
+    with open(os.path.join(output_dir, 'lm.train.txt'), 'w') as f:
+        for _ in range(count):
+            label, words = rng.choice(models[:-1])
+            f.write('{} {}\n'.format(label,
+                ' '.join(words.sample(rng.randint(5, 25)))))
+
+    with open(os.path.join(output_dir, 'lm.test.txt'), 'w') as test, \
+            open(os.path.join(output_dir, 'lm.correct.txt'), 'w') as correct:
+        for _ in range(count // 10):
+            label, words = rng.choice(models)
+            sentence = ' '.join(words.sample(rng.randint(5, 25)))
+            test.write(sentence + '\n')
+            correct.write('{} {}\n'.format(label, sentence))
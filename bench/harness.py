@@ -0,0 +1,300 @@
+"""Timing and peak memory of the benchmarks.
+
+Every run of a benchmark is a fresh Python process, started with
+`python -m bench.harness`, which imports the modules of the benchmarked
+directory the way its scripts do, times the measured calls with
+perf_counter and reports its metrics as JSON. The peak memory is the
+maximum resident set size of the process, or of its largest child
+process for the parallel builds. The resident size before the measured
+calls (interpreter, modules, and the index or models the calls need)
+is reported separately.
+
+The searches run without result or subexpression cache, so that their
+latencies do not depend on the repeated queries of the query set; the
+decoded postings cache is on, as in the search scripts.
+"""
+
+import contextlib
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Index required by a search benchmark
+REQUIRES = {'search2': 'index2', 'search3': 'index3'}
+
+# Search modes of search3, the search.MODES of 3/, whose modules are only
+# imported by the benchmark processes
+SEARCH_MODES = ('maxscore', 'exhaustive', 'impact', 'matrix')
+
+# metric -> (summary of the runs, True when higher is better)
+METRICS = {
+    'seconds': (min, False),
+    'load_seconds': (min, False),
+    'latency_p50_ms': (min, False),
+    'latency_p95_ms': (min, False),
+    'queries_per_second': (max, True),
+    'peak_rss_kb': (max, False),
+    'accuracy': (max, True),
+}
+
+
+def max_rss_kb(who=resource.RUSAGE_SELF):
+    rss = resource.getrusage(who).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def latency_metrics(latencies):
+    total = sum(latencies)
+    return {
+        'queries': len(latencies),
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p95_ms': percentile(latencies, 0.95) * 1000,
+        'queries_per_second': len(latencies) / total if total else 0.0,
+    }
+
+
+def read_lines(filepath):
+    with open(filepath) as f:
+        return [line for line in f if line.strip()]
+
+
+# Benchmarks, run in the worker process with the modules of their
+# directory importable. They are generators, which yield once their
+# setup is done, and then their metrics without the memory.
+
+def bench_index(name, corpus_dir, work_dir, options):
+    import index
+    dict_file, postings_file = index_files(work_dir, name)
+    yield
+
+    index_options = {'workers': options.get('workers', 1)}
+    if name == 'index3' and options.get('mode') == 'impact':
+        # Impact-ordered postings for the impact mode of search3
+        index_options['impact_ordered'] = True
+
+    start = time.perf_counter()
+    index.main(os.path.join(corpus_dir, 'docs'), dict_file, postings_file,
+            **index_options)
+    seconds = time.perf_counter() - start
+    yield {'seconds': seconds,
+            'index_bytes': os.path.getsize(dict_file)
+            + os.path.getsize(postings_file)}
+
+
+def bench_search2(name, corpus_dir, work_dir, options):
+    import nltk
+    import search
+    dict_file, postings_file = index_files(work_dir, 'index2')
+    queries = read_lines(os.path.join(corpus_dir, 'boolean.txt'))
+
+    start = time.perf_counter()
+    _, dictionary, universal_doc, doc_set = search.load_index(
+            dict_file, postings_file, search.CONTAINERS['skiplist'],
+            64 * 1024 * 1024)
+    load_seconds = time.perf_counter() - start
+    yield
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        query_tokens = search.shunting(nltk.word_tokenize(query))
+        search.search(query_tokens, universal_doc, doc_set, dictionary)
+        latencies.append(time.perf_counter() - start)
+    doc_set.close()
+    yield dict(latency_metrics(latencies), seconds=sum(latencies),
+            load_seconds=load_seconds)
+
+
+def bench_search3(name, corpus_dir, work_dir, options):
+    import search
+    dict_file, postings_file = index_files(work_dir, 'index3')
+    queries = read_lines(os.path.join(corpus_dir, 'ranked.txt'))
+    mode = options.get('mode', search.MAXSCORE)
+
+    start = time.perf_counter()
+    doc_ids, doc_length, dictionary, postings = search.load_index(
+            dict_file, postings_file, 64 * 1024 * 1024)
+    impacts = search.load_impacts(postings_file, dictionary, postings,
+            64 * 1024 * 1024)
+    search_engine = search.SearchEngine(dictionary, doc_ids, doc_length,
+            postings, impacts)
+    load_seconds = time.perf_counter() - start
+    yield
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search_engine.search(query, 10, mode)
+        latencies.append(time.perf_counter() - start)
+    postings.close()
+    yield dict(latency_metrics(latencies), seconds=sum(latencies),
+            load_seconds=load_seconds, mode=mode)
+
+
+def bench_build_lm(name, corpus_dir, work_dir, options):
+    import build_test_LM as lm
+    tokenizer = lm.CharacterTokenizer(ngram=4, pad=True)
+    yield
+
+    start = time.perf_counter()
+    lm.build_LM(os.path.join(corpus_dir, 'lm.train.txt'), tokenizer)
+    yield {'seconds': time.perf_counter() - start}
+
+
+def bench_test_lm(name, corpus_dir, work_dir, options):
+    import build_test_LM as lm
+    tokenizer = lm.CharacterTokenizer(ngram=4, pad=True)
+    language_models = lm.build_LM(
+            os.path.join(corpus_dir, 'lm.train.txt'), tokenizer)
+    output_file = os.path.join(work_dir, 'lm.out.txt')
+    yield
+
+    start = time.perf_counter()
+    lm.test_LM(os.path.join(corpus_dir, 'lm.test.txt'), output_file,
+            language_models, tokenizer)
+    seconds = time.perf_counter() - start
+
+    predicted = [line.split(' ', 1)[0] for line in read_lines(output_file)]
+    correct = [line.split(' ', 1)[0] for line in
+            read_lines(os.path.join(corpus_dir, 'lm.correct.txt'))]
+    accuracy = (sum(p == c for p, c in zip(predicted, correct))
+            / len(correct) if correct else 0.0)
+    yield {'seconds': seconds, 'queries': len(correct),
+            'accuracy': accuracy}
+
+
+# name -> (directory of the benchmarked modules, benchmark)
+BENCHMARKS = {
+    'index2': ('2', bench_index),
+    'index3': ('3', bench_index),
+    'search2': ('2', bench_search2),
+    'search3': ('3', bench_search3),
+    'build_lm': ('1', bench_build_lm),
+    'test_lm': ('1', bench_test_lm),
+}
+ORDER = ('index2', 'index3', 'search2', 'search3', 'build_lm', 'test_lm')
+
+
+def index_files(work_dir, name):
+    return (os.path.join(work_dir, name + '.dict'),
+            os.path.join(work_dir, name + '.postings'))
+
+
+def measure(name, corpus_dir, work_dir, options):
+    """Metrics of a run of the benchmark `name`, in this process"""
+    corpus_dir = os.path.abspath(corpus_dir)
+    work_dir = os.path.abspath(work_dir)
+    directory, benchmark = BENCHMARKS[name]
+    directory = os.path.join(ROOT, directory)
+    sys.path.insert(0, directory)
+    os.chdir(directory)
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        steps = benchmark(name, corpus_dir, work_dir, options)
+        next(steps)
+        baseline_rss_kb = max_rss_kb()
+        metrics = next(steps)
+
+    metrics['baseline_rss_kb'] = baseline_rss_kb
+    metrics['peak_rss_kb'] = max(max_rss_kb(),
+            max_rss_kb(resource.RUSAGE_CHILDREN))
+    return metrics
+
+
+def run_worker(name, corpus_dir, work_dir, options):
+    """Metrics of a run of the benchmark `name` in a fresh process"""
+    process = subprocess.run(
+            [sys.executable, '-m', 'bench.harness', name, corpus_dir,
+                work_dir, json.dumps(options)],
+            cwd=ROOT, stdout=subprocess.PIPE, check=True,
+            universal_newlines=True)
+    return json.loads(process.stdout)
+
+
+def summarize(runs):
+    """Summary of each metric over the runs of a benchmark"""
+    summary = {}
+    for metric, (summary_function, _) in METRICS.items():
+        values = [run[metric] for run in runs if metric in run]
+        if values:
+            summary[metric] = summary_function(values)
+    seconds = [run['seconds'] for run in runs]
+    summary['median_seconds'] = statistics.median(seconds)
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=ROOT, stderr=subprocess.DEVNULL,
+                universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(corpus_dir, output_file, names=ORDER, repeat=3, work_dir=None,
+        **options):
+    """Run each benchmark `repeat` times and write the JSON results
+    @options passed to the benchmarks: workers of the index builds,
+    search mode of search3, whose index3 is impact-ordered for the
+    impact mode"""
+    corpus_dir = os.path.abspath(corpus_dir)
+    with open(os.path.join(corpus_dir, 'corpus.json')) as f:
+        corpus = json.load(f)
+
+    with contextlib.ExitStack() as stack:
+        if work_dir is None:
+            work_dir = stack.enter_context(
+                    tempfile.TemporaryDirectory(prefix='bench'))
+        work_dir = os.path.abspath(work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+
+        benchmarks = {}
+        for name in ORDER:
+            if name not in names:
+                continue
+            required = REQUIRES.get(name)
+            if required and not os.path.exists(
+                    index_files(work_dir, required)[0]):
+                run_worker(required, corpus_dir, work_dir, options)
+            runs = []
+            for _ in range(repeat):
+                runs.append(run_worker(name, corpus_dir, work_dir, options))
+            benchmarks[name] = {'runs': runs, 'summary': summarize(runs)}
+            print("{:>10}: {seconds:.4f}s, {peak_rss_kb} KB peak".format(
+                name, **benchmarks[name]['summary']))
+
+    results = {
+        'format': 1,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': corpus,
+        'repeat': repeat,
+        'options': options,
+        'benchmarks': benchmarks,
+    }
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    name, corpus_dir, work_dir, options = sys.argv[1:]
+    print(json.dumps(measure(name, corpus_dir, work_dir, json.loads(options))))